@@ -0,0 +1,642 @@
+import asyncio
+import json
+import os
+import time
+
+from compression import BLOCK_LENGTH, MAX_BLOCK_SIZE, Compressor, Decompressor, codec_flags, flag_codec
+from connection import StripedUpload
+from log import get_logger
+from metrics import serve_metrics
+from server import Server
+from throttle import consume, new_bucket, wait_time
+from tools import (DataType, Framing, HASH_ALGORITHMS, MESSAGE_FIELDS, decode_hello, hello_missing, login_reply,
+                   new_digest, pack_indices)
+
+logger = get_logger(__name__)
+
+
+class StreamClient:
+    """
+    Writing end of a client connection. Writes go through a lock so a broadcast can't end up in the middle of
+    a file being downloaded.
+    """
+
+    def __init__(self, writer: asyncio.StreamWriter, framing: Framing, login: str):
+        self.writer = writer
+        self.framing = framing
+        self.login = login
+        self.lock = asyncio.Lock()
+        # (transfer id, digest) of a resumable upload waiting for its FILE_DIGEST trailer
+        self.pending_upload = None
+        # Deduplicated uploads in progress (see Connection.pending_manifests)
+        self.pending_manifests = dict()
+        # Version of the list of the server files the client has, and whether it missed changes to them (see
+        # Connection.files_version and Connection.files_stale)
+        self.files_version = None
+        self.files_stale = False
+        # Bytes of the messages waiting for their turn to be sent, or for the client to read them
+        self.queued = 0
+        # Flags and id of the request being handled, its answers carry the id back (0 for none)
+        self.flags = 0
+        self.request_id = 0
+        # Rate limit of the files sent to the client, shared with its data connections (None for no limit)
+        self.bucket = None
+        # ServerMetrics of the server, None if disabled
+        self.metrics = None
+
+    async def send(self, data: bytes):
+        self.queued += len(data)
+        try:
+            async with self.lock:
+                started = time.monotonic()
+                self.writer.write(data)
+                await self.writer.drain()
+                if self.metrics is not None:
+                    self.metrics.wait_seconds.inc(time.monotonic() - started, ("send",))
+                    self.metrics.sent_bytes.inc(len(data), (self.login,))
+        finally:
+            self.queued -= len(data)
+
+    async def send_header(self, data_type: int, *fields: bytes, flags: int = 0):
+        """
+        Sends a data type followed by length-prefixed fields, answering the request being handled if any
+        """
+
+        await self.send(self.framing.encode_message(data_type, fields, flags, self.request_id))
+
+
+class AsyncServer(Server):
+    """
+    Server built on asyncio instead of a selectors loop, with the same DataType semantics.
+
+    Every client is served by its own task which simply awaits the data it needs, and every write awaits
+    drain() so a slow client only slows down its own task.
+    """
+
+    # Maximum number of pending connections waiting to be accepted
+    BACKLOG = 1024
+    # Bytes read from a client at once while receiving a file
+    RECV_SIZE = 65536
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # Login -> StreamClient
+        self.CLIENTS = dict()
+        # Broadcast tasks, referenced until they are done so they aren't garbage collected
+        self.background_tasks = set()
+        # Taken by a download to send its next chunk within the rate limit of the server, the downloads waiting for
+        # it get it in turn
+        self.send_turn = asyncio.Lock()
+
+    def add_gauges(self) -> None:
+        self.metrics.gauge("connections", "Clients logged in", function=lambda: len(self.CLIENTS))
+        self.metrics.gauge("queued_bytes", "Bytes of messages waiting to be sent to the clients",
+                           function=lambda: sum(client.queued for client in list(self.CLIENTS.values())))
+
+    def start(self):
+        """
+        Starts the server and listens for incoming connections.
+        """
+
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        self.open_storage()
+        if self.index.watcher is not None:
+            asyncio.get_running_loop().add_reader(self.index.watcher, self.handle_index_events, self.index.watcher)
+        self.start_background(self.rescan_files())
+        if self.METRICS_PORT:
+            serve_metrics(self.METRICS_PORT, self.metrics)
+        logger.info("Starting server on %s:%d", self.SERVER_IP, self.PORT)
+        server = await asyncio.start_server(self.handle_connection, self.SERVER_IP, self.PORT,
+                                            reuse_address=True, backlog=self.BACKLOG)
+        logger.info("Listening on %s:%d", self.SERVER_IP, self.PORT)
+        async with server:
+            await server.serve_forever()
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Task serving one client from its login until it disconnects
+        """
+
+        addr = writer.get_extra_info("peername")
+        try:
+            data_type, fields, framing = await asyncio.wait_for(self.receive_hello(reader), self.LOGIN_TIMEOUT)
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            writer.close()
+            return
+        except TimeoutError:
+            logger.info("No login from %s within %s seconds", addr, self.LOGIN_TIMEOUT)
+            writer.close()
+            return
+        if data_type != DataType.LOGIN:
+            try:
+                await self.serve_range(reader, writer, data_type, fields)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                pass
+            finally:
+                writer.close()
+            return
+
+        try:
+            login = fields[0].decode(self.FORMAT)
+        except ValueError:
+            logger.warning("Invalid login from %s", addr)
+            writer.close()
+            return
+
+        if login in self.CLIENTS:
+            logger.info("%s is already connected to the server", login)
+            writer.write(login_reply(framing, False))
+            await writer.drain()
+            writer.close()
+            return
+        writer.write(login_reply(framing, True, self.login_flags()))
+        client = StreamClient(writer, framing, login)
+        client.bucket = new_bucket(self.CLIENT_RATE)
+        client.metrics = self.metrics
+        self.CLIENTS[login] = client
+        logger.info("%s has connected to the server from %s", login, addr)
+
+        try:
+            while True:
+                try:
+                    header = await reader.readexactly(framing.header_size)
+                    data_type, client.flags, client.request_id, length = framing.decode_request_header(header)
+                    data_type = DataType(data_type)
+                except ValueError:
+                    data_type = None
+                if data_type not in MESSAGE_FIELDS:
+                    logger.warning("Invalid data type from %s", login)
+                    break
+                if data_type == DataType.DISCONNECT:
+                    break
+
+                fields = []
+                for _ in range(MESSAGE_FIELDS[data_type]):
+                    # Binary frames carry the length of the first field in their header
+                    fields.append(await self.receive_field(reader, framing, length))
+                    length = None
+                if self.metrics is not None:
+                    self.metrics.messages.inc(1, (data_type.name,))
+                    # Length prefixes of the fields aside
+                    self.metrics.received_bytes.inc(len(header) + sum(len(field) for field in fields), (login,))
+                await self.handle_message(reader, client, data_type, fields)
+                await self.catch_up_files(client)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except (ValueError, OSError):
+            logger.exception("Error handling a message from %s", login)
+        finally:
+            self.drop_manifests(client)
+            if self.CLIENTS.get(login) is client:
+                logger.info("%s has disconnected from the server", login)
+                del self.CLIENTS[login]
+            writer.close()
+
+    async def receive_hello(self, reader: asyncio.StreamReader) -> tuple[int, list[bytes], Framing]:
+        """
+        Receives the first message of a connection (see tools.hello_missing)
+        """
+
+        data = bytearray()
+        while missing := hello_missing(data):
+            data += await reader.readexactly(missing)
+        return decode_hello(data, self.HEADERDATALEN, self.FORMAT)
+
+    async def serve_range(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, data_type: int,
+                          fields: list[bytes]):
+        """
+        Serves a data connection carrying one range of a file uploaded or downloaded over several connections
+        """
+
+        try:
+            login, transfer_id, file_name = (field.decode(self.FORMAT) for field in fields[:3])
+            file_size, offset, length = (int(field) for field in fields[3:])
+        except ValueError:
+            # Missing fields, or not numbers
+            logger.warning("Invalid range request from %s", writer.get_extra_info("peername"))
+            return
+        if login not in self.CLIENTS or offset < 0 or length < 0 or offset + length > file_size:
+            logger.warning("Invalid range request from %s", writer.get_extra_info("peername"))
+            return
+
+        if data_type == DataType.DOWNLOAD_RANGE:
+            if self.file_size(file_name) is None:
+                logger.info("Range of %s requested, it does not exist", file_name)
+                return
+            started = time.monotonic()
+            chunks = self.pin_file(file_name)
+            try:
+                await self.send_segments(writer, self.file_segments(file_name, offset, length),
+                                         bucket=self.CLIENTS[login].bucket)
+                await writer.drain()
+            finally:
+                self.release_file(chunks)
+            self.count_transfer(login, "download", length, started)
+            # Wait for the client to close the connection once it has received the whole range
+            await reader.read()
+            return
+
+        # The first range to arrive creates the transfer
+        key = (login, transfer_id)
+        if key not in self.transfers:
+            file_path = self.striped_path(transfer_id)
+            if file_path is None:
+                logger.warning("Invalid range request from %s", writer.get_extra_info("peername"))
+                return
+            logger.debug("Receiving file over several connections: %s", file_name)
+            self.transfers[key] = StripedUpload(file_path, file_name, file_size)
+        transfer = self.transfers[key]
+        remaining = length
+        started = time.monotonic()
+        try:
+            while remaining and not transfer.closed():
+                data = await reader.read(min(remaining, self.RECV_SIZE))
+                if not data:
+                    break
+                transfer.write(offset, data)
+                offset += len(data)
+                remaining -= len(data)
+        finally:
+            self.count_transfer(login, "upload", length - remaining, started)
+            if transfer.closed():
+                pass
+            elif transfer.done():
+                self.complete_transfer(transfer)
+                await self.send_files_info()
+            elif remaining:
+                logger.warning("Upload of %s interrupted", transfer.file_name)
+                self.drop_transfer(transfer)
+
+    @staticmethod
+    async def receive_length(reader: asyncio.StreamReader, framing: Framing) -> int:
+        return framing.decode_length(await reader.readexactly(framing.length_size))
+
+    async def receive_field(self, reader: asyncio.StreamReader, framing: Framing, length: int = None) -> bytes:
+        if length is None:
+            length = await self.receive_length(reader, framing)
+        return await reader.readexactly(length) if length else b""
+
+    async def receive_to(self, reader: asyncio.StreamReader, file, length: int, digest=None, codec=None):
+        """
+        Writes the next length bytes sent by a client to file, hashing them with digest if given. With a codec they
+        come in compressed blocks, a block which can't be decompressed aborts the connection.
+        """
+
+        decompressor = Decompressor(codec) if codec is not None else None
+        remaining = length
+        while remaining:
+            if decompressor is None:
+                data = await reader.read(min(remaining, self.RECV_SIZE))
+            else:
+                block_length = BLOCK_LENGTH.unpack(await reader.readexactly(BLOCK_LENGTH.size))[0]
+                if not 0 < block_length <= MAX_BLOCK_SIZE:
+                    logger.warning("Invalid compressed block")
+                    raise ConnectionAbortedError
+                try:
+                    data = decompressor.decompress(await reader.readexactly(block_length), remaining)
+                except ValueError as err:
+                    logger.warning("Invalid compressed block: %s", err)
+                    raise ConnectionAbortedError
+            if not data:
+                raise asyncio.IncompleteReadError(b"", remaining)
+            file.write(data)
+            if digest is not None:
+                digest.update(data)
+            remaining -= len(data)
+
+    async def handle_message(self, reader: asyncio.StreamReader, client: StreamClient, data_type: int,
+                             fields: list[bytes]):
+        match data_type:
+            case DataType.DEBUG:
+                # Debug message
+                if fields[0]:
+                    logger.info("Debug message from %s: %s", client.login, fields[0].decode(self.FORMAT))
+
+            case DataType.COMMAND:
+                # Command
+                if fields[0]:
+                    logger.info("Command from %s: %s", client.login, fields[0].decode(self.FORMAT))
+
+            case DataType.UPLOAD_FILE:
+                codec = self.upload_codec(client)
+                file_size = await self.receive_length(reader, client.framing)
+                started = time.monotonic()
+                with self.open_upload(fields[0].decode(self.FORMAT)) as file:
+                    await self.receive_to(reader, file, file_size, codec=codec)
+                self.count_transfer(client.login, "upload", file_size, started)
+                file_name = os.path.basename(file.name)
+                logger.info("Received file: %s", file_name)
+                self.index.refresh(file_name)
+                await self.send_files_info()
+
+            case DataType.UPLOAD_RESUMABLE:
+                codec = self.upload_codec(client)
+                length = await self.receive_length(reader, client.framing)
+                file, digest = self.open_partial(client.login, fields, length)
+                if file is None:
+                    logger.warning("Invalid resumable upload from %s", client.login)
+                    raise ConnectionAbortedError
+                started = time.monotonic()
+                with file:
+                    await self.receive_to(reader, file, length, digest, codec)
+                self.count_transfer(client.login, "upload", length, started)
+
+                # The upload is complete after its last segment, unless it still has to be checked against its
+                # FILE_DIGEST trailer
+                transfer_id = fields[0].decode(self.FORMAT)
+                if not self.segment_received(transfer_id, int(fields[2]), digest):
+                    return
+                if digest is not None:
+                    client.pending_upload = (transfer_id, digest)
+                    return
+                file_path = self.complete_partial(transfer_id)
+                logger.info("Received file: %s", os.path.basename(file_path))
+                await self.send_files_info()
+
+            case DataType.FILE_DIGEST:
+                file_path = self.verify_upload(client, fields)
+                if file_path is None:
+                    await client.send_header(DataType.DEBUG, b"Upload failed the integrity check")
+                    return
+                logger.info("Received file: %s", os.path.basename(file_path))
+                await self.send_files_info()
+
+            case DataType.UPLOAD_MANIFEST:
+                missing = self.receive_manifest(client, fields)
+                if missing is None:
+                    logger.warning("Invalid manifest from %s", client.login)
+                    raise ConnectionAbortedError
+                await client.send_header(DataType.CHUNKS_NEEDED, fields[0], pack_indices(missing))
+                if not missing:
+                    self.complete_manifest(client, fields[0].decode(self.FORMAT))
+                    await self.send_files_info()
+
+            case DataType.UPLOAD_CHUNK:
+                completed = self.receive_chunk(client, fields[0])
+                if completed is None:
+                    logger.warning("Unexpected chunk from %s", client.login)
+                    raise ConnectionAbortedError
+                if completed:
+                    await self.send_files_info()
+
+            case DataType.TRANSFER_OFFSET:
+                offset = self.partial_offset(client.login, fields[0].decode(self.FORMAT))
+                await client.send_header(DataType.TRANSFER_OFFSET, fields[0], str(offset).encode(self.FORMAT))
+
+            case DataType.DOWNLOAD_FILE:
+                # Send the token back to the client to tell it which file is being sent
+                file_name = fields[0].decode(self.FORMAT)
+                file_size = self.file_size(file_name)
+                if file_size is None:
+                    await self.reply_error(client, f"File {file_name} does not exist")
+                    return
+
+                codec = self.download_codec(file_name, 0, client.flags)
+                async with client.lock:
+                    writer = client.writer
+                    writer.write(client.framing.encode_message(DataType.DOWNLOAD_FILE, [fields[1]],
+                                                               codec_flags([codec]), client.request_id))
+                    writer.write(client.framing.encode_length(file_size))
+                    await writer.drain()
+                    started = time.monotonic()
+                    chunks = self.pin_file(file_name)
+                    try:
+                        await self.send_segments(writer, self.file_segments(file_name), codec=codec,
+                                                 bucket=client.bucket)
+                    finally:
+                        self.release_file(chunks)
+                    self.count_transfer(client.login, "download", file_size, started)
+
+            case DataType.DOWNLOAD_FROM:
+                # Send the end of the file, after the bytes the client already has
+                file_name = fields[0].decode(self.FORMAT)
+                file_size = self.file_size(file_name)
+                if file_size is None:
+                    await self.reply_error(client, f"File {file_name} does not exist")
+                    return
+
+                algorithm = fields[3].decode(self.FORMAT)
+                if algorithm and algorithm not in HASH_ALGORITHMS:
+                    await self.reply_error(client, f"Unsupported hash algorithm {algorithm}")
+                    return
+
+                offset = min(int(fields[2]) if fields[2].isdigit() else 0, file_size)
+                # Without a known digest the file is hashed while it is sent, after the bytes the client has
+                cached = self.cached_digest(file_name, algorithm) if algorithm else None
+                digest = None
+                # Pinned from the hashing of the bytes the client already has on
+                chunks = self.pin_file(file_name)
+                try:
+                    if algorithm and cached is None:
+                        digest = await asyncio.to_thread(new_digest, algorithm,
+                                                         self.file_segments(file_name, 0, offset), self.FILE_CHUNK_SIZE)
+
+                    codec = self.download_codec(file_name, offset, client.flags)
+                    async with client.lock:
+                        writer = client.writer
+                        header = [fields[1], str(offset).encode(self.FORMAT), fields[3]]
+                        writer.write(client.framing.encode_message(DataType.DOWNLOAD_FROM, header, codec_flags([codec]),
+                                                                   client.request_id))
+                        writer.write(client.framing.encode_length(file_size - offset))
+                        await writer.drain()
+                        started = time.monotonic()
+                        await self.send_segments(writer, self.file_segments(file_name, offset), digest, codec,
+                                                 client.bucket)
+                        self.count_transfer(client.login, "download", file_size - offset, started)
+                        if algorithm:
+                            if cached is None:
+                                cached = digest.digest()
+                                self.cache_digest(file_name, algorithm, cached)
+                            writer.write(client.framing.encode_message(DataType.FILE_DIGEST,
+                                                                       [algorithm.encode(), cached]))
+                            await writer.drain()
+                finally:
+                    self.release_file(chunks)
+
+            case DataType.DOWNLOAD_STRIPED:
+                # Tell the client the size of the file, it then requests ranges of it over data connections
+                file_name = fields[0].decode(self.FORMAT)
+                file_size = self.file_size(file_name)
+                if file_size is not None:
+                    file_size = str(file_size).encode(self.FORMAT)
+                    await client.send_header(DataType.DOWNLOAD_STRIPED, fields[1], fields[0], file_size)
+                else:
+                    await self.reply_error(client, f"File {file_name} does not exist")
+
+            case DataType.FILES_INFO:
+                await self.send_files_info(client)
+
+            case DataType.FILES_DELTA:
+                data = self.files_delta(fields[0]).encode(self.FORMAT)
+                client.files_version = self.index.version
+                await client.send_header(DataType.FILES_DELTA, data)
+
+            case DataType.FILES_QUERY:
+                data = self.files_page(fields).encode(self.FORMAT)
+                await client.send_header(DataType.FILES_QUERY, data)
+
+            case DataType.DELETE_FILE:
+                file_name = fields[0].decode(self.FORMAT)
+                if self.delete_file(file_name):
+                    logger.info("Deleting file: %s", file_name)
+                    if client.framing.request_ids:
+                        await client.send_header(DataType.DELETE_FILE, fields[0])
+                    await self.send_files_info()
+                else:
+                    await self.reply_error(client, f"File {file_name} does not exist")
+
+            case DataType.STATS:
+                if self.metrics is None:
+                    await self.reply_error(client, "Metrics are disabled")
+                    return
+                await client.send_header(DataType.STATS, json.dumps(self.metrics.snapshot()).encode(self.FORMAT))
+
+    def count_transfer(self, login: str, direction: str, size: int, started: float) -> None:
+        """
+        Adds a file (or range of a file) uploaded or downloaded since time.monotonic() started to the metrics
+        """
+
+        if self.metrics is None:
+            return
+        counter = self.metrics.sent_bytes if direction == "download" else self.metrics.received_bytes
+        counter.inc(size, (login,))
+        self.metrics.transfer_seconds.observe(time.monotonic() - started, (direction,))
+
+    @staticmethod
+    def upload_codec(client: StreamClient):
+        """
+        Returns the codec of the upload a client is sending, from the flags of its message. Aborts the connection
+        if the server doesn't have it.
+        """
+
+        try:
+            return flag_codec(client.flags)
+        except ValueError as err:
+            logger.warning("Invalid upload from %s: %s", client.login, err)
+            raise ConnectionAbortedError
+
+    async def reply_error(self, client: StreamClient, message: str):
+        """
+        Answers a request which can't be served with a DEBUG message (see Server.reply_error)
+        """
+
+        logger.info("Request of %s failed: %s", client.login, message)
+        await client.send_header(DataType.DEBUG, message.encode(self.FORMAT))
+
+    async def send_segments(self, writer: asyncio.StreamWriter, segments: list[tuple[str, int, int]], digest=None,
+                            codec=None, bucket=None):
+        """
+        Writes (file path, offset, count) pieces of files to a client, with zero-copy where the platform supports it
+        unless they have to be hashed with digest or compressed with codec while they are sent.
+        With rate limits, the pieces are sent a chunk at a time within the limits of the server, of the client (its
+        bucket) and of the transfer.
+        """
+
+        loop = asyncio.get_running_loop()
+        compressor = Compressor(codec) if codec is not None else None
+        buckets = (self.send_bucket, bucket, new_bucket(self.TRANSFER_RATE))
+        throttled = any(limit is not None for limit in buckets)
+        for file_path, offset, count in segments:
+            if not count:
+                continue
+            with open(file_path, "rb") as file:
+                if digest is None and compressor is None:
+                    if not throttled:
+                        await loop.sendfile(writer.transport, file, offset, count)
+                        continue
+                    while count:
+                        await self.throttle(buckets, min(self.FILE_CHUNK_SIZE, count))
+                        sent = await loop.sendfile(writer.transport, file, offset, min(self.FILE_CHUNK_SIZE, count))
+                        if not sent:
+                            break
+                        offset += sent
+                        count -= sent
+                    continue
+                file.seek(offset)
+                while count and (data := file.read(min(self.FILE_CHUNK_SIZE, count))):
+                    if digest is not None:
+                        digest.update(data)
+                    block = data if compressor is None else compressor.compress(data)
+                    if throttled:
+                        await self.throttle(buckets, len(block))
+                    writer.write(block)
+                    await writer.drain()
+                    count -= len(data)
+
+    async def throttle(self, buckets, size: int):
+        """
+        Waits until the rate limits (TokenBuckets, None for no limit) allow sending a chunk of size bytes, then takes
+        it from them. The downloads waiting for the limit of the server send their chunks in turn.
+        """
+
+        while (delay := wait_time(buckets[1:])) > 0:
+            await asyncio.sleep(delay)
+        async with self.send_turn:
+            while (delay := wait_time(buckets)) > 0:
+                await asyncio.sleep(delay)
+            consume(buckets, size)
+
+    async def send_files_info(self, client: StreamClient = None):
+        """
+        Sends information about the files stored on the server to a client, or the changes to them to all clients
+        """
+
+        if client is not None:
+            logger.debug("Sending files info")
+            await client.send_header(DataType.FILES_INFO, self.files_info_data())
+        else:
+            # Give each client its own task so a slow client doesn't hold up the broadcast
+            for other, message in self.files_broadcast():
+                self.start_background(self.send_quietly(other, message))
+
+    def start_background(self, coroutine) -> None:
+        task = asyncio.create_task(coroutine)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+
+    def handle_index_events(self, watcher) -> None:
+        """
+        Updates the index with the changes made to the files directory, and tells the clients about them
+        """
+
+        changed = self.index.read_events()
+        if self.index.watcher is None:
+            # The watch was lost, the files are rescanned periodically from now on
+            asyncio.get_running_loop().remove_reader(watcher)
+            watcher.close()
+        if changed:
+            self.start_background(self.send_files_info())
+
+    async def rescan_files(self):
+        """
+        Task reconciling the index with the files on disk every once in a while. The directory is scanned in a
+        thread, only the differences found are checked again from the event loop.
+        """
+
+        while True:
+            await asyncio.sleep(self.index.timeout())
+            if self.index.rescan(await asyncio.to_thread(self.scan_files)):
+                await self.send_files_info()
+
+    async def send_quietly(self, client: StreamClient, data: bytes):
+        """
+        Sends a change to the server files to a client whose connection may be gone, its own task takes care of the
+        disconnection. Once the client has caught up, it gets what it missed while it was too far behind.
+        """
+
+        try:
+            await client.send(data)
+            await self.catch_up_files(client)
+        except ConnectionError:
+            pass
+
+    async def catch_up_files(self, client: StreamClient):
+        """
+        Sends a client which was too far behind the changes to the server files it missed, once it has caught up
+        """
+
+        if client.files_stale and client.queued <= self.LOW_WATER_MARK:
+            for client, message in self.files_broadcast([client]):
+                await client.send(message)
@@ -0,0 +1,132 @@
+"""
+Upload and download of different kinds of files with each compression codec installed, through a local proxy
+limiting the bandwidth like a real link: wall time and bytes on the wire.
+
+Random data stands for files which are already compressed (archives, pictures, videos), which are sent as they
+are whatever the codec once their entropy gives them away.
+
+    python benchmarks/compressed_transfer.py --size 64 --rate 20
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from harness import DataType, DelayProxy, start_server
+import main as fdp
+from client import Client
+from compression import CODECS
+
+
+def log_file(file, size: int) -> None:
+    levels = ["INFO"] * 8 + ["DEBUG"] * 4 + ["WARNING", "ERROR"]
+    messages = ["Request served in {} ms", "Connection from 10.0.{}.{} accepted", "Cache miss for key user:{}",
+                "Retrying upload {} after timeout", "Worker {} finished its batch of {} items"]
+    written = 0
+    timestamp = 1700000000.0
+    while written < size:
+        timestamp += random.random()
+        line = (f"{time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(timestamp))} {random.choice(levels):<7} "
+                f"[{random.choice(['server', 'index', 'store', 'client'])}] "
+                + random.choice(messages).format(*(random.randint(0, 9999) for _ in range(2))) + "\n")
+        written += file.write(line.encode())
+
+
+def csv_file(file, size: int) -> None:
+    written = file.write(b"id,timestamp,sensor,temperature,humidity,pressure\n")
+    row = 0
+    while written < size:
+        row += 1
+        written += file.write(f"{row},{1700000000 + row * 60},sensor-{row % 32:02},{random.uniform(15, 30):.2f},"
+                              f"{random.uniform(20, 80):.1f},{random.uniform(990, 1030):.1f}\n".encode())
+
+
+def random_file(file, size: int) -> None:
+    for _ in range(size // (1024 * 1024)):
+        file.write(os.urandom(1024 * 1024))
+
+
+GENERATORS = {"log": log_file, "csv": csv_file, "random": random_file}
+
+
+def wait_file(server, file_name: str, file_size: int) -> None:
+    while (entry := server.index.files.get(file_name)) is None or entry.size != file_size:
+        time.sleep(0.005)
+
+
+def run(server, proxy: DelayProxy, file_path: str, codec: str, directory: str) -> tuple[float, int, float, int]:
+    """
+    Uploads then downloads a file, returns the time each took and the bytes they sent on the wire
+    """
+
+    client = Client(hash_algorithm="", compression=[] if codec == "none" else [codec])
+    client.PORT = proxy.port
+    client.connect_to_server(f"compression{codec}", "127.0.0.1")
+    file_name = os.path.basename(file_path)
+    file_size = os.path.getsize(file_path)
+
+    sent = proxy.forwarded["up"]
+    start = time.perf_counter()
+    client.upload_file(file_path)
+    wait_file(server, file_name, file_size)
+    upload_time = time.perf_counter() - start
+    upload_bytes = proxy.forwarded["up"] - sent
+
+    received = proxy.forwarded["down"]
+    downloaded_path = os.path.join(directory, f"downloaded-{file_name}")
+    start = time.perf_counter()
+    if not client.download_file(file_name, downloaded_path).result():
+        raise RuntimeError(f"Download of {file_name} failed")
+    download_time = time.perf_counter() - start
+    download_bytes = proxy.forwarded["down"] - received
+    if os.path.getsize(downloaded_path) != file_size:
+        raise RuntimeError(f"Download of {file_name} with {codec} is truncated")
+    os.remove(downloaded_path)
+
+    client.send(DataType.DISCONNECT)
+    return upload_time, upload_bytes, download_time, download_bytes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=64, help="file size in MB")
+    parser.add_argument("--rate", type=float, default=20, help="link bandwidth in MB/s")
+    parser.add_argument("--types", nargs="+", choices=list(GENERATORS), default=list(GENERATORS))
+    parser.add_argument("--codecs", nargs="+", default=["none", *CODECS])
+    parser.add_argument("--engine", default="selectors", choices=["selectors", "asyncio"])
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        # The client keeps track of its transfers in the working directory
+        os.chdir(directory)
+        fdp.DEFAULT_CLIENT_TRANSFERS_PATH = os.path.join(directory, "client_transfers.json")
+        # The server compresses downloads with whichever codec the client asks for
+        server = start_server(os.path.join(directory, "server_files"), args.engine, compression=args.codecs)
+        proxy = DelayProxy(server.PORT, 0, window=16 * 1024 * 1024, rate=args.rate * 1024 * 1024)
+        proxy.start()
+
+        for file_type in args.types:
+            source = os.path.join(directory, f"{file_type}.dat")
+            with open(source, "wb") as file:
+                GENERATORS[file_type](file, args.size * 1024 * 1024)
+            for codec in args.codecs:
+                # A file of its own for every codec, so each upload is a new file on the server
+                file_path = os.path.join(directory, f"{file_type}-{codec}.dat")
+                os.link(source, file_path)
+                results.append((file_type, codec, os.path.getsize(file_path),
+                                *run(server, proxy, file_path, codec, directory)))
+
+    print()
+    print(f"{args.size} MB files, {args.rate:g} MB/s link, {args.engine} server")
+    print(f"{'type':>7} {'codec':>6} {'upload s':>9} {'MB on wire':>11} {'ratio':>6} {'download s':>11} "
+          f"{'MB on wire':>11} {'ratio':>6}")
+    for file_type, codec, file_size, upload_time, upload_bytes, download_time, download_bytes in results:
+        print(f"{file_type:>7} {codec:>6} {upload_time:>9.2f} {upload_bytes / 1048576:>11.1f} "
+              f"{file_size / upload_bytes:>6.2f} {download_time:>11.2f} {download_bytes / 1048576:>11.1f} "
+              f"{file_size / download_bytes:>6.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""
+Latency of small FILES_INFO requests while large uploads are in flight.
+
+Before the non-blocking connection state machine, one upload stalled every other client until it was
+finished, so the FILES_INFO latency was as long as the slowest upload.
+
+    python benchmarks/concurrent_uploads.py --uploads 10 --size 256
+"""
+import argparse
+import tempfile
+import threading
+import time
+
+from harness import DataType, connect, percentile, start_server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--uploads", type=int, default=10, help="number of concurrent uploads")
+    parser.add_argument("--size", type=int, default=256, help="size of each upload in MB")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as save_path:
+        server = start_server(save_path)
+        probe = connect(server, "probe")
+        uploaders = [connect(server, f"uploader{i}") for i in range(args.uploads)]
+
+        file_size = args.size * 1024 * 1024
+        threads = [
+            threading.Thread(target=uploader.upload, args=(f"upload{i}.bin", file_size))
+            for i, uploader in enumerate(uploaders)
+        ]
+
+        latencies = []
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        while any(thread.is_alive() for thread in threads):
+            sent = time.perf_counter()
+            probe.send(DataType.FILES_INFO)
+            # Uploads finishing trigger FILES_INFO broadcasts as well, any FILES_INFO answers the probe
+            while probe.receive()[0] != DataType.FILES_INFO:
+                pass
+            latencies.append(time.perf_counter() - sent)
+        elapsed = time.perf_counter() - start
+
+        total = args.uploads * file_size / (1024 * 1024)
+        print()
+        print(f"{args.uploads} uploads of {args.size} MB in {elapsed:.2f} s: {total / elapsed:.1f} MB/s aggregate")
+        print(f"{len(latencies)} FILES_INFO requests during the uploads")
+        print(f"latency p50 {percentile(latencies, 50) * 1000:.2f} ms, "
+              f"p99 {percentile(latencies, 99) * 1000:.2f} ms, max {max(latencies) * 1000:.2f} ms")
+
+        for client in uploaders + [probe]:
+            client.close()
+
+
+if __name__ == "__main__":
+    main()
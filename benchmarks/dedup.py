@@ -0,0 +1,93 @@
+"""
+Bytes sent over the network and stored on disk by a duplicate-heavy workload, with and without the deduplicating
+chunk store.
+
+Every user uploads the same installer, a second version of it differing by a few chunks, and a small file of their
+own. The clients go through a local proxy counting the bytes they send.
+
+    python benchmarks/dedup.py --users 10 --size 32
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from harness import DataType, DelayProxy, start_server
+import main as fdp
+from client import Client
+
+
+def disk_usage(*paths: str) -> int:
+    return sum(os.path.getsize(os.path.join(root, file_name))
+               for path in paths for root, _, file_names in os.walk(path) for file_name in file_names)
+
+
+def run(dedup: bool, files: list[list[str]], directory: str) -> tuple[int, int, float]:
+    """
+    Uploads the files of every user, returns the bytes sent, the bytes stored and the time it took
+    """
+
+    save_path = os.path.join(directory, f"server_files_{'dedup' if dedup else 'plain'}")
+    server = start_server(save_path, dedup=dedup)
+    proxy = DelayProxy(server.PORT, 0, window=16 * 1024 * 1024)
+    proxy_port = proxy.start()
+
+    expected = 0
+    start = time.perf_counter()
+    for user, user_files in enumerate(files):
+        client = Client()
+        client.PORT = proxy_port
+        client.connect_to_server(f"user{user}", "127.0.0.1")
+        for file_path in user_files:
+            client.send(DataType.UPLOAD_FILE, file_path)
+        expected += len(user_files)
+        while len(json.loads(server.get_server_files_info())) < expected:
+            time.sleep(0.01)
+        client.send(DataType.DISCONNECT)
+    elapsed = time.perf_counter() - start
+
+    return proxy.forwarded["up"], disk_usage(save_path, server.SERVER_STORE_PATH), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--size", type=int, default=32, help="installer size in MB")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        fdp.DEFAULT_CLIENT_TRANSFERS_PATH = os.path.join(directory, "client_transfers.json")
+
+        installer = os.urandom(args.size * 1024 * 1024)
+        # The second version only differs by a few bytes in 3 of its chunks
+        update = bytearray(installer)
+        for position in (0.1, 0.5, 0.9):
+            update[int(len(update) * position)] ^= 0xFF
+
+        files = []
+        for user in range(args.users):
+            user_directory = os.path.join(directory, f"user{user}")
+            os.makedirs(user_directory)
+            user_files = []
+            for file_name, data in (("installer.bin", installer), ("installer-v2.bin", update),
+                                    ("notes.txt", os.urandom(64 * 1024))):
+                file_path = os.path.join(user_directory, file_name)
+                with open(file_path, "wb") as file:
+                    file.write(data)
+                user_files.append(file_path)
+            files.append(user_files)
+        logical = sum(os.path.getsize(file_path) for user_files in files for file_path in user_files)
+
+        results = {dedup: run(dedup, files, directory) for dedup in (False, True)}
+
+    print()
+    print(f"{args.users} users, {logical / 1e6:.1f} MB of files uploaded")
+    print(f"{'store':>8} {'MB sent':>10} {'MB on disk':>11} {'seconds':>8}")
+    for dedup, (sent, stored, elapsed) in results.items():
+        print(f"{'dedup' if dedup else 'plain':>8} {sent / 1e6:>10.1f} {stored / 1e6:>11.1f} {elapsed:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""
+Requests the server can't serve, which it answers with a DEBUG message carrying their request id: downloading a
+file which doesn't exist, deleting one, and asking for the metrics of a server which has them disabled. Each one
+must resolve to None, and the client must still get the answers to the requests sent after them. Then files the
+client isn't waiting for (as when a download timed out), sent as they are, hashed and compressed: the client must
+throw them away and still get the answers to the requests sent after them. Last, logins which aren't UTF-8, data
+connections whose range request is malformed and a client sending a file name which isn't UTF-8: the server must
+close them and go on serving. Exits with an error otherwise.
+
+    python benchmarks/error_answers.py --engine both
+"""
+import argparse
+import os
+import socket
+import sys
+import tempfile
+from concurrent.futures import TimeoutError
+
+from harness import ENGINES, DataType, connect, start_server
+import main as fdp
+from client import Client
+from compression import codec_flags
+
+
+def check(engine: str, directory: str, save_path: str) -> list:
+    server = start_server(save_path, engine)
+    client = Client(hash_algorithm="")
+    client.PORT = server.PORT
+    client.REQUEST_TIMEOUT = 5
+    client.connect_to_server(f"errors-{engine}", "127.0.0.1")
+
+    requests = [
+        ("missing download", lambda: client.download_file("missing.txt", os.path.join(directory, "missing.txt"))),
+        ("unknown deletion", lambda: client.delete_file("missing.txt")),
+        ("STATS with metrics disabled", client.request_stats),
+    ]
+    checks = []
+    for name, request in requests:
+        try:
+            result = request().result(client.REQUEST_TIMEOUT)
+            checks.append((f"{engine} {name} answered None", result is None))
+        except TimeoutError:
+            checks.append((f"{engine} {name} answered None", False))
+        try:
+            page = client.query_files(0, 10).result(client.REQUEST_TIMEOUT)
+            checks.append((f"{engine} answered after {name}", page is not None))
+        except TimeoutError:
+            checks.append((f"{engine} answered after {name}", False))
+
+    # Sent without waiting for their answer, their request ids aren't pending
+    unrequested = [
+        ("unrequested file", DataType.DOWNLOAD_FILE, ["file.bin", "1000"], 0),
+        ("unrequested hashed file", DataType.DOWNLOAD_FROM, ["file.bin", "1001", "0", fdp.DEFAULT_HASH_ALGORITHM], 0),
+        ("unrequested compressed file", DataType.DOWNLOAD_FROM, ["file.bin", "1002", "0", ""],
+         codec_flags(client.COMPRESSION)),
+    ]
+    for name, data_type, fields, flags in unrequested:
+        client.send_message(client.framing.encode_message(data_type, [field.encode() for field in fields], flags,
+                                                          client.next_request_id()))
+        try:
+            page = client.query_files(0, 10).result(client.REQUEST_TIMEOUT)
+            checks.append((f"{engine} answered after {name}", page is not None))
+        except TimeoutError:
+            checks.append((f"{engine} answered after {name}", False))
+    written = set(os.listdir(directory)) - {"server_files", "client_transfers.json"}
+    checks.append((f"{engine} unrequested files not written", not written))
+
+    login = f"errors-{engine}".encode()
+    malformed = [
+        ("login which isn't UTF-8", DataType.LOGIN, [b"\xff" * 64]),
+        ("range with a size which isn't a number", DataType.DOWNLOAD_RANGE,
+         [login, b"t", b"file.bin", b"abc", b"0", b"1"]),
+        ("range with a login which isn't UTF-8", DataType.DOWNLOAD_RANGE,
+         [b"\xff\xfe", b"t", b"file.bin", b"1", b"0", b"1"]),
+    ]
+    for name, data_type, fields in malformed:
+        with socket.create_connection(("127.0.0.1", server.PORT), timeout=client.REQUEST_TIMEOUT) as sock:
+            sock.sendall(client.framing.encode_hello(data_type, fields))
+            try:
+                closed = sock.recv(1) == b""
+            except (TimeoutError, ConnectionError):
+                closed = False
+        checks.append((f"{engine} {name} closed", closed))
+        try:
+            page = client.query_files(0, 10).result(client.REQUEST_TIMEOUT)
+            checks.append((f"{engine} answered after {name}", page is not None))
+        except TimeoutError:
+            checks.append((f"{engine} answered after {name}", False))
+
+    raw = connect(server, f"raw-{engine}")
+    raw.sock.settimeout(client.REQUEST_TIMEOUT)
+    raw.send(DataType.DELETE_FILE, b"\xff\xfe")
+    try:
+        # What was sent to it since its login, until the connection is closed
+        while raw.sock.recv(65536):
+            pass
+        closed = True
+    except (TimeoutError, ConnectionError):
+        closed = False
+    raw.sock.close()
+    checks.append((f"{engine} client sending a file name which isn't UTF-8 closed", closed))
+    try:
+        page = client.query_files(0, 10).result(client.REQUEST_TIMEOUT)
+        checks.append((f"{engine} answered after a file name which isn't UTF-8", page is not None))
+    except TimeoutError:
+        checks.append((f"{engine} answered after a file name which isn't UTF-8", False))
+    client.send(DataType.DISCONNECT)
+    return checks
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--engine", choices=[*ENGINES, "both"], default="both")
+    args = parser.parse_args()
+
+    engines = list(ENGINES) if args.engine == "both" else [args.engine]
+    checks = []
+    with tempfile.TemporaryDirectory() as directory:
+        fdp.DEFAULT_CLIENT_TRANSFERS_PATH = os.path.join(directory, "client_transfers.json")
+        save_path = os.path.join(directory, "server_files")
+        os.makedirs(save_path)
+        with open(os.path.join(save_path, "file.bin"), "wb") as file:
+            # Compressible, in several chunks and blocks
+            file.write(os.urandom(64) * 32768)
+        for engine in engines:
+            checks += check(engine, directory, save_path)
+
+    print()
+    for name, passed in checks:
+        print(f"{name:<65} {'ok' if passed else 'FAILED'}")
+    if not all(passed for _, passed in checks):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""
+Time the GUI file list takes to apply file list changes (FileListModel.set_files), painting included, at several
+numbers of files. Runs offscreen.
+
+"snapshot" is the first full list, "delta" 100 changed, 10 added and 10 removed files, "resync" a full list again
+with 1% of the files changed, "remove half" every other file removed at once, and "scroll" a jump to the middle.
+
+The "widgets" rows time the first full list with the original approach of one widget per file, stock Qt widgets
+standing in for the FluentQt ones it used.
+
+    python benchmarks/file_list.py --counts 1000 10000 50000 --widgets 1000 10000
+"""
+import argparse
+import os
+import sys
+import time
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+# Only the model of the client is measured, the servers imported by harness aren't needed
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from qtpy.QtWidgets import (QApplication, QHBoxLayout, QLabel, QListView, QPushButton, QScrollArea,  # noqa: E402
+                            QSizePolicy, QVBoxLayout, QWidget)
+from ui.file_model import FileItemDelegate, FileListModel  # noqa: E402
+
+
+def snapshot(files: list[dict], version: int = 1) -> dict:
+    return {"version": version, "since": None, "files": files, "removed": []}
+
+
+def timed(app: QApplication, function) -> float:
+    """
+    Returns the milliseconds function() and painting its result take
+    """
+
+    start = time.perf_counter()
+    function()
+    app.processEvents()
+    return (time.perf_counter() - start) * 1000
+
+
+def measure_model(app: QApplication, count: int) -> dict:
+    files = [{"file_name": f"file{i:06}.bin", "file_size": i} for i in range(count)]
+    model = FileListModel()
+    view = QListView()
+    view.setModel(model)
+    view.setItemDelegate(FileItemDelegate(view))
+    view.setUniformItemSizes(True)
+    view.setLayoutMode(QListView.LayoutMode.Batched)
+    view.resize(600, 600)
+    view.show()
+    app.processEvents()
+
+    timings = {"snapshot": timed(app, lambda: model.set_files(snapshot(files)))}
+
+    changed = [{"file_name": file["file_name"], "file_size": file["file_size"] + 1} for file in files[::count // 100]]
+    added = [{"file_name": f"new{i}.bin", "file_size": i} for i in range(10)]
+    removed = [file["file_name"] for file in files[1::count // 10]]
+    delta = {"version": 2, "since": 1, "files": changed + added, "removed": removed}
+    timings["delta"] = timed(app, lambda: model.set_files(delta))
+
+    files = [file for file in files if file["file_name"] not in set(removed)] + added
+    resync = [dict(file, file_size=-1) if i % 100 == 0 else file for i, file in enumerate(files)]
+    timings["resync"] = timed(app, lambda: model.set_files(snapshot(resync, 3)))
+
+    half = {"version": 4, "since": 3, "files": [], "removed": [file["file_name"] for file in files[::2]]}
+    timings["remove half"] = timed(app, lambda: model.set_files(half))
+
+    timings["scroll"] = timed(app, lambda: view.verticalScrollBar().setValue(view.verticalScrollBar().maximum() // 2))
+    view.close()
+    return timings
+
+
+def measure_widgets(app: QApplication, count: int) -> float:
+    """
+    The original FileList, a widget per file added to a scrolled layout, adjusting its size after every file
+    """
+
+    scroll_area = QScrollArea()
+    scroll_area.setWidgetResizable(True)
+    content = QWidget(scroll_area)
+    content.setSizePolicy(QSizePolicy(QSizePolicy.Policy.Preferred, QSizePolicy.Policy.Fixed))
+    scroll_area.setWidget(content)
+    layout = QVBoxLayout(content)
+    scroll_area.resize(600, 600)
+    scroll_area.show()
+    app.processEvents()
+
+    def add_widgets():
+        for i in range(count):
+            row = QWidget(content)
+            row_layout = QHBoxLayout(row)
+            row_layout.addWidget(QLabel(f"file{i:06}.bin\n{i} bytes", row))
+            row_layout.addWidget(QPushButton("Delete", row))
+            row_layout.addWidget(QPushButton("Download", row))
+            layout.addWidget(row)
+            content.adjustSize()
+
+    elapsed = timed(app, add_widgets)
+    scroll_area.close()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--counts", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--widgets", type=int, nargs="*", default=[1000], help="counts to time the widgets with")
+    args = parser.parse_args()
+
+    app = QApplication([])
+    names = ["snapshot", "delta", "resync", "remove half", "scroll"]
+    print(f"{'files':>8} " + " ".join(f"{name + ' ms':>14}" for name in names))
+    for count in args.counts:
+        timings = measure_model(app, count)
+        print(f"{count:>8} " + " ".join(f"{timings[name]:>14.1f}" for name in names))
+    for count in args.widgets:
+        print(f"{count:>8} {measure_widgets(app, count):>14.1f}  (widgets)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Cost of telling clients about a change to a large list of server files: the whole list in FILES_INFO, as clients
+which don't keep a copy of it get, against the changed entries in FILES_DELTA.
+
+Every event is the upload of a small file by one of the clients, timed until all the clients have been told about
+it.
+
+    python benchmarks/files_delta.py --clients 200 --files 50000 --events 5
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from harness import ENGINES, DataType, connect, percentile, start_server
+
+
+def run(engine: str, save_path: str, clients: int, events: int, delta: bool) -> tuple[float, float, int]:
+    """
+    Returns the median and worst milliseconds until all the clients got an update, and its size in bytes
+    """
+
+    server = start_server(save_path, engine)
+    connections = [connect(server, f"{engine}{delta}{i}") for i in range(clients)]
+    if delta:
+        for connection in connections:
+            connection.send(DataType.FILES_DELTA, b"")
+            connection.receive()
+
+    latencies = []
+    size = 0
+    for event in range(events):
+        start = time.perf_counter()
+        connections[0].upload(f"{engine}{delta}{event}.bin", 1024)
+        for connection in connections:
+            data_type, data = connection.receive()
+            while data_type not in (DataType.FILES_INFO, DataType.FILES_DELTA):
+                data_type, data = connection.receive()
+            size = len(data)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    for connection in connections:
+        connection.close()
+    return percentile(latencies, 50), max(latencies), size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--engine", choices=[*ENGINES, "both"], default="both")
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--files", type=int, default=50000)
+    parser.add_argument("--events", type=int, default=5)
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for engine in ENGINES if args.engine == "both" else [args.engine]:
+            save_path = os.path.join(directory, engine)
+            os.makedirs(save_path)
+            for i in range(args.files):
+                with open(os.path.join(save_path, f"file{i:06}.bin"), "wb") as file:
+                    file.write(b"x" * (i % 4096))
+            for delta in (False, True):
+                results.append((engine, delta, *run(engine, save_path, args.clients, args.events, delta)))
+
+    print()
+    print(f"{args.clients} clients, {args.files} files")
+    print(f"{'engine':>10} {'message':>12} {'p50 ms':>8} {'max ms':>8} {'bytes':>10}")
+    for engine, delta, p50, worst, size in results:
+        message = "FILES_DELTA" if delta else "FILES_INFO"
+        print(f"{engine:>10} {message:>12} {p50:>8.1f} {worst:>8.1f} {size:>10}")
+
+
+if __name__ == "__main__":
+    main()
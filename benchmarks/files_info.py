@@ -0,0 +1,64 @@
+"""
+10k back-to-back FILES_INFO requests from one client, with the encoded list of the server files cached until the
+files change, against building and encoding it again for every request as the server used to.
+
+    python benchmarks/files_info.py --files 10000 --requests 10000
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from harness import ENGINES, DataType, connect, percentile, start_server
+
+
+def run(engine: str, save_path: str, requests: int, cached: bool) -> dict:
+    server = start_server(save_path, engine)
+    if not cached:
+        server.files_info_data = lambda: server.get_server_files_info().encode(server.FORMAT)
+    client = connect(server, f"{engine}-{cached}")
+
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(requests):
+        sent = time.perf_counter()
+        client.send(DataType.FILES_INFO)
+        while client.receive()[0] != DataType.FILES_INFO:
+            pass
+        latencies.append(time.perf_counter() - sent)
+    elapsed = time.perf_counter() - start
+    client.close()
+
+    return {
+        "engine": engine,
+        "cached": cached,
+        "rate": requests / elapsed,
+        "p50": percentile(latencies, 50) * 1000,
+        "p99": percentile(latencies, 99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--engine", choices=[*ENGINES, "both"], default="both")
+    parser.add_argument("--files", type=int, default=10000)
+    parser.add_argument("--requests", type=int, default=10000)
+    args = parser.parse_args()
+
+    engines = list(ENGINES) if args.engine == "both" else [args.engine]
+    with tempfile.TemporaryDirectory() as save_path:
+        for i in range(args.files):
+            with open(os.path.join(save_path, f"file{i:06}.bin"), "wb") as file:
+                file.write(b"x" * (i % 4096))
+        results = [run(engine, save_path, args.requests, cached) for engine in engines for cached in (False, True)]
+
+    print()
+    print(f"{args.requests} FILES_INFO requests, {args.files} files")
+    print(f"{'engine':<10} {'list':<8} {'requests/s':>11} {'p50 ms':>8} {'p99 ms':>8}")
+    for result in results:
+        print(f"{result['engine']:<10} {'cached' if result['cached'] else 'built':<8} {result['rate']:>11.0f} "
+              f"{result['p50']:>8.3f} {result['p99']:>8.3f}")
+
+
+if __name__ == "__main__":
+    main()
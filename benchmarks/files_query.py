@@ -0,0 +1,69 @@
+"""
+Latency of getting the first page of the server files with FILES_QUERY, against the full dump of FILES_INFO, at
+100k files. Timed from the request until the client has parsed the answer.
+
+The first query sorting on a key sorts the index, which is then kept sorted: "first ms" is that query, "p50 ms"
+the median of the following ones.
+
+    python benchmarks/files_query.py --files 100000 --repeats 20
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from harness import ENGINES, DataType, connect, percentile, start_server
+from tools import FILES_PAGE_SIZE
+
+QUERIES = [
+    ("first page by name", ("0", str(FILES_PAGE_SIZE), "", "name")),
+    ("largest files", ("0", str(FILES_PAGE_SIZE), "", "-size")),
+    ("name prefix", ("0", str(FILES_PAGE_SIZE), "file05", "name")),
+    ("glob", ("0", str(FILES_PAGE_SIZE), "*7.bin", "name")),
+    ("last page by mtime", ("99900", str(FILES_PAGE_SIZE), "", "mtime")),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--engine", choices=ENGINES, default="selectors")
+    parser.add_argument("--files", type=int, default=100000)
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as save_path:
+        for i in range(args.files):
+            with open(os.path.join(save_path, f"file{i:06}.bin"), "wb") as file:
+                file.write(b"x" * (i % 4096))
+        server = start_server(save_path, args.engine)
+        client = connect(server, "query")
+
+        def request(data_type: int, *fields: str) -> int:
+            client.send(data_type, *(field.encode() for field in fields))
+            answer_type, data = client.receive()
+            while answer_type != data_type:
+                answer_type, data = client.receive()
+            json.loads(data)
+            return len(data)
+
+        results = []
+        for name, data_type, fields in [("full dump", DataType.FILES_INFO, ()),
+                                        *((name, DataType.FILES_QUERY, fields) for name, fields in QUERIES)]:
+            timings = []
+            for _ in range(args.repeats + 1):
+                start = time.perf_counter()
+                size = request(data_type, *fields)
+                timings.append((time.perf_counter() - start) * 1000)
+            results.append((name, timings[0], percentile(timings[1:], 50), size))
+        client.close()
+
+    print()
+    print(f"{args.files} files, {args.engine} server")
+    print(f"{'request':>20} {'first ms':>9} {'p50 ms':>8} {'bytes':>10}")
+    for name, first, p50, size in results:
+        print(f"{name:>20} {first:>9.1f} {p50:>8.1f} {size:>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Messages per second for small DEBUG and COMMAND messages, with the original framing (one ASCII digit and
+64-byte padded lengths, sent part by part like the old Client.send) and with the binary framing.
+
+    python benchmarks/framing.py --messages 100000
+"""
+import argparse
+import contextlib
+import os
+import tempfile
+import time
+
+from harness import DataType, connect, start_server
+
+
+def send_parts(client, data_type: int, field: bytes):
+    """
+    Sends a message like the original Client.send did, one send per part
+    """
+
+    client.sock.sendall(str(data_type).encode())
+    client.sock.sendall(client.framing.encode_length(len(field)))
+    client.sock.sendall(field)
+
+
+def run(server, name: str, binary: bool, parts: bool, messages: int, payload: bytes):
+    client = connect(server, name, binary)
+    message_size = len(client.framing.encode_message(DataType.COMMAND, [payload]))
+
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for i in range(messages):
+            data_type = DataType.DEBUG if i % 2 else DataType.COMMAND
+            if parts:
+                send_parts(client, data_type, payload)
+            else:
+                client.send(data_type, payload)
+        # The answer to FILES_INFO comes once the server has handled every message before it
+        client.send(DataType.FILES_INFO)
+        client.receive()
+    elapsed = time.perf_counter() - start
+
+    client.close()
+    return messages / elapsed, message_size - len(payload)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--payload", type=int, default=16, help="size of each message payload in bytes")
+    args = parser.parse_args()
+
+    payload = b"x" * args.payload
+    with tempfile.TemporaryDirectory() as save_path:
+        server = start_server(save_path)
+        results = [
+            ("legacy, one send per part", run(server, "parts", False, True, args.messages, payload)),
+            ("legacy, single send", run(server, "legacy", False, False, args.messages, payload)),
+            ("binary", run(server, "binary", True, False, args.messages, payload)),
+        ]
+
+    print()
+    print(f"{args.messages} DEBUG/COMMAND messages with a {args.payload} byte payload")
+    print(f"{'framing':<28} {'messages/s':>12} {'header bytes':>14}")
+    for name, (rate, header_size) in results:
+        print(f"{name:<28} {rate:>12.0f} {header_size:>14}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+Checks that connections which never log in don't degrade service for real clients: opens N half-open connections
+(some sending nothing, some stopping in the middle of their login), then exits with an error if a client's login
+and FILES_INFO latencies are much worse than without them, if the server uses CPU while they sit idle, or if they
+aren't closed once the login timeout has passed.
+
+This is a script exiting with an error, like the other checks under benchmarks/, the repository has no test suite
+running it.
+
+    python benchmarks/half_open.py --connections 1000 --engine selectors
+"""
+import argparse
+import socket
+import sys
+import tempfile
+import time
+
+from harness import ENGINES, DataType, connect, percentile, start_server
+from tools import FRAME_MAGIC
+
+# What the half-open connections send before going quiet: nothing, the start of a binary login, the start of a
+# login of an old client
+PARTIAL_LOGINS = [b"", FRAME_MAGIC + b"\x02", b"half"]
+
+
+def measure(server, login: str, requests: int) -> dict:
+    """
+    Logs a client in and times its FILES_INFO requests, in milliseconds
+    """
+
+    start = time.perf_counter()
+    client = connect(server, login)
+    login_time = time.perf_counter() - start
+
+    latencies = []
+    for _ in range(requests):
+        sent = time.perf_counter()
+        client.send(DataType.FILES_INFO)
+        while client.receive()[0] != DataType.FILES_INFO:
+            pass
+        latencies.append(time.perf_counter() - sent)
+    client.close()
+    return {"login": login_time * 1000, "p50": percentile(latencies, 50) * 1000,
+            "p99": percentile(latencies, 99) * 1000}
+
+
+def closed(sock: socket.socket, deadline: float) -> bool:
+    """
+    Whether the server closes a connection by the deadline
+    """
+
+    sock.settimeout(max(deadline - time.monotonic(), 0))
+    try:
+        return sock.recv(1) == b""
+    except ConnectionError:
+        return True
+    except socket.timeout:
+        return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--connections", type=int, default=1000, help="half-open connections")
+    parser.add_argument("--engine", choices=ENGINES, default="selectors")
+    parser.add_argument("--requests", type=int, default=200, help="FILES_INFO requests of the client")
+    parser.add_argument("--login-timeout", type=float, default=5, help="login timeout of the server in seconds")
+    parser.add_argument("--max-cpu", type=float, default=0.05, help="share of a CPU the idle server may use")
+    args = parser.parse_args()
+
+    checks = []
+
+    def check(name: str, value: float, limit: float):
+        checks.append((name, value, limit, value <= limit))
+
+    with tempfile.TemporaryDirectory() as save_path:
+        server = start_server(save_path, args.engine)
+        server.LOGIN_TIMEOUT = args.login_timeout
+        baseline = measure(server, "baseline", args.requests)
+
+        start = time.monotonic()
+        half_open = []
+        for i in range(args.connections):
+            sock = socket.create_connection((server.SERVER_IP, server.PORT))
+            sock.sendall(PARTIAL_LOGINS[i % len(PARTIAL_LOGINS)])
+            half_open.append(sock)
+        opened = time.monotonic() - start
+        # Measured once the server has accepted them all, what matters is them sitting there
+        time.sleep(0.5)
+
+        loaded = measure(server, "client", args.requests)
+        # Allow some noise on latencies of a fraction of a millisecond
+        for key in ("login", "p50", "p99"):
+            check(f"{key} ms", loaded[key], max(baseline[key] * 3, baseline[key] + 5))
+
+        # Nothing is running in this process but the server, idle with its half-open connections
+        idle_start, cpu_start = time.perf_counter(), time.process_time()
+        time.sleep(1)
+        cpu = (time.process_time() - cpu_start) / (time.perf_counter() - idle_start)
+        check("idle CPU share", cpu, args.max_cpu)
+
+        deadline = start + opened + args.login_timeout + 1
+        still_open = sum(not closed(sock, deadline) for sock in half_open)
+        check("not closed after the login timeout", still_open, 0)
+        for sock in half_open:
+            sock.close()
+
+    print()
+    print(f"{args.engine} server, {args.connections} half-open connections, {args.requests} FILES_INFO requests")
+    print(f"{'':>34} {'baseline':>9}")
+    for key in ("login", "p50", "p99"):
+        print(f"{key + ' ms':>34} {baseline[key]:>9.3f}")
+    print(f"{'check':>34} {'measured':>9} {'limit':>9}")
+    for name, value, limit, passed in checks:
+        print(f"{name:>34} {value:>9.3f} {limit:>9.3f} {'ok' if passed else 'FAILED'}")
+    if not all(passed for *_, passed in checks):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
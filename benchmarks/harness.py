@@ -0,0 +1,213 @@
+"""
+Helpers shared by the benchmark scripts: run a server on the loopback interface and talk to it with raw
+sockets, so the numbers measure the server and not the Qt client
+"""
+import asyncio
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+from async_server import AsyncServer  # noqa: E402
+from server import Server  # noqa: E402
+from tools import (BinaryFraming, DataType, Framing, receive_data, receive_field, receive_header,  # noqa: E402
+                   send_data)
+
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+ENGINES = {
+    "selectors": Server,
+    "asyncio": AsyncServer,
+}
+
+
+def start_server(save_path: str, engine: str = "selectors", **kwargs) -> Server:
+    """
+    Starts a server on 127.0.0.1 in a daemon thread, storing its files in save_path, and its partial uploads and
+    chunk store next to it
+    """
+
+    server = ENGINES[engine](**kwargs)
+    server.SERVER_IP = "127.0.0.1"
+    server.PORT = free_port()
+    server.SERVER_FILES_SAVE_PATH = save_path
+    server.SERVER_PARTIAL_PATH = save_path + "_partial"
+    server.SERVER_STORE_PATH = save_path + "_store"
+    threading.Thread(target=server.start, daemon=True).start()
+
+    # Wait until it listens, it first has to index its files
+    while True:
+        try:
+            socket.create_connection((server.SERVER_IP, server.PORT)).close()
+            return server
+        except ConnectionRefusedError:
+            time.sleep(0.01)
+
+
+class RawClient:
+    """
+    Minimal client speaking the wire protocol with a blocking socket, with either framing
+    """
+
+    def __init__(self, sock: socket.socket, framing: Framing):
+        self.sock = sock
+        self.framing = framing
+
+    def send(self, data_type: int, *fields: bytes):
+        self.sock.sendall(self.framing.encode_message(data_type, fields))
+
+    def receive(self) -> tuple[int, bytes]:
+        """
+        Receives a server message made of a data type and a single length-prefixed field
+        """
+
+        data_type, length = receive_header(self.sock, self.framing)
+        return data_type, receive_field(self.sock, self.framing, length)
+
+    def upload(self, file_name: str, file_size: int, block_size: int = 1048576):
+        """
+        Uploads file_size bytes of generated data as file_name
+        """
+
+        self.send(DataType.UPLOAD_FILE, file_name.encode(main.DEFAULT_FORMAT))
+        self.sock.sendall(self.framing.encode_length(file_size))
+        block = memoryview(b"\0" * block_size)
+        remaining = file_size
+        while remaining:
+            size = min(remaining, block_size)
+            self.sock.sendall(block[:size])
+            remaining -= size
+
+    def close(self):
+        self.sock.close()
+
+
+def connect(server: Server, login: str, binary: bool = True, timeout: float = 5) -> RawClient:
+    """
+    Opens a connection to the server and logs in, retrying until the server is listening
+    """
+
+    deadline = time.monotonic() + timeout
+    while True:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.connect((server.SERVER_IP, server.PORT))
+            break
+        except ConnectionRefusedError:
+            sock.close()
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+    if binary:
+        hello = BinaryFraming()
+        sock.sendall(hello.encode_hello(DataType.LOGIN, [login.encode(main.DEFAULT_FORMAT)]))
+        # The answer has the version 1 header, with the version both sides speak from now on
+        _, version, _, _, length = BinaryFraming.HEADER.unpack(receive_data(sock, BinaryFraming.HEADER.size))
+        result = receive_field(sock, hello, length)
+        framing = BinaryFraming(version)
+    else:
+        framing = Framing(main.DEFAULT_HEADERDATALEN, main.DEFAULT_FORMAT)
+        send_data(sock, login.encode(main.DEFAULT_FORMAT), 64)
+        result = receive_data(sock, 1)
+    if result != b"1":
+        raise ConnectionError(f"Login {login} refused")
+    return RawClient(sock, framing)
+
+
+class DelayProxy:
+    """
+    TCP proxy emulating a link with latency, and optionally a bandwidth limit, in front of a server.
+
+    Each direction of a connection holds at most `window` bytes in flight, like a TCP window, so a single
+    connection can't go faster than window / delay however fast the link is.
+    """
+
+    def __init__(self, target_port: int, delay: float, window: int = 262144, rate: float = None):
+        self.target_port = target_port
+        self.delay = delay
+        self.window = window
+        # Bytes per second shared by all connections in each direction, None for no limit
+        self.rate = rate
+        self.link_free = {"up": 0.0, "down": 0.0}
+        # Bytes forwarded in each direction
+        self.forwarded = {"up": 0, "down": 0}
+        self.port = None
+
+    def start(self) -> int:
+        """
+        Starts the proxy in a daemon thread, returns the port it listens on
+        """
+
+        ready = threading.Event()
+
+        async def serve():
+            server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+            self.port = server.sockets[0].getsockname()[1]
+            ready.set()
+            async with server:
+                await server.serve_forever()
+
+        threading.Thread(target=asyncio.run, args=(serve(),), daemon=True).start()
+        ready.wait()
+        return self.port
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        target_reader, target_writer = await asyncio.open_connection("127.0.0.1", self.target_port)
+        await asyncio.gather(self.pipe(reader, target_writer, "up"), self.pipe(target_reader, writer, "down"),
+                             return_exceptions=True)
+        writer.close()
+        target_writer.close()
+
+    async def pipe(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, direction: str):
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        space = asyncio.Condition()
+        in_flight = 0
+
+        async def deliver():
+            nonlocal in_flight
+            while True:
+                due, data = await queue.get()
+                await asyncio.sleep(max(0.0, due - loop.time()))
+                if not data:
+                    writer.write_eof()
+                    return
+                writer.write(data)
+                await writer.drain()
+                async with space:
+                    in_flight -= len(data)
+                    space.notify()
+
+        delivery = asyncio.create_task(deliver())
+        try:
+            while True:
+                async with space:
+                    await space.wait_for(lambda: in_flight < self.window)
+                data = await reader.read(self.window - in_flight)
+                in_flight += len(data)
+                self.forwarded[direction] += len(data)
+
+                due = loop.time()
+                if self.rate:
+                    due = max(due, self.link_free[direction]) + len(data) / self.rate
+                    self.link_free[direction] = due
+                await queue.put((due + self.delay, data))
+                if not data:
+                    break
+        finally:
+            await delivery
+
+
+def percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
@@ -0,0 +1,98 @@
+"""
+Upload and download throughput of large files with and without the streaming integrity check, to measure what
+hashing the data in flight costs.
+
+On loopback nothing but the CPU limits a transfer and hashing shows at its full cost. Pass --rate to go through a
+local proxy limiting the bandwidth like a real link, where hashing overlaps with the data waiting in the socket
+buffers.
+
+    python benchmarks/integrity.py --size 256 --algorithms none blake2b sha256 --rate 100
+"""
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+from PySide6.QtCore import Qt
+
+from harness import DataType, DelayProxy, start_server
+import main as fdp
+from client import Client
+
+
+def run(port: int, algorithm: str, file_path: str, directory: str) -> tuple[float, float]:
+    client = Client(hash_algorithm="" if algorithm == "none" else algorithm)
+    client.PORT = port
+    file_name = os.path.basename(file_path)
+    file_size = os.path.getsize(file_path)
+
+    uploaded = threading.Event()
+
+    def files_info_received(delta: dict):
+        if any(file["file_name"] == file_name and file["file_size"] == file_size for file in delta["files"]):
+            uploaded.set()
+
+    client.files_info_received.connect(files_info_received, Qt.ConnectionType.DirectConnection)
+    client.connect_to_server(f"integrity{algorithm}", "127.0.0.1")
+
+    start = time.perf_counter()
+    client.send(DataType.UPLOAD_FILE, file_path)
+    uploaded.wait()
+    upload_time = time.perf_counter() - start
+
+    downloaded_path = os.path.join(directory, f"downloaded-{algorithm}.bin")
+    start = time.perf_counter()
+    client.download_file(file_name, downloaded_path).result()
+    download_time = time.perf_counter() - start
+    if os.path.getsize(downloaded_path) != file_size:
+        raise RuntimeError(f"Download with {algorithm} failed")
+    os.remove(downloaded_path)
+
+    client.send(DataType.DELETE_FILE, file_name)
+    client.send(DataType.DISCONNECT)
+    return upload_time, download_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=256, help="file size in MB")
+    parser.add_argument("--algorithms", nargs="+", default=["none", "blake2b", "sha256"])
+    parser.add_argument("--rate", type=float, default=0, help="link bandwidth in MB/s, 0 for plain loopback")
+    parser.add_argument("--runs", type=int, default=3, help="runs per algorithm, the best one is kept")
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        # The client keeps track of its transfers in the working directory
+        os.chdir(directory)
+        fdp.DEFAULT_CLIENT_TRANSFERS_PATH = os.path.join(directory, "client_transfers.json")
+        server = start_server(os.path.join(directory, "server_files"))
+        port = server.PORT
+        if args.rate:
+            port = DelayProxy(server.PORT, 0, window=16 * 1024 * 1024, rate=args.rate * 1024 * 1024).start()
+
+        file_path = os.path.join(directory, "integrity.bin")
+        with open(file_path, "wb") as file:
+            for _ in range(args.size):
+                file.write(os.urandom(1024 * 1024))
+
+        for _ in range(args.runs):
+            for algorithm in args.algorithms:
+                upload_time, download_time = run(port, algorithm, file_path, directory)
+                best = results.get(algorithm, (upload_time, download_time))
+                results[algorithm] = (min(best[0], upload_time), min(best[1], download_time))
+
+    print()
+    print(f"{args.size} MB file, " + (f"{args.rate} MB/s link" if args.rate else "loopback"))
+    print(f"{'hash':>8} {'upload MB/s':>12} {'overhead':>9} {'download MB/s':>14} {'overhead':>9}")
+    base = results.get("none")
+    for algorithm, (upload_time, download_time) in results.items():
+        upload_overhead = f"{(upload_time / base[0] - 1) * 100:.1f}%" if base else "-"
+        download_overhead = f"{(download_time / base[1] - 1) * 100:.1f}%" if base else "-"
+        print(f"{algorithm:>8} {args.size / upload_time:>12.1f} {upload_overhead:>9} "
+              f"{args.size / download_time:>14.1f} {download_overhead:>9}")
+
+
+if __name__ == "__main__":
+    main()
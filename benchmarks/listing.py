@@ -0,0 +1,80 @@
+"""
+Latency of listing the server files (building the FILES_INFO message) from the in-memory index, against the
+original os.listdir() and os.path.getsize() of every file, at several directory sizes.
+
+"upload" is the work done when a file is added: updating the index and listing the files again. "rescan" is the
+periodic reconciliation with the directory, done every few minutes.
+
+    python benchmarks/listing.py --counts 1000 10000 100000
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from harness import percentile
+from server import Server
+
+
+def legacy_files_info(path: str) -> str:
+    """
+    The original get_server_files_info
+    """
+
+    files_info = []
+    for file_name in os.listdir(path):
+        files_info.append({
+            "file_name": file_name,
+            "file_size": os.path.getsize(os.path.join(path, file_name))
+        })
+    return json.dumps(files_info)
+
+
+def measure(function, repeats: int) -> float:
+    """
+    Returns the median milliseconds function() takes
+    """
+
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        timings.append((time.perf_counter() - start) * 1000)
+    return percentile(timings, 50)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--counts", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'files':>8} {'listdir ms':>11} {'index ms':>9} {'upload ms':>10} {'rescan ms':>10}")
+    with tempfile.TemporaryDirectory() as directory:
+        for count in args.counts:
+            server = Server()
+            server.SERVER_FILES_SAVE_PATH = os.path.join(directory, f"server_files_{count}")
+            server.SERVER_PARTIAL_PATH = os.path.join(directory, f"server_partial_{count}")
+            os.makedirs(server.SERVER_FILES_SAVE_PATH)
+            for i in range(count):
+                with open(os.path.join(server.SERVER_FILES_SAVE_PATH, f"file{i:06}.bin"), "wb") as file:
+                    file.write(b"x" * (i % 4096))
+            server.open_storage()
+
+            def upload():
+                with open(os.path.join(server.SERVER_FILES_SAVE_PATH, "upload.bin"), "wb") as file:
+                    file.write(b"x")
+                server.index.refresh("upload.bin")
+                server.get_server_files_info()
+
+            legacy = measure(lambda: legacy_files_info(server.SERVER_FILES_SAVE_PATH), args.repeats)
+            indexed = measure(server.get_server_files_info, args.repeats)
+            uploaded = measure(upload, args.repeats)
+            rescanned = measure(server.index.rescan, args.repeats)
+            print(f"{count:>8} {legacy:>11.1f} {indexed:>9.1f} {uploaded:>10.1f} {rescanned:>10.1f}")
+            server.index.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Load test of both server engines: opens N idle simulated clients, then runs a few hot uploads while one more
+client measures the latency of FILES_INFO requests.
+
+    python benchmarks/load_test.py --clients 2000 --hot 4 --size 128
+"""
+import argparse
+import tempfile
+import threading
+import time
+
+from harness import ENGINES, DataType, connect, percentile, start_server
+
+
+def run(engine: str, clients: int, hot: int, size: int, requests: int):
+    with tempfile.TemporaryDirectory() as save_path:
+        server = start_server(save_path, engine)
+
+        start = time.perf_counter()
+        idle = [connect(server, f"idle{i}") for i in range(clients)]
+        connect_time = time.perf_counter() - start
+
+        probe = connect(server, "probe")
+        uploaders = [connect(server, f"hot{i}") for i in range(hot)]
+        file_size = size * 1024 * 1024
+        threads = [
+            threading.Thread(target=uploader.upload, args=(f"hot{i}.bin", file_size))
+            for i, uploader in enumerate(uploaders)
+        ]
+
+        latencies = []
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        while len(latencies) < requests or any(thread.is_alive() for thread in threads):
+            sent = time.perf_counter()
+            probe.send(DataType.FILES_INFO)
+            while probe.receive()[0] != DataType.FILES_INFO:
+                pass
+            latencies.append(time.perf_counter() - sent)
+        elapsed = time.perf_counter() - start
+
+        for client in idle + uploaders + [probe]:
+            client.close()
+
+    return {
+        "engine": engine,
+        "connect_rate": clients / connect_time,
+        "throughput": hot * size / elapsed,
+        "p50": percentile(latencies, 50) * 1000,
+        "p99": percentile(latencies, 99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--engine", choices=[*ENGINES, "both"], default="both")
+    parser.add_argument("--clients", type=int, default=1000, help="number of idle clients")
+    parser.add_argument("--hot", type=int, default=4, help="number of concurrent uploads")
+    parser.add_argument("--size", type=int, default=128, help="size of each upload in MB")
+    parser.add_argument("--requests", type=int, default=200, help="minimum number of FILES_INFO requests")
+    args = parser.parse_args()
+
+    engines = list(ENGINES) if args.engine == "both" else [args.engine]
+    results = [run(engine, args.clients, args.hot, args.size, args.requests) for engine in engines]
+
+    print()
+    print(f"{args.clients} idle clients, {args.hot} uploads of {args.size} MB")
+    print(f"{'engine':<10} {'logins/s':>10} {'MB/s':>10} {'p50 ms':>10} {'p99 ms':>10}")
+    for result in results:
+        print(f"{result['engine']:<10} {result['connect_rate']:>10.0f} {result['throughput']:>10.1f} "
+              f"{result['p50']:>10.2f} {result['p99']:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Cost of logging on the server: a burst of FILES_INFO requests (each one logging a DEBUG record) with the logging at
+DEBUG, written from the listener thread to a file of JSON lines and to /dev/null, then at INFO. Exits with an error
+if a DEBUG record was created at INFO, or if a JSON line can't be parsed.
+
+    python benchmarks/logging_overhead.py --requests 10000
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+from harness import ENGINES, DataType, connect, start_server
+from log import get_logger, setup_logging, stop_logging
+
+# Records created, per level
+created = {}
+
+
+def counting_factory(factory):
+    def create(*args, **kwargs):
+        record = factory(*args, **kwargs)
+        created[record.levelname] = created.get(record.levelname, 0) + 1
+        return record
+    return create
+
+
+def run(engine: str, save_path: str, requests: int, level: str, json_path: str) -> dict:
+    with open(os.devnull, "w") as devnull:
+        setup_logging(level, json_path, devnull)
+        created.clear()
+        server = start_server(save_path, engine)
+        client = connect(server, f"{engine}-{level}")
+
+        start = time.perf_counter()
+        for _ in range(requests):
+            client.send(DataType.FILES_INFO)
+            while client.receive()[0] != DataType.FILES_INFO:
+                pass
+        rate = requests / (time.perf_counter() - start)
+        client.send(DataType.DISCONNECT)
+        client.close()
+        time.sleep(0.1)
+        stop_logging()
+    return {"rate": rate, "debug": created.get("DEBUG", 0), "records": sum(created.values())}
+
+
+def call_cost(calls: int) -> float:
+    """
+    Nanoseconds per logger.debug() call with an argument, at INFO
+    """
+
+    logger = get_logger("benchmark")
+    with open(os.devnull, "w") as devnull:
+        setup_logging("INFO", stream=devnull)
+        start = time.perf_counter()
+        for i in range(calls):
+            logger.debug("Sending chunk %d", i)
+        elapsed = time.perf_counter() - start
+        stop_logging()
+    return elapsed / calls * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--engine", choices=[*ENGINES, "both"], default="both")
+    parser.add_argument("--requests", type=int, default=10000)
+    parser.add_argument("--calls", type=int, default=1000000, help="logger.debug() calls timed at INFO")
+    args = parser.parse_args()
+
+    logging.setLogRecordFactory(counting_factory(logging.getLogRecordFactory()))
+    engines = list(ENGINES) if args.engine == "both" else [args.engine]
+    results, checks = [], []
+    with tempfile.TemporaryDirectory() as directory:
+        save_path = os.path.join(directory, "server_files")
+        os.makedirs(save_path)
+        for i in range(10):
+            with open(os.path.join(save_path, f"file{i}.bin"), "wb") as file:
+                file.write(b"x" * 1024)
+        for engine in engines:
+            for level, json_path in (("DEBUG", os.path.join(directory, f"{engine}.jsonl")), ("DEBUG", None),
+                                     ("INFO", None)):
+                result = run(engine, save_path, args.requests, level, json_path)
+                results.append((engine, level, "json lines" if json_path else "/dev/null", result))
+                if level == "INFO":
+                    checks.append((f"{engine} DEBUG records created at INFO", result["debug"] == 0))
+                if json_path:
+                    with open(json_path) as file:
+                        lines = [json.loads(line) for line in file]
+                    checks.append((f"{engine} JSON lines parsed", len(lines) == result["records"]))
+    cost = call_cost(args.calls)
+
+    print()
+    print(f"{args.requests} FILES_INFO requests")
+    print(f"{'engine':<10} {'level':<6} {'output':<11} {'requests/s':>11} {'records':>8} {'DEBUG':>7}")
+    for engine, level, output, result in results:
+        print(f"{engine:<10} {level:<6} {output:<11} {result['rate']:>11.0f} {result['records']:>8} "
+              f"{result['debug']:>7}")
+    print(f"logger.debug() at INFO: {cost:.0f} ns per call")
+    for name, passed in checks:
+        print(f"{name:<40} {'ok' if passed else 'FAILED'}")
+    if not all(passed for _, passed in checks):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
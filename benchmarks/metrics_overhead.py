@@ -0,0 +1,97 @@
+"""
+Cost of the metrics of the server: FILES_INFO requests per second (a small message handled per request) and upload
+throughput with the metrics disabled and enabled, the best of a few alternating rounds. With them enabled, checks
+that the STATS answer and the Prometheus endpoint count the requests and bytes received.
+
+    python benchmarks/metrics_overhead.py --requests 20000 --upload-mb 256 --rounds 3
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import urllib.request
+
+from harness import ENGINES, DataType, connect, free_port, start_server
+
+
+def run(engine: str, save_path: str, requests: int, upload_size: int, enabled: bool) -> dict:
+    port = free_port() if enabled else None
+    server = start_server(save_path, engine, metrics_port=port)
+    client = connect(server, f"{engine}-{enabled}")
+
+    start = time.perf_counter()
+    for _ in range(requests):
+        client.send(DataType.FILES_INFO)
+        while client.receive()[0] != DataType.FILES_INFO:
+            pass
+    rate = requests / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    client.upload("upload.bin", upload_size)
+    # Uploaded once the list of the server files with it in it comes back
+    while client.receive()[0] != DataType.FILES_INFO:
+        pass
+    throughput = upload_size / (time.perf_counter() - start) / 1024 / 1024
+
+    checks = []
+    if enabled:
+        client.send(DataType.STATS)
+        data_type, data = client.receive()
+        stats = json.loads(data) if data_type == DataType.STATS else {}
+        samples = {name: metric["samples"] for name, metric in stats.items()}
+        messages = {sample["labels"]["type"]: sample["value"]
+                    for sample in samples.get("fdp_server_messages_total", [])}
+        received = sum(sample["value"] for sample in samples.get("fdp_server_received_bytes_total", []))
+        checks.append(("FILES_INFO counted in STATS", messages.get("FILES_INFO") == requests))
+        checks.append(("upload counted in STATS", received >= upload_size))
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics") as response:
+            text = response.read().decode()
+        checks.append(("FILES_INFO counted at /metrics",
+                       f'fdp_server_messages_total{{type="FILES_INFO"}} {requests}' in text))
+    client.send(DataType.DISCONNECT)
+    client.close()
+    os.remove(os.path.join(save_path, "upload.bin"))
+    return {"rate": rate, "throughput": throughput, "checks": checks}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--engine", choices=[*ENGINES, "both"], default="both")
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--upload-mb", type=int, default=256)
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    engines = list(ENGINES) if args.engine == "both" else [args.engine]
+    results, checks = {}, []
+    with tempfile.TemporaryDirectory() as save_path:
+        for i in range(10):
+            with open(os.path.join(save_path, f"file{i}.bin"), "wb") as file:
+                file.write(b"x" * 1024)
+        for engine in engines:
+            for _ in range(args.rounds):
+                for enabled in (False, True):
+                    result = run(engine, save_path, args.requests, args.upload_mb * 1024 * 1024, enabled)
+                    best = results.setdefault((engine, enabled), {"rate": 0, "throughput": 0})
+                    best["rate"] = max(best["rate"], result["rate"])
+                    best["throughput"] = max(best["throughput"], result["throughput"])
+                    checks += [(engine, *check) for check in result["checks"]]
+
+    print()
+    print(f"{args.requests} FILES_INFO requests, {args.upload_mb} MB upload, best of {args.rounds} rounds")
+    print(f"{'engine':<10} {'metrics':<9} {'requests/s':>11} {'overhead':>9} {'upload MB/s':>12} {'overhead':>9}")
+    for (engine, enabled), result in results.items():
+        disabled = results[engine, False]
+        print(f"{engine:<10} {'enabled' if enabled else 'disabled':<9} {result['rate']:>11.0f} "
+              f"{(1 - result['rate'] / disabled['rate']) * 100:>8.1f}% {result['throughput']:>12.0f} "
+              f"{(1 - result['throughput'] / disabled['throughput']) * 100:>8.1f}%")
+    for engine, name, passed in sorted(set(checks)):
+        print(f"{engine:<10} {name:<32} {'ok' if passed else 'FAILED'}")
+    if not all(passed for *_, passed in checks):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
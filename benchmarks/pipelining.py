@@ -0,0 +1,100 @@
+"""
+Small requests sent one after the other, each waiting for the answer to the one before, against the same requests
+pipelined: all sent at once, the answers being matched to them by their request id as they come.
+
+The server is reached through a local proxy adding --delay ms each way, as a sequential client pays a whole round
+trip per request.
+
+    python benchmarks/pipelining.py --requests 1000 --delay 1 --kinds query delete download
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from harness import DataType, DelayProxy, start_server
+import main as fdp
+from client import Client
+
+
+def connect(port: int, login: str) -> Client:
+    client = Client(hash_algorithm="")
+    client.PORT = port
+    client.connect_to_server(login, "127.0.0.1")
+    return client
+
+
+def requests(client: Client, kind: str, count: int, run: str, directory: str) -> list:
+    """
+    Returns functions each sending a request and returning the Future of its answer
+    """
+
+    match kind:
+        case "query":
+            return [lambda i=i: client.query_files(i, 10) for i in range(count)]
+        case "delete":
+            return [lambda i=i: client.delete_file(f"{run}{i}.txt") for i in range(count)]
+        case "download":
+            return [lambda i=i: client.download_file("small.txt", os.path.join(directory, f"{run}{i}.txt"))
+                    for i in range(count)]
+
+
+def sequential(client: Client, calls: list) -> float:
+    start = time.perf_counter()
+    for call in calls:
+        if not call().result():
+            raise RuntimeError("Request failed")
+    return time.perf_counter() - start
+
+
+def pipelined(client: Client, calls: list) -> float:
+    start = time.perf_counter()
+    futures = [call() for call in calls]
+    if not all(future.result() for future in futures):
+        raise RuntimeError("Request failed")
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--delay", type=float, default=1, help="delay added each way in ms")
+    parser.add_argument("--kinds", nargs="+", default=["query", "delete", "download"])
+    parser.add_argument("--engine", default="selectors", choices=["selectors", "asyncio"])
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        # The client keeps track of its downloads in the working directory
+        os.chdir(directory)
+        fdp.DEFAULT_CLIENT_TRANSFERS_PATH = os.path.join(directory, "client_transfers.json")
+        save_path = os.path.join(directory, "server_files")
+        os.makedirs(save_path)
+        for run in ("sequential", "pipelined"):
+            for i in range(args.requests):
+                with open(os.path.join(save_path, f"{run}{i}.txt"), "w") as file:
+                    file.write("x")
+        with open(os.path.join(save_path, "small.txt"), "wb") as file:
+            file.write(os.urandom(1024))
+
+        server = start_server(save_path, args.engine)
+        port = DelayProxy(server.PORT, args.delay / 1000).start()
+        client = connect(port, "pipelining")
+        downloads = os.path.join(directory, "downloads")
+        os.makedirs(downloads)
+
+        for kind in args.kinds:
+            results[kind] = (sequential(client, requests(client, kind, args.requests, "sequential", downloads)),
+                             pipelined(client, requests(client, kind, args.requests, "pipelined", downloads)))
+        client.send(DataType.DISCONNECT)
+
+    print()
+    print(f"{args.requests} requests, {args.delay:g} ms each way, {args.engine} server")
+    print(f"{'request':>10} {'sequential ms':>14} {'pipelined ms':>13} {'speedup':>8}")
+    for kind, (sequential_time, pipelined_time) in results.items():
+        print(f"{kind:>10} {sequential_time * 1000:>14.1f} {pipelined_time * 1000:>13.1f} "
+              f"{sequential_time / pipelined_time:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+"""
+CPU time per GB of a file sent with send_file() and received with receive_file() over a loopback connection, with
+each progress reporter on both sides: none, NullReporter, TqdmReporter and SignalReporter (see progress.py), and a
+tqdm bar updated on every chunk like the transfers used to. The file is sent from Python (with a hash algorithm) and
+with sendfile(), and the bars are written to /dev/null. The best of a few alternating rounds is kept.
+The progress is a small part of the work done per chunk, so the time each reporter adds per chunk is measured on its
+own too, in a loop updating it like send_file() does. Also checks that a client uploads and downloads a file
+outside of a job with each reporter as its PROGRESS.
+
+    python benchmarks/progress_reporters.py --size-mb 256 --chunk-size 1024 --rounds 3
+"""
+import argparse
+import contextlib
+import hashlib
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+from qtpy.QtCore import QObject, Qt, Signal
+from tqdm import tqdm
+
+from harness import BinaryFraming, DataType, start_server
+import main as fdp
+from client import Client
+from progress import NullReporter, ProgressReporter, SignalReporter, TqdmReporter
+from tools import receive_file, send_file
+
+
+class Progress(QObject):
+    # Bytes transferred, bytes to transfer
+    changed = Signal(object, object)
+
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+        self.changed.connect(self.count, Qt.ConnectionType.DirectConnection)
+
+    def count(self, done, total):
+        self.calls += 1
+
+
+class ChunkTqdm(ProgressReporter):
+    """
+    tqdm bar updated on every chunk, as send_file() and receive_file() did before the reporters
+    """
+
+    def __init__(self, description: str):
+        super().__init__()
+        self.bar = tqdm(desc=description, unit="B", unit_scale=True)
+
+    def update(self, done: int, total: int) -> None:
+        self.bar.total = total
+        self.bar.update(done - self.bar.n)
+
+    def close(self) -> None:
+        self.bar.close()
+
+
+def reporters(name: str, signals: list):
+    match name:
+        case "none":
+            return None, None
+        case "null":
+            return NullReporter("Sending file"), NullReporter("Receiving file")
+        case "tqdm":
+            return TqdmReporter("Sending file"), TqdmReporter("Receiving file")
+        case "signal":
+            signals[:] = [Progress(), Progress()]
+            return SignalReporter(signals[0].changed), SignalReporter(signals[1].changed)
+        case "tqdm per chunk":
+            return ChunkTqdm("Sending file"), ChunkTqdm("Receiving file")
+
+
+def run(file_path: str, directory: str, chunk_size: int, name: str, hashed: bool) -> dict:
+    framing = BinaryFraming()
+    signals = []
+    with socket.create_server(("127.0.0.1", 0)) as listener:
+        sender = socket.create_connection(listener.getsockname())
+        receiver, _ = listener.accept()
+    send_progress, receive_progress = reporters(name, signals)
+    digest = hashlib.blake2b() if hashed else None
+
+    def send():
+        send_file(sender, file_path, framing, chunk_size, digest=digest, progress=send_progress)
+        # The FILE_DIGEST trailer isn't read, only the file is timed
+        sender.shutdown(socket.SHUT_WR)
+
+    started, wall_started = time.process_time(), time.perf_counter()
+    thread = threading.Thread(target=send)
+    thread.start()
+    completed = receive_file(receiver, framing, chunk_size, os.path.join(directory, "received.bin"), 0,
+                             progress=receive_progress)
+    thread.join()
+    cpu, wall = time.process_time() - started, time.perf_counter() - wall_started
+    sender.close()
+    receiver.close()
+    os.remove(os.path.join(directory, "received.bin"))
+    return {"cpu": cpu, "wall": wall, "completed": completed, "signals": [signal.calls for signal in signals]}
+
+
+def update_cost(name: str, calls: int, rounds: int) -> float:
+    """
+    Nanoseconds per chunk spent on the progress by the reporter sending the file, in a loop updating it like
+    send_file() does with the progress growing by 1 KiB per chunk. The best of rounds.
+    """
+
+    best = None
+    for _ in range(rounds):
+        # The objects of the signals have to outlive the reporters
+        signals = []
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stderr(devnull):
+            reporter = reporters(name, signals)[0]
+            start = time.perf_counter()
+            for i in range(calls):
+                if reporter is not None:
+                    reporter.update(i * 1024, calls * 1024)
+            elapsed = time.perf_counter() - start
+            if reporter is not None:
+                reporter.close()
+        best = elapsed if best is None else min(best, elapsed)
+    return best / calls * 1e9
+
+
+def client_transfers(directory: str, file_path: str, reporter) -> bool:
+    """
+    Uploads the file and downloads it back with a client whose transfers aren't run by jobs, creating their
+    reporters with reporter, returns whether both completed
+    """
+
+    server = start_server(os.path.join(directory, f"server_files_{reporter.__name__}"))
+    client = Client(progress=reporter)
+    client.PORT = server.PORT
+    client.connect_to_server(f"progress-{reporter.__name__}", "127.0.0.1")
+    uploaded = client.upload_file(file_path)
+    download_path = os.path.join(directory, f"download_{reporter.__name__}.bin")
+    downloaded = client.download_file(os.path.basename(file_path), download_path).result(client.REQUEST_TIMEOUT)
+    client.send(DataType.DISCONNECT)
+    return bool(uploaded and downloaded and os.path.getsize(download_path) == os.path.getsize(file_path))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mb", type=int, default=256)
+    parser.add_argument("--chunk-size", type=int, default=1024)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--calls", type=int, default=1000000, help="update() calls timed per reporter")
+    args = parser.parse_args()
+
+    names = ["none", "null", "tqdm", "signal", "tqdm per chunk"]
+    size = args.size_mb * 1024 * 1024
+    results, checks = {}, []
+    with tempfile.TemporaryDirectory() as directory:
+        file_path = os.path.join(directory, "file.bin")
+        with open(file_path, "wb") as file:
+            file.write(os.urandom(size))
+        for _ in range(args.rounds):
+            for hashed in (True, False):
+                for name in names:
+                    with open(os.devnull, "w") as devnull, contextlib.redirect_stderr(devnull):
+                        result = run(file_path, directory, args.chunk_size, name, hashed)
+                    if (hashed, name) not in results or result["cpu"] < results[hashed, name]["cpu"]:
+                        results[hashed, name] = result
+                    sent = "hashed" if hashed else "sendfile"
+                    checks.append((f"{name} {sent} file received", result["completed"]))
+                    if result["signals"]:
+                        # Once every INTERVAL seconds at most, plus the last progress
+                        limit = result["wall"] / ProgressReporter.INTERVAL + 2
+                        checks.append((f"signal {sent} rate limited",
+                                       all(calls <= limit for calls in result["signals"])))
+        fdp.DEFAULT_CLIENT_TRANSFERS_PATH = os.path.join(directory, "client_transfers.json")
+        for reporter in (NullReporter, TqdmReporter):
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stderr(devnull):
+                checks.append((f"client transfers with {reporter.__name__}",
+                               client_transfers(directory, file_path, reporter)))
+
+    print()
+    print(f"{args.size_mb} MB file in chunks of {args.chunk_size} bytes, best of {args.rounds} rounds")
+    # Without a reporter, the cost of the loop
+    loop = update_cost("none", args.calls, args.rounds)
+    costs = {name: update_cost(name, args.calls, args.rounds) - loop for name in names if name != "none"}
+    print(f"{'sent':<9} {'reporter':<15} {'CPU s/GB':>9} {'overhead':>9} {'signals':>8}")
+    for (hashed, name), result in results.items():
+        baseline = results[hashed, "none"]["cpu"]
+        signals = "/".join(str(calls) for calls in result["signals"]) or "-"
+        print(f"{'hashed' if hashed else 'sendfile':<9} {name:<15} {result['cpu'] / size * 1024 ** 3:>9.2f} "
+              f"{(result['cpu'] / baseline - 1) * 100:>8.1f}% {signals:>8}")
+    # Updates per GB on each side, the sender's and the receiver's
+    updates = 1024 ** 3 / args.chunk_size * 2
+    print(f"{'reporter':<15} {'ns/chunk':>10} {'CPU s/GB':>9}")
+    for name, cost in costs.items():
+        print(f"{name:<15} {cost:>10.0f} {cost * updates / 1e9:>9.3f}")
+    for name, passed in sorted(set(checks)):
+        print(f"{name:<40} {'ok' if passed else 'FAILED'}")
+    if not all(passed for _, passed in checks):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
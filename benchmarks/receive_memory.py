@@ -0,0 +1,131 @@
+"""
+Memory allocated while receiving, measured with tracemalloc, and receive throughput over loopback.
+
+receive_file and the server's upload path receive into one reused buffer, so their peak allocation stays
+the same whatever the file size. receive_data used to grow its result with data += packet, which copies
+the whole message for every packet received.
+
+    python benchmarks/receive_memory.py --sizes 16 256 1024 --message 32
+"""
+import argparse
+import contextlib
+import os
+import socket
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from harness import BinaryFraming, connect, receive_data, start_server
+from tools import receive_file
+
+BLOCK = memoryview(b"\0" * 1048576)
+
+
+def send_blocks(sock: socket.socket, size: int, header: bytes = b""):
+    sock.sendall(header)
+    remaining = size
+    while remaining:
+        sent = min(remaining, len(BLOCK))
+        sock.sendall(BLOCK[:sent])
+        remaining -= sent
+
+
+def legacy_receive_data(sock: socket.socket, data_len: int):
+    """
+    The original receive_data
+    """
+
+    data = b""
+    while len(data) < data_len:
+        packet = sock.recv(data_len - len(data))
+        if not packet:
+            return None
+        data += packet
+    return data
+
+
+def measure(receive, size: int, header: bytes = b"", traced: bool = False) -> tuple[float, int]:
+    """
+    Runs receive(sock) while another thread sends it header followed by size bytes, returns the elapsed time
+    and the peak memory allocated meanwhile
+    """
+
+    with socket.create_server(("127.0.0.1", 0)) as listener:
+        sender = socket.create_connection(listener.getsockname())
+        receiver, _ = listener.accept()
+        thread = threading.Thread(target=send_blocks, args=(sender, size, header))
+
+        if traced:
+            tracemalloc.start()
+        start = time.perf_counter()
+        thread.start()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull), \
+                contextlib.redirect_stderr(devnull):
+            receive(receiver)
+        elapsed = time.perf_counter() - start
+        thread.join()
+        peak = 0
+        if traced:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+        sender.close()
+        receiver.close()
+    return elapsed, peak
+
+
+def measure_upload(size: int) -> int:
+    """
+    Peak memory allocated by the server (and the uploading thread) while it receives an upload
+    """
+
+    with tempfile.TemporaryDirectory() as save_path:
+        server = start_server(save_path)
+        client = connect(server, "uploader")
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            tracemalloc.start()
+            client.upload("upload.bin", size)
+            # The broadcast following the upload means the server has written all of it
+            client.receive()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        client.close()
+    return peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[16, 256, 1024], help="file sizes in MB")
+    parser.add_argument("--message", type=int, default=32, help="size of the single message in MB")
+    parser.add_argument("--chunk-size", type=int, default=65536)
+    args = parser.parse_args()
+
+    framing = BinaryFraming()
+    print(f"{'file MB':>8} {'receive_file peak KiB':>22} {'MB/s':>8} {'server upload peak KiB':>23}")
+    with tempfile.TemporaryDirectory() as directory:
+        file_path = os.path.join(directory, "received.bin")
+        for size in args.sizes:
+            file_size = size * 1024 * 1024
+
+            def receive(sock):
+                receive_file(sock, framing, args.chunk_size, file_path)
+                os.remove(file_path)
+
+            header = framing.encode_length(file_size)
+            _, peak = measure(receive, file_size, header, traced=True)
+            elapsed, _ = measure(receive, file_size, header)
+            upload_peak = measure_upload(file_size)
+            print(f"{size:>8} {peak / 1024:>22.0f} {size / elapsed:>8.1f} {upload_peak / 1024:>23.0f}")
+
+    message_size = args.message * 1024 * 1024
+    print()
+    print(f"receiving a single {args.message} MB message")
+    print(f"{'':<14} {'seconds':>8} {'peak MiB':>9}")
+    for name, receive in (("data += packet", legacy_receive_data), ("recv_into", receive_data)):
+        elapsed, peak = measure(lambda sock: receive(sock, message_size), message_size, traced=True)
+        print(f"{name:<14} {elapsed:>8.3f} {peak / 1048576:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
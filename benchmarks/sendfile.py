@@ -0,0 +1,92 @@
+"""
+Loopback throughput of tools.send_file (zero-copy socket.sendfile) against the original loop sending the
+file in 1 KiB chunks read and sent from Python.
+
+The test files are sparse, so the numbers measure the sending path and not the disk.
+
+    python benchmarks/sendfile.py --sizes 1 100 2048 --chunk-size 65536
+"""
+import argparse
+import contextlib
+import os
+import socket
+import tempfile
+import threading
+import time
+
+from harness import BinaryFraming, send_data
+from main import DEFAULT_FILE_CHUNK_SIZE
+from tools import send_file
+
+
+def legacy_send_file(sock: socket.socket, file_path: str, framing, chunk_size: int = 1024):
+    """
+    The original send_file loop, without its progress bar
+    """
+
+    file_size = os.path.getsize(file_path)
+    sock.sendall(framing.encode_length(file_size))
+    chunks = file_size // chunk_size
+    remaining_data = file_size % chunk_size
+    with open(file_path, "rb") as file:
+        for chunk in range(chunks + 1):
+            size = chunk_size if chunk < chunks else remaining_data
+            file_data = file.read(size)
+            if not file_data:
+                break
+            send_data(sock, file_data, size)
+
+
+def drain(sock: socket.socket, total: int):
+    buffer = bytearray(1048576)
+    received = 0
+    while received < total:
+        size = sock.recv_into(buffer)
+        if not size:
+            break
+        received += size
+
+
+def measure(send, file_path: str, file_size: int) -> float:
+    framing = BinaryFraming()
+    with socket.create_server(("127.0.0.1", 0)) as listener:
+        sender = socket.create_connection(listener.getsockname())
+        receiver, _ = listener.accept()
+        thread = threading.Thread(target=drain, args=(receiver, file_size + framing.length_size))
+        thread.start()
+
+        start = time.perf_counter()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull), \
+                contextlib.redirect_stderr(devnull):
+            send(sender, file_path, framing)
+        thread.join()
+        elapsed = time.perf_counter() - start
+
+        sender.close()
+        receiver.close()
+    return file_size / elapsed / (1024 * 1024)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 100, 2048], help="file sizes in MB")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_FILE_CHUNK_SIZE)
+    args = parser.parse_args()
+
+    print(f"{'size MB':>8} {'1 KiB loop MB/s':>16} {'sendfile MB/s':>14}")
+    with tempfile.TemporaryDirectory() as directory:
+        for size in args.sizes:
+            file_path = os.path.join(directory, f"{size}.bin")
+            file_size = size * 1024 * 1024
+            with open(file_path, "wb") as file:
+                file.truncate(file_size)
+
+            legacy = measure(legacy_send_file, file_path, file_size)
+            zero_copy = measure(lambda sock, path, framing: send_file(sock, path, framing, args.chunk_size),
+                                file_path, file_size)
+            print(f"{size:>8} {legacy:>16.1f} {zero_copy:>14.1f}")
+            os.remove(file_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+Checks that a client which stops reading doesn't affect the others: while one client uploads small files, each
+upload broadcasting the whole list of the server files, other clients time how long each change takes to reach
+them, first alone, then with a client which never reads what it is sent. Exits with an error if the changes reach
+the others much later with it, if more than the high-water mark (and the message which crossed it) is queued for
+it, or if it doesn't get the latest list once it reads again.
+
+This is a script exiting with an error, like the other checks under benchmarks/, the repository has no test suite
+running it.
+
+    python benchmarks/slow_consumer.py --files 2000 --uploads 200 --clients 4
+"""
+import argparse
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+from harness import ENGINES, DataType, connect, percentile, start_server
+
+
+def wait_for_file(client, file_name: str, deadline: float) -> int:
+    """
+    Reads the messages of a client until a list of the server files has file_name in it, returns its size
+    """
+
+    client.sock.settimeout(max(deadline - time.monotonic(), 0))
+    while True:
+        data_type, data = client.receive()
+        if data_type == DataType.FILES_INFO and file_name.encode() in data:
+            return len(data)
+
+
+def run_uploads(server, phase: str, clients: int, uploads: int) -> tuple[list[float], int]:
+    """
+    Uploads files one at a time, returns how long each took to reach the slowest of the other clients, and the
+    size of the lists sent
+    """
+
+    uploader = connect(server, f"{phase}-uploader")
+    readers = [connect(server, f"{phase}-reader{i}") for i in range(clients)]
+    latencies, size = [], 0
+    for i in range(uploads):
+        file_name = f"{phase}-{i}.bin"
+        start = time.perf_counter()
+        uploader.upload(file_name, 16)
+        deadline = time.monotonic() + 10
+        arrived = [0.0] * clients
+
+        def read(j):
+            wait_for_file(readers[j], file_name, deadline)
+            arrived[j] = time.perf_counter()
+
+        threads = [threading.Thread(target=read, args=(j,)) for j in range(clients)]
+        for thread in threads:
+            thread.start()
+        size = wait_for_file(uploader, file_name, deadline)
+        for thread in threads:
+            thread.join()
+        latencies.append(max(arrived) - start)
+
+    for client in [uploader] + readers:
+        client.send(DataType.DISCONNECT)
+        client.close()
+    return latencies, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--engine", choices=ENGINES, default="selectors")
+    parser.add_argument("--files", type=int, default=2000, help="server files, the lists sent grow with them")
+    parser.add_argument("--uploads", type=int, default=200)
+    parser.add_argument("--clients", type=int, default=4, help="clients reading the changes")
+    args = parser.parse_args()
+
+    checks = []
+
+    def check(name: str, value: float, limit: float):
+        checks.append((name, value, limit, value <= limit))
+
+    with tempfile.TemporaryDirectory() as save_path:
+        for i in range(args.files):
+            with open(os.path.join(save_path, f"file{i:06}.bin"), "wb") as file:
+                file.write(b"x" * (i % 4096))
+        server = start_server(save_path, args.engine)
+
+        baseline, size = run_uploads(server, "baseline", args.clients, args.uploads)
+
+        # Logged in, then reads nothing: the lists sent to it fill up the socket buffers, then its queue
+        slow = connect(server, "slow")
+        loaded, size = run_uploads(server, "loaded", args.clients, args.uploads)
+
+        for key, p in (("p50", 50), ("p99", 99)):
+            expected = percentile(baseline, p) * 1000
+            check(f"change reaching the others {key} ms", percentile(loaded, p) * 1000,
+                  max(expected * 3, expected + 5))
+        check("bytes queued for the slow client", server.CLIENTS["slow"].queued, server.HIGH_WATER_MARK + size)
+
+        # Reading again, it gets the list with the last upload in it
+        start = time.perf_counter()
+        try:
+            wait_for_file(slow, f"loaded-{args.uploads - 1}.bin", time.monotonic() + 30)
+            caught_up = time.perf_counter() - start
+        except socket.timeout:
+            caught_up = float("inf")
+        check("slow client catching up, s", caught_up, 10)
+        slow.close()
+
+    print()
+    print(f"{args.engine} server, {args.files} files ({size} bytes lists), {args.uploads} uploads, "
+          f"{args.clients} clients reading")
+    print(f"{'check':>40} {'measured':>10} {'limit':>10}")
+    for name, value, limit, passed in checks:
+        print(f"{name:>40} {value:>10.3f} {limit:>10.3f} {'ok' if passed else 'FAILED'}")
+    if not all(passed for *_, passed in checks):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Upload and download throughput over a link with latency, with a file split over 1, 4 and 8 data connections.
+
+The server is reached through a local proxy delaying every byte and limiting each connection to a TCP-like
+window, so a single connection is capped at window / delay like on a long distance link.
+
+    python benchmarks/striped_transfer.py --size 64 --delay 20 --window 256
+"""
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+from PySide6.QtCore import Qt
+
+from harness import DelayProxy, DataType, start_server
+from client import Client
+
+
+def run(server, proxy_port: int, streams: int, file_path: str, directory: str) -> tuple[float, float]:
+    client = Client(streams=streams)
+    client.PORT = proxy_port
+    file_name = os.path.basename(file_path)
+    file_size = os.path.getsize(file_path)
+
+    uploaded = threading.Event()
+
+    def files_info_received(delta: dict):
+        if any(file["file_name"] == file_name and file["file_size"] == file_size for file in delta["files"]):
+            uploaded.set()
+
+    client.files_info_received.connect(files_info_received, Qt.ConnectionType.DirectConnection)
+    client.connect_to_server(f"streams{streams}", "127.0.0.1")
+
+    start = time.perf_counter()
+    client.send(DataType.UPLOAD_FILE, file_path)
+    uploaded.wait()
+    upload_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    client.download_file(file_name, os.path.join(directory, f"downloaded{streams}.bin")).result()
+    download_time = time.perf_counter() - start
+
+    client.send(DataType.DELETE_FILE, file_name)
+    client.send(DataType.DISCONNECT)
+    return upload_time, download_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=64, help="file size in MB")
+    parser.add_argument("--delay", type=float, default=20, help="one way latency in ms")
+    parser.add_argument("--window", type=int, default=256, help="bytes in flight per connection in KiB")
+    parser.add_argument("--streams", type=int, nargs="+", default=[1, 4, 8])
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        server = start_server(os.path.join(directory, "server_files"))
+        proxy = DelayProxy(server.PORT, args.delay / 1000, args.window * 1024)
+        proxy_port = proxy.start()
+
+        file_path = os.path.join(directory, "striped.bin")
+        with open(file_path, "wb") as file:
+            file.write(os.urandom(args.size * 1024 * 1024))
+
+        for streams in args.streams:
+            results.append((streams, *run(server, proxy_port, streams, file_path, directory)))
+
+    print()
+    print(f"{args.size} MB file, {args.delay} ms latency, {args.window} KiB window per connection")
+    print(f"{'streams':>8} {'upload MB/s':>12} {'download MB/s':>14}")
+    for streams, upload_time, download_time in results:
+        print(f"{streams:>8} {args.size / upload_time:>12.1f} {args.size / download_time:>14.1f}")
+
+
+if __name__ == "__main__":
+    main()
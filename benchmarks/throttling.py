@@ -0,0 +1,135 @@
+"""
+Checks the rate limits of the server and how it shares them between downloads: exits with an error if a limit
+isn't held within --tolerance, if clients downloading at once don't get the same share of the server's limit, or if
+a small file downloaded during a large download doesn't finish about as fast as its fair share allows.
+
+A bucket starts full, so the first BURST_TIME seconds of its rate go out at once. The rates are measured on what
+follows that burst, the long-run rate the limits hold, which small files would otherwise overstate.
+
+This is a script exiting with an error, like the other checks under benchmarks/, the repository has no test suite
+running it.
+
+    python benchmarks/throttling.py --rate 8 --size 32 --clients 4
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from harness import DataType, start_server
+import main as fdp
+from client import Client
+from throttle import BURST_TIME
+
+
+def connect(server, login: str) -> Client:
+    # Clients in the same process keep track of their downloads in files of their own
+    fdp.DEFAULT_CLIENT_TRANSFERS_PATH = f"{login}_transfers.json"
+    client = Client(hash_algorithm="", compression=[])
+    client.PORT = server.PORT
+    client.connect_to_server(login, "127.0.0.1")
+    return client
+
+
+def download(client: Client, file_name: str, file_path: str) -> float:
+    """
+    Downloads a file to file_path, returns how long it took
+    """
+
+    start = time.perf_counter()
+    if not client.download_file(file_name, file_path).result():
+        raise RuntimeError(f"Download of {file_name} failed")
+    return time.perf_counter() - start
+
+
+def downloads_at_once(server, file_names: list[str], directory: str, delays: list[float] = None) -> list[float]:
+    """
+    Downloads files at the same time, each from its own client after its delay, returns how long each took
+    """
+
+    clients = [connect(server, f"client{i}") for i in range(len(file_names))]
+    times = [0.0] * len(file_names)
+
+    def run(i):
+        time.sleep(delays[i] if delays else 0)
+        times[i] = download(clients[i], file_names[i], os.path.join(directory, f"{i}-{file_names[i]}"))
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(len(file_names))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for client in clients:
+        client.send(DataType.DISCONNECT)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rate", type=float, default=8, help="limit in MB/s")
+    parser.add_argument("--size", type=int, default=32, help="size of the large files in MB")
+    parser.add_argument("--small", type=int, default=1, help="size of the small file in MB")
+    parser.add_argument("--clients", type=int, default=4, help="clients downloading at once")
+    parser.add_argument("--tolerance", type=float, default=0.05)
+    parser.add_argument("--engine", default="selectors", choices=["selectors", "asyncio"])
+    args = parser.parse_args()
+
+    rate = args.rate * 1024 * 1024
+    size = args.size * 1024 * 1024
+    # Sent at once by a full bucket
+    burst = rate * BURST_TIME
+    checks = []
+
+    def check(name: str, value: float, expected: float, passed: bool):
+        checks.append((name, value, expected, passed))
+
+    with tempfile.TemporaryDirectory() as directory:
+        # The clients keep track of their downloads in the working directory
+        os.chdir(directory)
+        save_path = os.path.join(directory, "server_files")
+        os.makedirs(save_path)
+        for i in range(args.clients):
+            with open(os.path.join(save_path, f"large{i}.bin"), "wb") as file:
+                for _ in range(args.size):
+                    file.write(os.urandom(1024 * 1024))
+        with open(os.path.join(save_path, "small.bin"), "wb") as file:
+            file.write(os.urandom(args.small * 1024 * 1024))
+        downloads = os.path.join(directory, "downloads")
+        os.makedirs(downloads)
+
+        # Each limit on its own, with one download
+        for option in ("max_rate", "client_rate", "transfer_rate"):
+            server = start_server(save_path, args.engine, **{option: rate})
+            elapsed = downloads_at_once(server, ["large0.bin"], downloads)[0]
+            achieved = (size - burst) / elapsed / 1024 / 1024
+            check(f"{option} MB/s", achieved, args.rate, abs(achieved - args.rate) <= args.rate * args.tolerance)
+
+        # Several clients against the limit of the server: the same share each, and the limit all together
+        server = start_server(save_path, args.engine, max_rate=rate)
+        times = downloads_at_once(server, [f"large{i}.bin" for i in range(args.clients)], downloads)
+        rates = [size / elapsed for elapsed in times]
+        fairness = sum(rates) ** 2 / (len(rates) * sum(rate ** 2 for rate in rates))
+        check(f"{args.clients} clients, fairness index", fairness, 1.0, fairness >= 1 - args.tolerance)
+        total = (size * args.clients - burst) / max(times) / 1024 / 1024
+        check(f"{args.clients} clients, total MB/s", total, args.rate,
+              abs(total - args.rate) <= args.rate * args.tolerance)
+
+        # A small file started during a large download gets half of the limit
+        server = start_server(save_path, args.engine, max_rate=rate)
+        small_time = downloads_at_once(server, ["large0.bin", "small.bin"], downloads, [0, 1])[1]
+        fair_time = args.small * 2 / args.rate
+        check("small file during a large one, s", small_time, fair_time, small_time <= fair_time * 1.5)
+
+    print()
+    print(f"{args.engine} server, {args.rate:g} MB/s limit, {args.size} MB files")
+    print(f"{'check':>38} {'measured':>9} {'expected':>9}")
+    for name, value, expected, passed in checks:
+        print(f"{name:>38} {value:>9.3f} {expected:>9.3f} {'ok' if passed else 'FAILED'}")
+    if not all(passed for *_, passed in checks):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+"""
+Dropping many files on the client: how long queuing them takes, how many uploads the transfer manager runs at
+once and how long they all take, against sending them one after the other like the GUI did before.
+
+Also measures the round trip of a small request while a large upload is in progress, with the upload sent in
+segments and in one piece.
+
+    python benchmarks/transfer_manager.py --files 500 --size 64 --workers 2
+"""
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+from qtpy.QtCore import Qt
+
+from harness import DataType, start_server
+import main as fdp
+from client import Client, TransferManager
+from tools import LOGIN_UPLOAD_SEGMENTS
+
+
+def connect(server, login: str) -> Client:
+    client = Client()
+    client.PORT = server.PORT
+    client.connect_to_server(login, "127.0.0.1")
+    return client
+
+
+def wait_files(server, count: int) -> None:
+    while len(server.index.files) < count:
+        time.sleep(0.01)
+
+
+def synchronous(file_paths: list[str], directory: str) -> float:
+    """
+    Uploads the files one after the other from the calling thread, returns how long it was blocked
+    """
+
+    server = start_server(os.path.join(directory, "server_files_sync"))
+    client = connect(server, "sync")
+    start = time.perf_counter()
+    for file_path in file_paths:
+        client.send(DataType.UPLOAD_FILE, file_path)
+    elapsed = time.perf_counter() - start
+    wait_files(server, len(file_paths))
+    client.send(DataType.DISCONNECT)
+    return elapsed
+
+
+def managed(file_paths: list[str], directory: str, workers: int) -> tuple[float, float, int]:
+    """
+    Queues the files in a transfer manager, returns how long queuing them took, how long until they were all
+    uploaded and the largest number of uploads running at once
+    """
+
+    server = start_server(os.path.join(directory, "server_files_managed"))
+    client = connect(server, "managed")
+    manager = TransferManager(client, workers)
+
+    running = set()
+    most_running = 0
+    finished = threading.Semaphore(0)
+    lock = threading.Lock()
+
+    def state_changed(job_id: int, state: str):
+        nonlocal most_running
+        with lock:
+            if state == "running":
+                running.add(job_id)
+                most_running = max(most_running, len(running))
+            else:
+                running.discard(job_id)
+        if state in ("done", "failed"):
+            finished.release()
+
+    manager.job_state_changed.connect(state_changed, Qt.ConnectionType.DirectConnection)
+
+    start = time.perf_counter()
+    for file_path in file_paths:
+        manager.upload(file_path)
+    queued = time.perf_counter() - start
+    for _ in file_paths:
+        finished.acquire()
+    wait_files(server, len(file_paths))
+    elapsed = time.perf_counter() - start
+
+    manager.shutdown()
+    client.send(DataType.DISCONNECT)
+    return queued, elapsed, most_running
+
+
+def request_latency(file_path: str, directory: str, segment_size: int) -> float:
+    """
+    Returns the longest round trip of a TRANSFER_OFFSET request while a large file was uploaded in segments of
+    segment_size bytes, 0 to send it in one piece
+    """
+
+    server = start_server(os.path.join(directory, f"server_files_segments_{segment_size}"))
+    client = connect(server, "probe")
+    if segment_size:
+        client.UPLOAD_SEGMENT_SIZE = segment_size
+    else:
+        client.server_features &= ~LOGIN_UPLOAD_SEGMENTS
+    manager = TransferManager(client, 1)
+    manager.upload(file_path)
+    while not any(job.state == "running" for job in manager.jobs.values()):
+        time.sleep(0.001)
+
+    longest = 0
+    while any(job.state in ("queued", "running") for job in manager.jobs.values()):
+        start = time.perf_counter()
+        client.query_offset("probe")
+        longest = max(longest, time.perf_counter() - start)
+        time.sleep(0.01)
+
+    client.send(DataType.DISCONNECT)
+    return longest
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=500)
+    parser.add_argument("--size", type=int, default=64, help="size of each file in KB")
+    parser.add_argument("--workers", type=int, default=2, help="uploads the manager runs at once")
+    parser.add_argument("--large", type=int, default=256, help="size of the large upload in MB")
+    parser.add_argument("--segment", type=float, default=fdp.DEFAULT_UPLOAD_SEGMENT_SIZE / (1024 * 1024),
+                        help="size of the upload segments in MB")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        fdp.DEFAULT_CLIENT_TRANSFERS_PATH = os.path.join(directory, "client_transfers.json")
+        file_paths = []
+        for i in range(args.files):
+            file_path = os.path.join(directory, f"file{i}.bin")
+            with open(file_path, "wb") as file:
+                file.write(os.urandom(args.size * 1024))
+            file_paths.append(file_path)
+        large_path = os.path.join(directory, "large.bin")
+        with open(large_path, "wb") as file:
+            for _ in range(args.large):
+                file.write(os.urandom(1024 * 1024))
+
+        blocked = synchronous(file_paths, directory)
+        queued, elapsed, most_running = managed(file_paths, directory, args.workers)
+        whole_latency = request_latency(large_path, directory, 0)
+        segments_latency = request_latency(large_path, directory, int(args.segment * 1024 * 1024))
+
+    print()
+    print(f"{args.files} files of {args.size} KB")
+    print(f"sent one after the other: caller blocked {blocked * 1000:.1f} ms")
+    print(f"transfer manager:         queued in {queued * 1000:.1f} ms, all uploaded in {elapsed * 1000:.1f} ms, "
+          f"at most {most_running} running at once ({args.workers} workers)")
+    print(f"request during a {args.large} MB upload answered in at most {whole_latency * 1000:.1f} ms with the file "
+          f"in one piece, {segments_latency * 1000:.1f} ms with it in {args.segment:g} MB segments")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""
+Throughput of the selectors server with 1, 2, 4 and 8 worker processes, against a load generator made of several
+processes: each logs in a few clients, which keep asking for FILES_INFO (serializing the list of the server files
+takes the server some CPU), then all of them log in and out as fast as they can.
+
+The workers only help as far as there are cores to run them, and the load generator needs some too.
+
+    python benchmarks/workers.py --workers 1 2 4 8 --processes 4 --files 1000
+"""
+import argparse
+import multiprocessing
+import os
+import socket
+import tempfile
+import time
+
+from harness import DataType, connect, free_port
+from server import Server
+
+
+def serve(save_path: str, port: int, workers: int):
+    server = Server(workers=workers)
+    server.SERVER_IP = "127.0.0.1"
+    server.PORT = port
+    server.SERVER_FILES_SAVE_PATH = save_path
+    server.SERVER_PARTIAL_PATH = save_path + "_partial"
+    server.SERVER_STORE_PATH = save_path + "_store"
+    server.start()
+
+
+def requests(port: int, process: int, clients: int, duration: float) -> int:
+    """
+    Sends FILES_INFO requests from clients connections for duration seconds, returns how many were answered
+    """
+
+    server = Server()
+    server.SERVER_IP = "127.0.0.1"
+    server.PORT = port
+    connections = [connect(server, f"load{process}-{i}") for i in range(clients)]
+    answered = 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        # One request in flight on each connection, so every worker has something to do
+        for connection in connections:
+            connection.send(DataType.FILES_INFO)
+        for connection in connections:
+            while connection.receive()[0] != DataType.FILES_INFO:
+                pass
+        answered += len(connections)
+    for connection in connections:
+        connection.send(DataType.DISCONNECT)
+        connection.close()
+    return answered
+
+
+def logins(port: int, process: int, duration: float) -> int:
+    """
+    Logs in and out for duration seconds, returns how many logins went through
+    """
+
+    server = Server()
+    server.SERVER_IP = "127.0.0.1"
+    server.PORT = port
+    count = 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        connection = connect(server, f"churn{process}-{count}")
+        connection.send(DataType.DISCONNECT)
+        connection.close()
+        count += 1
+    return count
+
+
+def run(workers: int, processes: int, clients: int, files: int, duration: float) -> dict:
+    with tempfile.TemporaryDirectory() as directory:
+        save_path = os.path.join(directory, "server_files")
+        os.makedirs(save_path)
+        for i in range(files):
+            with open(os.path.join(save_path, f"file{i:06}.bin"), "wb") as file:
+                file.write(b"x" * (i % 4096))
+
+        # The supervisor forks the workers, so the server gets a process of its own without any threads
+        context = multiprocessing.get_context("fork")
+        port = free_port()
+        server = context.Process(target=serve, args=(save_path, port, workers))
+        server.start()
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port)).close()
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.01)
+
+        with context.Pool(processes) as pool:
+            answered = pool.starmap(requests, [(port, i, clients, duration) for i in range(processes)])
+            logged_in = pool.starmap(logins, [(port, i, duration) for i in range(processes)])
+
+        server.terminate()
+        server.join()
+
+    return {
+        "workers": workers,
+        "requests": sum(answered) / duration,
+        "logins": sum(logged_in) / duration,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--processes", type=int, default=4, help="processes of the load generator")
+    parser.add_argument("--clients", type=int, default=8, help="clients of each load generator process")
+    parser.add_argument("--files", type=int, default=1000, help="server files listed by FILES_INFO")
+    parser.add_argument("--duration", type=float, default=5, help="seconds of each measure")
+    args = parser.parse_args()
+
+    results = [run(workers, args.processes, args.clients, args.files, args.duration) for workers in args.workers]
+
+    print()
+    print(f"{args.processes} load processes of {args.clients} clients, {args.files} files, {os.cpu_count()} CPUs")
+    print(f"{'workers':>8} {'requests/s':>12} {'logins/s':>10}")
+    for result in results:
+        print(f"{result['workers']:>8} {result['requests']:>12.0f} {result['logins']:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
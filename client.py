@@ -1,7 +1,12 @@
+import hashlib
+import itertools
 import json
-import random
 import socket
 import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import Future
 
 from PySide6.QtCore import QObject
 from qtpy.QtCore import Signal
@@ -9,31 +14,290 @@ from qtpy.QtCore import Signal
 import main
 import os
 
-from tools import receive_data, send_data, DataType, send_file, receive_file
+from compression import codec_flags, file_codec, flag_codec
+from log import get_logger
+from metrics import ClientMetrics
+from progress import NullReporter, SignalReporter, TqdmReporter
+from tools import receive_data, DataType, send_file, receive_file, discard_file, BinaryFraming, \
+    receive_request_header, receive_field, split_ranges, unique_file_path, new_digest, DEDUP_CHUNK_SIZE, \
+    DEDUP_HASH_SIZE, LOGIN_DEDUP, LOGIN_FILES_DELTA, LOGIN_FILES_QUERY, LOGIN_STATS, LOGIN_UPLOAD_SEGMENTS, \
+    FILES_PAGE_SIZE, unpack_indices
+
+logger = get_logger(__name__)
+
+
+class TransferState:
+    """
+    Uploads and downloads which haven't completed yet, saved to a JSON file so they can be resumed after a
+    disconnection or a restart of the client
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path) as file:
+                self.state = json.load(file)
+        except (OSError, ValueError):
+            self.state = {}
+        self.state.setdefault("uploads", {})
+        self.state.setdefault("downloads", {})
+
+    def get(self, kind, key):
+        with self.lock:
+            return self.state[kind].get(key)
+
+    def items(self, kind):
+        with self.lock:
+            return list(self.state[kind].items())
+
+    def set(self, kind, key, value):
+        """
+        Saves the state of a transfer, None removes it
+        """
+
+        with self.lock:
+            if value is None:
+                if self.state[kind].pop(key, None) is None:
+                    return
+            else:
+                self.state[kind][key] = value
+            # Write a new file and swap it in, so a crash can't leave a truncated one
+            with open(self.path + ".tmp", "w") as file:
+                json.dump(self.state, file)
+            os.replace(self.path + ".tmp", self.path)
+
+
+class FrameWriter:
+    """
+    Thread writing everything the client sends to its socket, so frames sent from different threads are never
+    interleaved.
+
+    Messages are sent in the order they were queued, ahead of files. A file is sent as a stream of steps, each one
+    sending whole messages (a segment of an upload, or a chunk) from the writer thread, and the streams take turns
+    a step at a time. A message then never waits for more than one step of a file.
+
+    A socket error closes the connection, failing every file still queued. Any other error raised by a step only
+    fails its own file, whose future gets the exception, and the writer goes on with the others.
+    """
+
+    def __init__(self, sock, metrics=None):
+        self.sock = sock
+        # ClientMetrics the time spent sending is added to, None if disabled
+        self.metrics = metrics
+        self.messages = deque()
+        # (steps, future) of the files being sent
+        self.streams = deque()
+        self.condition = threading.Condition()
+        self.closing = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def send(self, message):
+        """
+        Queues an encoded message
+        """
+
+        with self.condition:
+            if not self.closing:
+                self.messages.append(message)
+                self.condition.notify()
+
+    def send_stream(self, steps):
+        """
+        Queues a file, steps being a generator sending one step of it on the socket each time it is resumed.
+        Returns a future resolved with the value the generator returns once it is exhausted.
+        """
+
+        future = Future()
+        with self.condition:
+            if self.closing:
+                steps.close()
+                future.set_exception(ConnectionError("Connection closed"))
+            else:
+                self.streams.append((steps, future))
+                self.condition.notify()
+        return future
+
+    def close(self, wait=False):
+        """
+        Closes the socket once the messages already queued have been sent, the files still being sent are
+        abandoned after their current step. With wait, returns once the socket is closed.
+        """
+
+        with self.condition:
+            self.closing = True
+            self.condition.notify()
+        if wait and threading.current_thread() is not self.thread:
+            self.thread.join()
+
+    def run(self):
+        stream = None
+        try:
+            while True:
+                with self.condition:
+                    self.condition.wait_for(lambda: self.messages or self.streams or self.closing)
+                    if self.messages:
+                        message, stream = self.messages.popleft(), None
+                    elif self.streams and not self.closing:
+                        message, stream = None, self.streams.popleft()
+                    else:
+                        break
+                started = time.monotonic()
+                if stream is None:
+                    self.sock.sendall(message)
+                    self.count_wait(started)
+                    continue
+                steps, future = stream
+                try:
+                    next(steps)
+                except StopIteration as stop:
+                    future.set_result(stop.value)
+                    stream = None
+                    continue
+                except OSError:
+                    raise
+                except Exception as err:
+                    logger.exception("Sending a file failed")
+                    future.set_exception(err)
+                    stream = None
+                    continue
+                finally:
+                    self.count_wait(started)
+                with self.condition:
+                    # Its turn comes again after the other files
+                    self.streams.append(stream)
+                    stream = None
+        except OSError as err:
+            # Also when a file can't be read, the frame it was in can't be finished
+            logger.warning("Cannot send to the server: %s", err)
+        finally:
+            with self.condition:
+                self.closing = True
+                streams, self.streams = self.streams, deque()
+                self.messages.clear()
+            if stream is not None:
+                streams.appendleft(stream)
+            for steps, future in streams:
+                steps.close()
+                future.set_exception(ConnectionError("Connection closed"))
+            self.sock.close()
+
+    def count_wait(self, started):
+        if self.metrics is not None:
+            self.metrics.wait_seconds.inc(time.monotonic() - started, ("send",))
+
+
+class PendingRequest:
+    """
+    Request sent to the server whose answer the listener thread hasn't received yet, see Client.request()
+    """
+
+    def __init__(self, request_id, reply_type, key=None, context=None):
+        self.id = request_id
+        # Data type of the answer, and what tells it apart from the answers to other requests of the same type for
+        # servers which don't echo request ids (None to take them in order)
+        self.reply_type = reply_type
+        self.key = key
+        # What the listener thread needs to handle the answer, such as where to save a download
+        self.context = context
+        self.future = Future()
+        # time.monotonic() it was sent at
+        self.sent = time.monotonic()
+
+
+class TransferJob:
+    """
+    Upload or download run in the background by a TransferManager
+    """
+
+    def __init__(self, job_id, kind, file_path, file_name, progress=None):
+        self.id = job_id
+        # "upload" or "download"
+        self.kind = kind
+        self.file_path = file_path
+        self.file_name = file_name
+        # queued, running, paused, done, cancelled or failed
+        self.state = "queued"
+        # Bytes transferred and to transfer, as reported by the transfer
+        self.done = 0
+        self.total = 0
+        # "paused" or "cancelled" when a running upload was asked to stop, it stops after its current segment
+        self.stop_requested = None
+        # ProgressReporter the progress is passed on to, see progress.py
+        self.progress = progress or NullReporter()
+
+    def update(self, done, total):
+        """
+        Progress of the transfer, a job is passed to it as its progress reporter
+        """
+
+        self.done, self.total = done, total
+        self.progress.update(done, total)
+
+    def close(self):
+        self.progress.close()
 
 
 # Inherit from QObject to be able to use signals
 class Client(QObject):
-    files_info_received = Signal(list)
+    # Changes to the list of the server files, see apply_files_delta()
+    files_info_received = Signal(dict)
+    # Page of the server files answering query_files(), see Server.files_page()
+    files_page_received = Signal(dict)
 
-    def __init__(self):
+    def __init__(self, file_chunk_size=None, streams=1, hash_algorithm=None, compression=None, metrics=False,
+                 progress=None):
         super().__init__()
         self.FORMAT = main.DEFAULT_FORMAT
         self.HEADERDATALEN = main.DEFAULT_HEADERDATALEN
         self.PORT = main.DEFAULT_PORT
-        self.FILE_CHUNK_SIZE = 1024
+        self.FILE_CHUNK_SIZE = file_chunk_size or main.DEFAULT_FILE_CHUNK_SIZE
+        self.UPLOAD_SEGMENT_SIZE = main.DEFAULT_UPLOAD_SEGMENT_SIZE
+        # Seconds to wait for the answer to a request an upload needs before giving up on it
+        self.REQUEST_TIMEOUT = 10
+        # Number of data connections used to upload and download a file, 1 sends it over the main connection
+        self.STREAMS = streams
+        # Hash algorithm files are checked with after a transfer, empty to not check them
+        self.HASH_ALGORITHM = main.DEFAULT_HASH_ALGORITHM if hash_algorithm is None else hash_algorithm
+        # Codecs files are compressed with when the other side has them, in order of preference, empty to send and
+        # receive them as they are
+        self.COMPRESSION = main.DEFAULT_COMPRESSION if compression is None else compression
+        # Creates the progress reporter of a transfer which isn't run by a job from its description, a
+        # ProgressReporter class (see progress.py)
+        self.PROGRESS = progress or TqdmReporter
 
         self.SERVER = None
         self.LOGIN = None
 
         self.isConnected = False
+        self.framing = None
+        # LOGIN_* flags of the features the server supports
+        self.server_features = 0
 
         # Create a socket object (AF_INET = IPv4, SOCK_STREAM = TCP)
         self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Sends everything on the socket once logged in, see send_message() and send_stream()
+        self.writer = None
 
-        # Dictionary to store the file paths to save files, with the hash of the file path as the key
-        # Used to know which file the server is sending us
-        self.paths_to_save_files = {}
+        # Requests waiting for their answer, request id -> PendingRequest, see request()
+        self.pending_requests = {}
+        self.pending_lock = threading.Lock()
+        self.request_ids = itertools.count()
+
+        # Copy of the list of the server files, file name -> {file_name, file_size}, and its version (None if the
+        # server doesn't version it)
+        self.files = {}
+        self.files_version = None
+
+        self.transfers = TransferState(main.DEFAULT_CLIENT_TRANSFERS_PATH)
+
+        # ClientMetrics of the requests and transfers, None if disabled
+        self.metrics = None
+        if metrics:
+            self.metrics = ClientMetrics()
+            self.metrics.gauge("pending_requests", "Requests waiting for their answer",
+                               function=lambda: len(self.pending_requests))
 
         self.listener = None
 
@@ -41,24 +305,32 @@ class Client(QObject):
         self.SERVER = server_ip
         self.LOGIN = login
 
+        # A new socket for every connection, so the client can connect again after being disconnected
+        self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         try:
             # Connect to the server
             self.client.connect((self.SERVER, self.PORT))
-            print(f"Connected to {self.SERVER} on port {self.PORT}")
+            logger.info("Connected to %s on port %d", self.SERVER, self.PORT)
             self.isConnected = True
         except Exception as err:
-            print("Connection failed")
-            print(f"Unexpected {err=}, {type(err)=}")
+            logger.error("Connection to %s on port %d failed: %r", self.SERVER, self.PORT, err)
             return False
 
-        send_data(self.client, self.LOGIN.encode(self.FORMAT), 64)
-        result = receive_data(self.client, 1)
+        # Log in with a binary LOGIN frame, the server answers with a frame carrying the negotiated version. Both
+        # have the header of version 1, whatever the version.
+        login_framing = BinaryFraming()
+        self.client.sendall(login_framing.encode_hello(DataType.LOGIN, [self.LOGIN.encode(self.FORMAT)]))
+        header = receive_data(self.client, BinaryFraming.HEADER.size)
+        result = receive_data(self.client, 1) if header else None
 
-        if not result:
-            print("Connection closed")
+        if result != b'1':
+            logger.info("Connection closed")
             self.isConnected = False
             self.client.close()
             return False
+        _, version, _, self.server_features, _ = BinaryFraming.HEADER.unpack(header)
+        self.framing = BinaryFraming(version)
+        self.writer = FrameWriter(self.client, self.metrics)
 
         # Listen for messages from the server and be able to send messages to the server at the same time using
         # threading
@@ -75,62 +347,49 @@ class Client(QObject):
         """
 
         if not self.isConnected:
-            print("Not connected to the server")
+            logger.warning("Not connected to the server")
             return
 
-        send_data(self.client, str(data_type).encode(self.FORMAT), len(str(data_type)))
-
         match data_type:
             case DataType.DEBUG:
                 # Debug message
-                data = data.encode(self.FORMAT)
-                data_size = str(len(data)).encode(self.FORMAT)
-
-                send_data(self.client, data_size, self.HEADERDATALEN)
-                send_data(self.client, data, len(data))
+                self.send_message(self.framing.encode_message(data_type, [data.encode(self.FORMAT)]))
 
             case DataType.COMMAND:
                 # Command
-                data = data.encode(self.FORMAT)
-                data_size = str(len(data)).encode(self.FORMAT)
-
-                send_data(self.client, data_size, self.HEADERDATALEN)
-                send_data(self.client, data, len(data))
+                self.send_message(self.framing.encode_message(data_type, [data.encode(self.FORMAT)]))
 
             case DataType.UPLOAD_FILE:
                 # Upload file -> data = file path
-                print("[DEBUG] Uploading file")
-
-                file_name = os.path.basename(data).encode(self.FORMAT)
-                file_name_size = str(len(file_name)).encode(self.FORMAT)
-
-                send_data(self.client, file_name_size, self.HEADERDATALEN)
-                send_data(self.client, file_name, len(file_name))
-
-                send_file(self.client, data, self.HEADERDATALEN, self.FORMAT, self.FILE_CHUNK_SIZE)
+                self.upload_file(data)
 
             case DataType.FILES_INFO:
                 # Files info
-                # Send no data as we want to signal the server to send us the files info
-                print("[DEBUG] Requesting files info")
+                logger.debug("Requesting files info")
+                if self.server_features & LOGIN_FILES_DELTA:
+                    # Only ask for the changes since the version of the list we have, the server then keeps
+                    # sending the changes as they happen
+                    version = "" if self.files_version is None else str(self.files_version)
+                    self.send_message(self.framing.encode_message(DataType.FILES_DELTA,
+                                                                  [version.encode(self.FORMAT)]))
+                else:
+                    # Send no data as we want to signal the server to send us the files info
+                    self.send_message(self.framing.encode_message(data_type, []))
 
             case DataType.DELETE_FILE:
                 # Delete file -> data = file name
-                print("[DEBUG] Deleting file")
-                file_name = data.encode(self.FORMAT)
-                file_name_size = str(len(file_name)).encode(self.FORMAT)
-
-                send_data(self.client, file_name_size, self.HEADERDATALEN)
-                send_data(self.client, file_name, len(file_name))
+                logger.debug("Deleting file: %s", data)
+                self.delete_file(data)
 
             case DataType.DISCONNECT:
                 # Disconnect
+                self.send_message(self.framing.encode_message(data_type, []))
                 self.isConnected = False
-                self.client.close()
+                self.writer.close(wait=True)
 
             case _:
                 # Invalid data type
-                print("Invalid data type")
+                logger.warning("Invalid data type %s", data_type)
                 return
 
     def receive(self):
@@ -141,48 +400,143 @@ class Client(QObject):
             - Data type {0: Debug, 1: Command, 2: Upload file, 3: Download file, 4: Files info, 5: Delete file, 6: Disconnect}
         """
 
-        data_received = receive_data(self.client, 1)
-        if not data_received:
-            print("Connection closed")
+        data_type, flags, request_id, length = receive_request_header(self.client, self.framing)
+        if data_type is None:
+            logger.info("Connection closed")
             self.isConnected = False
-            self.client.close()
+            self.writer.close()
+            # The answers waited for won't come
+            with self.pending_lock:
+                requests, self.pending_requests = self.pending_requests, {}
+            for request in requests.values():
+                request.future.set_exception(ConnectionError("Connection closed"))
             return
-        data_type = int(data_received.decode(self.FORMAT))
 
         match data_type:
             case DataType.DEBUG:
-                # Debug message
-                data_length = int(receive_data(self.client, self.HEADERDATALEN).decode(self.FORMAT))
-                if data_length:
-                    debug_message = receive_data(self.client, data_length).decode(self.FORMAT)
-                    print(f"[DEBUG] {debug_message}")
+                # Debug message, the server couldn't serve the request it answers if it has a request id
+                debug_message = receive_field(self.client, self.framing, length).decode(self.FORMAT)
+                if debug_message:
+                    logger.info("Debug message from the server: %s", debug_message)
+                if request_id:
+                    self.resolve(self.take_request(request_id, DataType.DEBUG), None)
 
             case DataType.COMMAND:
                 # Command
-                data_length = int(receive_data(self.client, self.HEADERDATALEN).decode(self.FORMAT))
-                if data_length:
-                    command = receive_data(self.client, data_length).decode(self.FORMAT)
-                    print(f"[COMMAND] {command}")
+                command = receive_field(self.client, self.framing, length).decode(self.FORMAT)
+                if command:
+                    logger.info("Command from the server: %s", command)
 
             case DataType.DOWNLOAD_FILE:
                 # File
-                print("[DEBUG] Downloading file")
-                file_path_hash_size = int(receive_data(self.client, self.HEADERDATALEN).decode(self.FORMAT))
-                file_path_hash = receive_data(self.client, file_path_hash_size).decode(self.FORMAT)
+                logger.debug("Downloading file")
+                token = receive_field(self.client, self.framing, length).decode(self.FORMAT)
+                request = self.take_request(request_id, data_type, token)
+                if request is None:
+                    # Unknown, or no longer waited for
+                    logger.warning("Discarding a file no download is waiting for")
+                    discard_file(self.client, self.framing, self.FILE_CHUNK_SIZE, codec=flag_codec(flags))
+                    return
+                file_path, job = request.context
 
-                receive_file(self.client, self.HEADERDATALEN, self.FORMAT, self.FILE_CHUNK_SIZE, self.paths_to_save_files[str(file_path_hash)])
-                del self.paths_to_save_files[str(file_path_hash)]
+                started = time.monotonic()
+                completed = receive_file(self.client, self.framing, self.FILE_CHUNK_SIZE, file_path,
+                                         progress=self.new_progress("Receiving file", job), codec=flag_codec(flags))
+                if completed:
+                    self.count_transfer("download", os.path.getsize(file_path), started)
+                self.resolve(request, completed)
+
+            case DataType.DOWNLOAD_FROM:
+                # End of a file, written to the partial download from offset on
+                token = receive_field(self.client, self.framing, length).decode(self.FORMAT)
+                offset = int(receive_field(self.client, self.framing))
+                algorithm = receive_field(self.client, self.framing).decode(self.FORMAT)
+                request = self.take_request(request_id, data_type, token)
+                if request is None:
+                    logger.warning("Discarding a file no download is waiting for")
+                    discard_file(self.client, self.framing, self.FILE_CHUNK_SIZE, bool(algorithm), flag_codec(flags))
+                    return
+                file_path, job = request.context
+
+                # A FILE_DIGEST trailer follows the file if a hash algorithm was asked for, covering the bytes already
+                # received before the download was interrupted too
+                segments = [(file_path + ".part", 0, offset)]
+                digest = new_digest(algorithm, segments, self.FILE_CHUNK_SIZE) if algorithm else None
+                started = time.monotonic()
+                completed = receive_file(self.client, self.framing, self.FILE_CHUNK_SIZE, file_path + ".part", offset,
+                                         digest, self.new_progress("Receiving file", job), flag_codec(flags))
+                if completed:
+                    self.count_transfer("download", os.path.getsize(file_path + ".part") - offset, started)
+                    os.replace(file_path + ".part", unique_file_path(file_path))
+                    self.transfers.set("downloads", file_path, None)
+                elif not os.path.exists(file_path + ".part"):
+                    # Deleted because it was corrupted, the next download starts over
+                    self.transfers.set("downloads", file_path, None)
+                self.resolve(request, completed)
+
+            case DataType.TRANSFER_OFFSET:
+                transfer_id = receive_field(self.client, self.framing, length).decode(self.FORMAT)
+                offset = int(receive_field(self.client, self.framing))
+                self.resolve(self.take_request(request_id, data_type, transfer_id), offset)
+
+            case DataType.CHUNKS_NEEDED:
+                transfer_id = receive_field(self.client, self.framing, length).decode(self.FORMAT)
+                indices = unpack_indices(receive_field(self.client, self.framing))
+                self.resolve(self.take_request(request_id, data_type, transfer_id), indices)
+
+            case DataType.DOWNLOAD_STRIPED:
+                # Size of a file to download over several data connections
+                token = receive_field(self.client, self.framing, length).decode(self.FORMAT)
+                file_name = receive_field(self.client, self.framing).decode(self.FORMAT)
+                file_size = int(receive_field(self.client, self.framing))
+                request = self.take_request(request_id, data_type, token)
+                if request is None:
+                    # The file comes over data connections, which are only opened for a download waited for
+                    logger.warning("Ignoring a striped file no download is waiting for: %s", file_name)
+                    return
+
+                # Download in the background so the main connection keeps handling messages
+                threading.Thread(target=self.download_striped, args=(request, token, file_name, file_size),
+                                 daemon=True).start()
 
             case DataType.FILES_INFO:
                 # Files info
-                print("[DEBUG] Receiving files info")
-                files_info_size = int(receive_data(self.client, self.HEADERDATALEN).decode(self.FORMAT))
-                files_info = receive_data(self.client, files_info_size).decode(self.FORMAT)
-                self.files_info_received.emit(json.loads(files_info))
+                logger.debug("Receiving files info")
+                files_info = receive_field(self.client, self.framing, length).decode(self.FORMAT)
+                self.apply_files_delta({"version": None, "since": None, "files": json.loads(files_info), "removed": []})
+
+            case DataType.FILES_QUERY:
+                page = json.loads(receive_field(self.client, self.framing, length).decode(self.FORMAT))
+                for file_info in page["files"]:
+                    self.files[file_info["file_name"]] = file_info
+                if self.files_version is None and self.server_features & LOGIN_FILES_DELTA:
+                    # Get the changes from the version of the page on, without getting the whole list first
+                    self.files_version = page["version"]
+                    self.send(DataType.FILES_INFO)
+                self.resolve(self.take_request(request_id, data_type), page)
+                self.files_page_received.emit(page)
+
+            case DataType.DELETE_FILE:
+                # Deletion acknowledged
+                receive_field(self.client, self.framing, length)
+                self.resolve(self.take_request(request_id, data_type), True)
+
+            case DataType.STATS:
+                stats = json.loads(receive_field(self.client, self.framing, length).decode(self.FORMAT))
+                self.resolve(self.take_request(request_id, data_type), stats)
+
+            case DataType.FILES_DELTA:
+                delta = json.loads(receive_field(self.client, self.framing, length).decode(self.FORMAT))
+                if self.files_version is not None and delta["version"] <= self.files_version:
+                    # Already applied, in the answer to a request crossing a broadcast
+                    return
+                if not self.apply_files_delta(delta):
+                    # Missed some changes, ask for those since our version again
+                    self.send(DataType.FILES_INFO)
 
             case _:
                 # Invalid data type
-                print("Invalid data type")
+                logger.warning("Invalid data type %s", data_type)
                 return
 
     def listen(self):
@@ -192,26 +546,594 @@ class Client(QObject):
         while self.isConnected:
             self.receive()
 
-    def download_file(self, file_name, file_path):
+    def send_message(self, message):
+        """
+        Queue an encoded message to the server, sent by the writer thread ahead of the files being sent
+        """
+
+        self.writer.send(message)
+
+    def send_stream(self, steps):
+        """
+        Queue a file to the server, see FrameWriter.send_stream(). Returns whether it was entirely sent, once it
+        was, raises ConnectionError if the connection closed first.
+        """
+
+        return self.writer.send_stream(steps).result()
+
+    def request(self, data_type, fields, reply_type=None, key=None, context=None, request_id=None, flags=0):
+        """
+        Sends a request and returns a Future of its answer, which the listener thread resolves. The request carries
+        a new request id the server echoes in its answer, so any number of requests can be waiting for theirs.
+        Servers which don't echo it (framing version 1) get the id all the same, their answers are matched on their
+        data type (reply_type, data_type by default) and key instead, or taken in order without a key.
+        """
+
+        request = PendingRequest(request_id or self.next_request_id(), reply_type or data_type, key, context)
+        with self.pending_lock:
+            self.pending_requests[request.id] = request
+        if self.metrics is not None:
+            self.metrics.messages.inc(1, (DataType(data_type).name,))
+        self.send_message(self.framing.encode_message(data_type, fields, flags, request.id))
+        return request.future
+
+    def next_request_id(self):
+        """
+        Returns a new u32 request id, 0 being for messages which aren't requests
+        """
+
+        return next(self.request_ids) % 0xFFFFFFFF + 1
+
+    def take_request(self, request_id, reply_type, key=None):
         """
-        Download a file from the server
-        Send a hash of the file path to the server to later know which file the server is sending us
-        Add a random number in the hash to allow for multiple files with the same name to be downloaded
+        Removes and returns the pending request an answer is for, None if there is none
         """
 
-        send_data(self.client, str(DataType.DOWNLOAD_FILE).encode(self.FORMAT), len(str(DataType.DOWNLOAD_FILE)))
+        with self.pending_lock:
+            if request_id:
+                return self.pending_requests.pop(request_id, None)
+            for request in self.pending_requests.values():
+                if request.reply_type == reply_type and request.key in (key, None):
+                    return self.pending_requests.pop(request.id)
+        return None
 
-        file_name = file_name.encode(self.FORMAT)
-        file_name_size = str(len(file_name)).encode(self.FORMAT)
+    def resolve(self, request, result):
+        """
+        Resolves the future of a request answered, if it was still waited for
+        """
+
+        if request is not None and not request.future.done():
+            if self.metrics is not None:
+                self.metrics.request_seconds.observe(time.monotonic() - request.sent,
+                                                     (DataType(request.reply_type).name,))
+            request.future.set_result(result)
+
+    def count_transfer(self, direction, size, started):
+        """
+        Adds a file uploaded or downloaded since time.monotonic() started to the metrics
+        """
+
+        if self.metrics is not None:
+            self.metrics.file_bytes.inc(size, (direction,))
+            self.metrics.transfer_seconds.observe(time.monotonic() - started, (direction,))
+
+    def new_progress(self, description, job=None):
+        """
+        Returns the progress reporter of a transfer: its job if it has one, else a new one from PROGRESS
+        """
+
+        return job if job is not None else self.PROGRESS(description)
+
+    def download_file(self, file_name, file_path, job=None):
+        """
+        Download a file from the server to file_path, reporting its progress to job if given. Returns a Future of
+        whether the whole file was received. The request id is sent as the token the server echoes, so the
+        answers of servers which don't echo request ids are matched on it.
+        """
+
+        request_id = self.next_request_id()
+        token = str(request_id)
+        fields = [file_name.encode(self.FORMAT), token.encode(self.FORMAT)]
+        if self.STREAMS > 1:
+            return self.request(DataType.DOWNLOAD_STRIPED, fields, key=token, context=(file_path, job),
+                                request_id=request_id)
+
+        # The file is received to file_path.part until it is complete, continue it if it is a previous download of
+        # the same file
+        offset = 0
+        download = self.transfers.get("downloads", file_path)
+        if download is not None and download["file_name"] == file_name and os.path.exists(file_path + ".part"):
+            offset = os.path.getsize(file_path + ".part")
+            logger.info("Resuming download of %s at %d bytes", file_name, offset)
+        else:
+            self.transfers.set("downloads", file_path, {"file_name": file_name})
+        fields += [str(offset).encode(self.FORMAT), self.HASH_ALGORITHM.encode(self.FORMAT)]
+        # The server compresses the file with one of the codecs whose flag is set, if it has any of them
+        return self.request(DataType.DOWNLOAD_FROM, fields, key=token, context=(file_path, job), request_id=request_id,
+                            flags=codec_flags(self.COMPRESSION))
+
+    def delete_file(self, file_name):
+        """
+        Asks the server to delete a file, returns a Future of True once it did, of None if it couldn't. Servers
+        which don't echo request ids don't acknowledge deletions, None is returned for them.
+        """
+
+        fields = [file_name.encode(self.FORMAT)]
+        if not self.framing.request_ids:
+            self.send_message(self.framing.encode_message(DataType.DELETE_FILE, fields))
+            return None
+        return self.request(DataType.DELETE_FILE, fields)
+
+    def upload_file(self, file_path, job=None):
+        """
+        Upload a file the best way the server supports, returns whether the whole file was sent. With a job, the
+        upload reports its progress to it and stops early when it is paused or cancelled.
+        """
+
+        logger.debug("Uploading file: %s", file_path)
+        started = time.monotonic()
+        if self.STREAMS > 1:
+            completed = self.upload_striped(file_path, job)
+        elif self.server_features & LOGIN_DEDUP:
+            completed = self.upload_deduplicated(file_path, job)
+        else:
+            completed = self.upload_resumable(file_path, job)
+        if completed:
+            self.count_transfer("upload", os.path.getsize(file_path), started)
+        return completed
+
+    def upload_resumable(self, file_path, job=None):
+        """
+        Upload a file under a transfer id, continuing from the bytes the server already has if a previous upload of
+        the same file was interrupted. The file is hashed while it is sent so the server can check it.
+        Servers which support it get the file in segments of UPLOAD_SEGMENT_SIZE bytes, each in its own message, so
+        other messages don't wait behind a whole file and the upload can be paused between two of them.
+        """
 
-        send_data(self.client, file_name_size, self.HEADERDATALEN)
-        send_data(self.client, file_name, len(file_name))
+        file_name = os.path.basename(file_path)
+        file_stat = os.stat(file_path)
+        key = os.path.abspath(file_path)
 
-        file_path_hash = hash(file_path + str(random.randint(0, 1000000000)))
-        self.paths_to_save_files[str(file_path_hash)] = file_path
+        offset = 0
+        upload = self.transfers.get("uploads", key)
+        if upload is not None and upload["file_size"] == file_stat.st_size and upload["mtime"] == file_stat.st_mtime:
+            offset = self.query_offset(upload["transfer_id"])
+            logger.info("Resuming upload of %s at %d bytes", file_name, offset)
+        else:
+            # New upload, or the file changed since the interrupted one
+            upload = {"transfer_id": uuid.uuid4().hex, "file_size": file_stat.st_size, "mtime": file_stat.st_mtime}
+            self.transfers.set("uploads", key, upload)
 
-        file_path_hash = str(file_path_hash).encode(self.FORMAT)
-        file_path_hash_size = str(len(file_path_hash)).encode(self.FORMAT)
+        segment_size = self.UPLOAD_SEGMENT_SIZE if self.server_features & LOGIN_UPLOAD_SEGMENTS else None
+        # Compressed with the first of our codecs the server has, unless it looks already compressed
+        codec = file_codec(self.COMPRESSION, self.server_features, file_path, offset)
+        digest = None
+        if self.HASH_ALGORITHM:
+            digest = new_digest(self.HASH_ALGORITHM, [(file_path, 0, offset)], self.FILE_CHUNK_SIZE)
+
+        def segments(offset):
+            while True:
+                fields = [upload["transfer_id"], file_name, file_stat.st_size, offset, self.HASH_ALGORITHM]
+                self.client.sendall(self.framing.encode_message(DataType.UPLOAD_RESUMABLE,
+                                                                [str(field).encode(self.FORMAT) for field in fields],
+                                                                codec_flags([codec])))
+                send_file(self.client, file_path, self.framing, self.FILE_CHUNK_SIZE, offset, digest, segment_size,
+                          self.new_progress("Sending file", job), codec)
+                if segment_size is None or offset + segment_size >= file_stat.st_size:
+                    return True
+                offset += segment_size
+                yield
+                if job is not None and job.stop_requested:
+                    # The server keeps what it received, the upload continues from there
+                    return False
+
+        if not self.send_stream(segments(offset)):
+            return False
+        self.transfers.set("uploads", key, None)
+        return True
+
+    def query_offset(self, transfer_id):
+        """
+        Asks the server how many bytes of an upload it has, 0 if it doesn't answer in time
+        """
+
+        future = self.request(DataType.TRANSFER_OFFSET, [transfer_id.encode(self.FORMAT)], key=transfer_id)
+        return self.wait_answer(future) or 0
+
+    def upload_deduplicated(self, file_path, job=None):
+        """
+        Upload a file to a deduplicating server: send the hashes of its chunks first, then only the chunks the server
+        doesn't already have. Returns whether the upload was completed.
+        """
+
+        file_name = os.path.basename(file_path)
+        file_stat = os.stat(file_path)
+        file_size = file_stat.st_size
+        # Remembered like resumable uploads so resume_transfers() uploads it again if it is interrupted, the chunks
+        # the server received before are then not sent again. It keeps its transfer id, the manifest sent again
+        # replaces the one of the interrupted upload.
+        key = os.path.abspath(file_path)
+        upload = self.transfers.get("uploads", key)
+        if upload is None or upload["file_size"] != file_size or upload["mtime"] != file_stat.st_mtime:
+            upload = {"transfer_id": uuid.uuid4().hex, "file_size": file_size, "mtime": file_stat.st_mtime}
+            self.transfers.set("uploads", key, upload)
+        transfer_id = upload["transfer_id"]
+
+        hashes = []
+        with open(file_path, "rb") as file:
+            while chunk := file.read(DEDUP_CHUNK_SIZE):
+                hashes.append(hashlib.blake2b(chunk, digest_size=DEDUP_HASH_SIZE).digest())
+
+        fields = [transfer_id.encode(self.FORMAT), file_name.encode(self.FORMAT), str(file_size).encode(self.FORMAT),
+                  b"".join(hashes)]
+        needed = self.wait_answer(self.request(DataType.UPLOAD_MANIFEST, fields, DataType.CHUNKS_NEEDED, transfer_id))
+        if needed is None:
+            logger.warning("The server didn't answer the manifest of %s", file_name)
+            return False
+        logger.debug("Sending %d of the %d chunks of %s", len(needed), len(hashes), file_name)
+
+        def chunks():
+            total = sum(min(DEDUP_CHUNK_SIZE, file_size - index * DEDUP_CHUNK_SIZE) for index in needed)
+            sent = 0
+            progress = self.new_progress("Sending chunks", job)
+            try:
+                with open(file_path, "rb") as file:
+                    for index in needed:
+                        if job is not None and job.stop_requested:
+                            return False
+                        file.seek(index * DEDUP_CHUNK_SIZE)
+                        chunk = file.read(DEDUP_CHUNK_SIZE)
+                        self.client.sendall(self.framing.encode_message(DataType.UPLOAD_CHUNK, [chunk]))
+                        sent += len(chunk)
+                        progress.update(sent, total)
+                        yield
+            finally:
+                progress.close()
+            return True
+
+        if not self.send_stream(chunks()):
+            return False
+        self.transfers.set("uploads", key, None)
+        return True
+
+    def request_stats(self):
+        """
+        Asks the server for its metrics, returns a Future of them (see Metrics.snapshot()), of None if they are
+        disabled. Returns None if the server doesn't answer STATS.
+        """
+
+        if not self.server_features & LOGIN_STATS:
+            return None
+        return self.request(DataType.STATS, [])
+
+    def wait_answer(self, future):
+        """
+        Waits for the answer to a request, returns None if it doesn't come within REQUEST_TIMEOUT seconds or the
+        connection closes first
+        """
+
+        try:
+            return future.result(self.REQUEST_TIMEOUT)
+        except (TimeoutError, ConnectionError):
+            return None
+
+    def query_files(self, offset=0, limit=FILES_PAGE_SIZE, pattern="", sort="name"):
+        """
+        Asks the server for limit of its files from offset on, those whose name starts with or matches the glob
+        pattern if given, sorted by name, size or mtime ("-" first for descending order). files_page_received
+        emits the answer, servers which can't answer such queries send all of their files in files_info_received
+        instead. Returns a Future of the page, None for those servers.
+        """
+
+        if not self.server_features & LOGIN_FILES_QUERY:
+            self.send(DataType.FILES_INFO)
+            return None
+        fields = [str(offset), str(limit), pattern, sort]
+        return self.request(DataType.FILES_QUERY, [field.encode(self.FORMAT) for field in fields])
+
+    def apply_files_delta(self, delta):
+        """
+        Applies changes to our copy of the list of the server files and emits them, returns False if they don't
+        apply to the version we have:
+
+        {
+            version: int (None for the server's that don't version the list),
+            since: int, or None if files is the whole list,
+            files: [{file_name: str, file_size: int}] added or changed,
+            removed: [str]
+        }
+        """
+
+        if delta["since"] is None:
+            self.files = {}
+        elif delta["since"] != self.files_version:
+            return False
+        for file_info in delta["files"]:
+            self.files[file_info["file_name"]] = file_info
+        for file_name in delta["removed"]:
+            self.files.pop(file_name, None)
+        self.files_version = delta["version"]
+        self.files_info_received.emit(delta)
+        return True
+
+    def resume_transfers(self):
+        """
+        Continue the uploads and downloads which were interrupted, typically after connecting to the server again
+        """
+
+        for file_path, upload in self.transfers.items("uploads"):
+            if os.path.exists(file_path):
+                self.send(DataType.UPLOAD_FILE, file_path)
+            else:
+                self.transfers.set("uploads", file_path, None)
+        for file_path, download in self.transfers.items("downloads"):
+            self.download_file(download["file_name"], file_path)
+
+    def open_range(self, data_type, transfer_id, file_name, file_size, offset, length):
+        """
+        Opens a data connection to the server for one range of a file, data_type being UPLOAD_RANGE or
+        DOWNLOAD_RANGE
+        """
+
+        sock = socket.create_connection((self.SERVER, self.PORT))
+        fields = [self.LOGIN, transfer_id, file_name, file_size, offset, length]
+        sock.sendall(self.framing.encode_hello(data_type, [str(field).encode(self.FORMAT) for field in fields]))
+        return sock
+
+    def transfer_ranges(self, transfer_range, file_size):
+        """
+        Runs transfer_range(offset, length) for each of the self.STREAMS ranges of a file in its own thread, returns
+        whether they all returned True. A range which raised failed.
+        """
+
+        ranges = split_ranges(file_size, self.STREAMS)
+        results = [False] * len(ranges)
+
+        def run(index, offset, length):
+            try:
+                results[index] = transfer_range(offset, length)
+            except OSError as err:
+                logger.warning("Range of %d bytes at %d failed: %s", length, offset, err)
+            except Exception:
+                logger.exception("Range of %d bytes at %d failed", length, offset)
+
+        threads = [threading.Thread(target=run, args=(index, *file_range)) for index, file_range in enumerate(ranges)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return all(results)
+
+    def upload_striped(self, file_path, job=None):
+        """
+        Upload a file split in ranges sent in parallel over self.STREAMS data connections, returns whether they
+        have all been sent. The ranges go out whole, a job can't stop them.
+        """
+
+        file_name = os.path.basename(file_path)
+        file_size = os.path.getsize(file_path)
+        transfer_id = uuid.uuid4().hex
+
+        def upload_range(offset, length):
+            with self.open_range(DataType.UPLOAD_RANGE, transfer_id, file_name, file_size, offset, length) as sock, \
+                    open(file_path, "rb") as file:
+                # Short if the file was truncated meanwhile
+                return (sock.sendfile(file, offset, length) if length else 0) == length
+
+        if not self.transfer_ranges(upload_range, file_size):
+            logger.warning("Upload of %s failed", file_name)
+            return False
+        if job is not None:
+            job.update(file_size, file_size)
+        return True
+
+    def download_striped(self, request, token, file_name, file_size):
+        """
+        Download the ranges of a file in parallel over self.STREAMS data connections, each range being written
+        at its offset in the preallocated file, then resolve the request of the download. The file is deleted if a
+        range fails or ends early.
+        """
+
+        file_path, job = request.context
+        file_path = unique_file_path(file_path)
+        started = time.monotonic()
+        logger.debug("Receiving file: %s", os.path.basename(file_path))
+        with open(file_path, "wb") as file:
+            file.truncate(file_size)
+
+        def download_range(offset, length):
+            buffer = bytearray(self.FILE_CHUNK_SIZE)
+            view = memoryview(buffer)
+            with self.open_range(DataType.DOWNLOAD_RANGE, token, file_name, file_size, offset, length) as sock, \
+                    open(file_path, "r+b") as file:
+                # Each range has its own file object, so it can simply seek to its offset
+                file.seek(offset)
+                while length:
+                    size = sock.recv_into(view[:min(self.FILE_CHUNK_SIZE, length)])
+                    if not size:
+                        break
+                    file.write(view[:size])
+                    length -= size
+            return not length
+
+        if not self.transfer_ranges(download_range, file_size):
+            logger.warning("Download of %s failed, deleting it", os.path.basename(file_path))
+            os.remove(file_path)
+            self.resolve(request, False)
+            return
+        if job is not None:
+            job.update(file_size, file_size)
+        self.count_transfer("download", file_size, started)
+        self.resolve(request, True)
+
+
+class TransferManager(QObject):
+    """
+    Runs the uploads and downloads of a client in the background, at most `workers` of them at a time, so queuing
+    them returns at once. Jobs can be paused, resumed and cancelled.
+
+    An upload stops after the segment (or chunk, for a deduplicating server) it is sending, and a paused upload
+    continues from where it stopped like an interrupted one. A download is received by the client's listener
+    thread once the server started sending it, only the downloads still queued can be paused or cancelled.
+    """
+
+    # Job id, "upload" or "download", file name
+    job_added = Signal(int, str, str)
+    # Job id, bytes transferred, bytes to transfer. Emitted at most every ProgressReporter.INTERVAL seconds per job,
+    # see progress.py
+    job_progress = Signal(int, object, object)
+    # Job id, new state of the job (see TransferJob.state)
+    job_state_changed = Signal(int, str)
+
+    def __init__(self, client, workers=2, parent=None):
+        super().__init__(parent)
+        self.client = client
+        self.workers = workers
+        # Job id -> job, of every job added
+        self.jobs = {}
+        self.queue = deque()
+        self.condition = threading.Condition()
+        # Worker threads, started as jobs are added
+        self.threads = []
+        self.job_ids = itertools.count(1)
+        self.running = True
+
+    def upload(self, file_path):
+        """
+        Queues the upload of a file, returns the id of its job
+        """
+
+        job_id = next(self.job_ids)
+        return self.add(TransferJob(job_id, "upload", file_path, os.path.basename(file_path),
+                                    SignalReporter(self.job_progress, job_id)))
+
+    def download(self, file_name, file_path):
+        """
+        Queues the download of a server file to file_path, returns the id of its job
+        """
+
+        job_id = next(self.job_ids)
+        return self.add(TransferJob(job_id, "download", file_path, file_name,
+                                    SignalReporter(self.job_progress, job_id)))
+
+    def add(self, job):
+        self.job_added.emit(job.id, job.kind, job.file_name)
+        with self.condition:
+            self.jobs[job.id] = job
+            self.queue.append(job)
+            if len(self.threads) < self.workers:
+                thread = threading.Thread(target=self.work, daemon=True)
+                self.threads.append(thread)
+                thread.start()
+            self.condition.notify()
+        return job.id
+
+    def pause(self, job_id):
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return
+            if job.state == "queued":
+                self.queue.remove(job)
+                job.state = "paused"
+            elif job.state == "running" and job.kind == "upload":
+                job.stop_requested = "paused"
+                return
+            else:
+                return
+        self.job_state_changed.emit(job.id, job.state)
+
+    def resume(self, job_id):
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return
+            if job.state == "running":
+                # Asked to pause, but hasn't stopped yet
+                job.stop_requested = None
+                return
+            if job.state != "paused":
+                return
+            job.state = "queued"
+            self.queue.append(job)
+            self.condition.notify()
+        self.job_state_changed.emit(job.id, job.state)
+
+    def cancel(self, job_id):
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return
+            if job.state == "running" and job.kind == "upload":
+                job.stop_requested = "cancelled"
+                return
+            if job.state not in ("queued", "paused"):
+                return
+            if job.state == "queued":
+                self.queue.remove(job)
+            self.forget(job)
+            job.state = "cancelled"
+        self.job_state_changed.emit(job.id, job.state)
+
+    def shutdown(self):
+        """
+        Stops the workers once their running job is over, running uploads stop after their current segment and
+        can be resumed later like interrupted ones
+        """
+
+        with self.condition:
+            self.running = False
+            for job in self.jobs.values():
+                if job.state == "running" and job.kind == "upload":
+                    job.stop_requested = "paused"
+            self.condition.notify_all()
+
+    def work(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.queue or not self.running)
+                if not self.running:
+                    return
+                job = self.queue.popleft()
+                job.state = "running"
+            self.job_state_changed.emit(job.id, job.state)
+
+            try:
+                completed = self.run(job)
+            except OSError as err:
+                logger.warning("%s of %s failed: %s", job.kind.capitalize(), job.file_name, err)
+                completed = False
+            except Exception:
+                # Failed by the writer thread (see FrameWriter), the job fails instead of the worker
+                logger.exception("%s of %s failed", job.kind.capitalize(), job.file_name)
+                completed = False
+
+            with self.condition:
+                if completed:
+                    job.state = "done"
+                elif job.stop_requested is not None:
+                    job.state = job.stop_requested
+                    if job.state == "cancelled":
+                        self.forget(job)
+                else:
+                    job.state = "failed"
+                job.stop_requested = None
+            self.job_progress.emit(job.id, job.done, job.total)
+            self.job_state_changed.emit(job.id, job.state)
+
+    def run(self, job):
+        """
+        Transfers the file of a job, returns whether it was completed
+        """
+
+        if job.kind == "upload":
+            return self.client.upload_file(job.file_path, job)
+        return self.client.download_file(job.file_name, job.file_path, job).result()
+
+    def forget(self, job):
+        """
+        Forgets what the client saved to resume the upload of a cancelled job
+        """
 
-        send_data(self.client, file_path_hash_size, self.HEADERDATALEN)
-        send_data(self.client, file_path_hash, len(file_path_hash))
+        if job.kind == "upload":
+            self.client.transfers.set("uploads", os.path.abspath(job.file_path), None)
@@ -0,0 +1,222 @@
+"""
+Compressed file (the codec is given by the flags of the message the file follows):
+
+size of the file once decompressed (a length of the framing)
+then, until that many bytes have been decompressed:
+    u32 length of the block
+    block, the next piece of the compressed stream, which decompresses as soon as it is received
+"""
+import math
+import struct
+import zlib
+from collections import Counter
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# Codec -> flag. The flags of a message followed by a compressed file have the flag of its codec set, a client asks
+# for compressed downloads with the flags of the codecs it accepts, and the server's login answer has the flags of
+# the codecs it can receive uploads with.
+CODEC_FLAGS = {"zlib": 0x10, "zstd": 0x20, "lz4": 0x40}
+# Codecs installed, zlib always is
+CODECS = [codec for codec, module in (("zlib", zlib), ("zstd", zstandard), ("lz4", lz4)) if module is not None]
+
+BLOCK_LENGTH = struct.Struct("!I")
+# Longest compressed block accepted, a block holds one chunk of the file and chunks are much smaller
+MAX_BLOCK_SIZE = 16 * 1024 * 1024
+
+# What the codecs raise on invalid data, lz4 raises RuntimeError
+DECOMPRESSION_ERRORS = (zlib.error, RuntimeError) + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+ZLIB_LEVEL = 1
+ZSTD_LEVEL = 3
+
+# Bytes at the start of a file its entropy is measured on, and the entropy in bits per byte above which it is taken
+# as already compressed (or encrypted) and sent as it is
+SAMPLE_SIZE = 65536
+MAX_ENTROPY = 7.5
+
+
+def codec_flags(codecs) -> int:
+    """
+    Returns the flags of the codecs which are installed
+    """
+
+    flags = 0
+    for codec in codecs:
+        if codec in CODECS:
+            flags |= CODEC_FLAGS[codec]
+    return flags
+
+
+def choose_codec(codecs, flags: int):
+    """
+    Returns the first of codecs which is installed and whose flag is set in flags, None if there is none
+    """
+
+    for codec in codecs:
+        if codec in CODECS and flags & CODEC_FLAGS[codec]:
+            return codec
+    return None
+
+
+def flag_codec(flags: int):
+    """
+    Returns the codec of a file following a message with these flags, None if it isn't compressed. Raises ValueError
+    if the codec isn't installed.
+    """
+
+    for codec, flag in CODEC_FLAGS.items():
+        if flags & flag:
+            if codec not in CODECS:
+                raise ValueError(f"Codec {codec} isn't installed")
+            return codec
+    return None
+
+
+def entropy(data) -> float:
+    """
+    Returns the Shannon entropy of data in bits per byte
+    """
+
+    size = len(data)
+    return -sum(count / size * math.log2(count / size) for count in Counter(data).values()) if size else 0.0
+
+
+def compressible(file_path: str, offset: int = 0) -> bool:
+    """
+    Whether a file looks worth compressing, from the entropy of its first SAMPLE_SIZE bytes from offset on
+    """
+
+    with open(file_path, "rb") as file:
+        file.seek(offset)
+        sample = file.read(SAMPLE_SIZE)
+    return bool(sample) and entropy(sample) <= MAX_ENTROPY
+
+
+def file_codec(codecs, flags: int, file_path: str, offset: int = 0):
+    """
+    Returns the codec to send a file from offset on with (see choose_codec()), None to send it as it is, also when it
+    looks already compressed
+    """
+
+    codec = choose_codec(codecs, flags)
+    return codec if codec is not None and compressible(file_path, offset) else None
+
+
+class Compressor:
+    """
+    Compresses a file one chunk at a time, each into a length-prefixed block the receiver can decompress as soon as
+    it has it
+    """
+
+    def __init__(self, codec: str):
+        self.codec = codec
+        match codec:
+            case "zlib":
+                self.compressor = zlib.compressobj(ZLIB_LEVEL)
+            case "zstd":
+                self.compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+            case "lz4":
+                # Each block is a frame of its own, lz4's streaming decompressor holds back the end of a block until
+                # it gets the next one
+                self.compressor = None
+            case _:
+                raise ValueError(f"Unsupported codec {codec!r}")
+
+    def compress(self, data) -> bytes:
+        """
+        Returns the block of a chunk, length prefix included
+        """
+
+        match self.codec:
+            case "zlib":
+                block = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+            case "zstd":
+                block = self.compressor.compress(data) + self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+            case _:
+                block = lz4.frame.compress(data, store_size=True)
+        return BLOCK_LENGTH.pack(len(block)) + block
+
+
+class BoundedOutput:
+    """
+    Where a zstd stream writer writes what it decompresses, a piece at a time. Raises ValueError as soon as more than
+    limit bytes were written, so a small block can't expand to more than that in memory first.
+    """
+
+    def __init__(self):
+        self.limit = 0
+        self.pieces = []
+        self.size = 0
+
+    def reset(self, limit: int) -> None:
+        self.limit, self.pieces, self.size = limit, [], 0
+
+    def write(self, data) -> int:
+        self.size += len(data)
+        if self.size > self.limit:
+            raise ValueError("zstd block larger than the rest of the file")
+        self.pieces.append(bytes(data))
+        return len(data)
+
+    def take(self) -> bytes:
+        """
+        Returns what was written since reset()
+        """
+
+        data = b"".join(self.pieces)
+        self.pieces = []
+        return data
+
+
+class Decompressor:
+    """
+    Decompresses the blocks of a file made by a Compressor, as they are received
+    """
+
+    def __init__(self, codec: str):
+        self.codec = codec
+        match codec:
+            case "zlib":
+                self.decompressor = zlib.decompressobj()
+            case "zstd":
+                self.output = BoundedOutput()
+                self.decompressor = zstandard.ZstdDecompressor().stream_writer(self.output, write_return_read=True)
+            case "lz4":
+                self.decompressor = None
+            case _:
+                raise ValueError(f"Unsupported codec {codec!r}")
+
+    def decompress(self, block, limit: int) -> bytes:
+        """
+        Returns the data of a block (without its length prefix). Raises ValueError if the block is invalid or
+        decompresses to more than limit bytes, the rest of the file.
+        """
+
+        try:
+            match self.codec:
+                case "zlib":
+                    data = self.decompressor.decompress(block, limit + 1)
+                case "zstd":
+                    # Written to self.output as it is decompressed, which stops it past limit
+                    self.output.reset(limit)
+                    self.decompressor.write(block)
+                    data = self.output.take()
+                case _:
+                    # The frame has the size of its data, checked before decompressing anything
+                    size = lz4.frame.get_frame_info(bytes(block))["content_size"]
+                    if not 0 < size <= limit:
+                        raise ValueError(f"Invalid size of lz4 block: {size}")
+                    data = lz4.frame.decompress(bytes(block))
+        except DECOMPRESSION_ERRORS as err:
+            raise ValueError(f"Invalid {self.codec} block") from err
+        if len(data) > limit:
+            raise ValueError(f"{self.codec} block larger than the rest of the file")
+        return data
@@ -0,0 +1,627 @@
+import os
+import socket
+import stat
+import time
+from collections import deque
+from enum import IntEnum
+
+from compression import BLOCK_LENGTH, MAX_BLOCK_SIZE, Compressor, Decompressor, flag_codec
+from log import get_logger
+from throttle import new_bucket
+from tools import DataType, FILE_MESSAGES, Framing, MESSAGE_FIELDS, hello_missing, new_digest, write_at
+
+logger = get_logger(__name__)
+
+
+class ParserState(IntEnum):
+    HEADER = 0  # Waiting for the data type
+    LENGTH = 1  # Waiting for the length of the next field (or of the uploaded file)
+    FIELD = 2  # Waiting for the content of a field (file name, debug message, ...)
+    PAYLOAD = 3  # Streaming the bytes of an uploaded file to disk
+    DONE = 4  # A whole message has been received and is being handled
+    BLOCK_LENGTH = 5  # Waiting for the length of the next block of a compressed upload
+    BLOCK = 6  # Waiting for a block of a compressed upload, decompressed to disk once received
+
+
+class FileSender:
+    """
+    Files, or pieces of files, queued for sending one after the other. Regular files are copied to the socket by
+    the kernel with os.sendfile(), other files (or platforms without os.sendfile()) are read from disk one chunk at
+    a time. With a digest (a hashlib object), the files are read and hashed as they are sent instead, and with a
+    codec they are read and sent in compressed blocks. With a rate, the transfer is limited to that many bytes per
+    second. release is called once the sender is closed, to unpin the chunks the pieces are read from.
+    """
+
+    def __init__(self, segments, chunk_size, digest=None, codec=None, rate=None, release=None):
+        # (file path, offset, count) pieces left to send after the current one
+        self.segments = deque(segments)
+        self.size = sum(count for _, _, count in self.segments)
+        self.chunk_size = chunk_size
+        self.digest = digest
+        self.compressor = Compressor(codec) if codec is not None else None
+        self.bucket = new_bucket(rate)
+        self.release = release
+        # time.monotonic() the transfer was queued at
+        self.started = time.monotonic()
+
+        self.file = None
+        self.offset = self.end = 0
+        self.zero_copy = False
+        self.pending = memoryview(b"")
+        self.next_segment()
+
+    def next_segment(self) -> bool:
+        """
+        Opens the next piece to send, returns False if there is none left
+        """
+
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if not self.segments:
+            return False
+        file_path, self.offset, count = self.segments.popleft()
+        self.file = open(file_path, "rb")
+        file_stat = os.fstat(self.file.fileno())
+        # Sending the piece stops at self.end, or at the end of the file if it is shorter than expected
+        self.end = min(file_stat.st_size, self.offset + count)
+        self.zero_copy = (hasattr(os, "sendfile") and stat.S_ISREG(file_stat.st_mode) and self.digest is None
+                          and self.compressor is None)
+        return True
+
+    def send(self, sock: socket.socket) -> int:
+        """
+        Sends at most one chunk, returns the number of bytes sent or -1 once everything has been sent.
+        Raises BlockingIOError if the socket is not writable.
+        """
+
+        while not self.pending and self.offset >= self.end:
+            if not self.next_segment():
+                return -1
+
+        if self.zero_copy:
+            count = min(self.chunk_size, self.end - self.offset)
+            sent = os.sendfile(sock.fileno(), self.file.fileno(), self.offset, count)
+            if not sent:
+                self.end = self.offset
+            self.offset += sent
+            return sent
+
+        if not self.pending:
+            self.file.seek(self.offset)
+            data = self.file.read(min(self.chunk_size, self.end - self.offset))
+            if not data:
+                self.end = self.offset
+                return 0
+            self.offset += len(data)
+            if self.digest is not None:
+                self.digest.update(data)
+            self.pending = memoryview(data if self.compressor is None else self.compressor.compress(data))
+
+        sent = sock.send(self.pending)
+        self.pending = self.pending[sent:]
+        return sent
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.segments.clear()
+        if self.release is not None:
+            self.release()
+            self.release = None
+
+
+class Handshake:
+    """
+    First state of every connection in the non-blocking server loop: receiving its first message, a login or a range
+    request, without waiting for it. Only the bytes of that message are read, what follows it (like the data of an
+    upload range) is left on the socket for the connection it becomes.
+    """
+
+    def __init__(self, sock: socket.socket, addr, deadline: float):
+        self.sock = sock
+        self.addr = addr
+        # time.monotonic() by which the message must have been received
+        self.deadline = deadline
+        self.data = bytearray()
+        self.missing = hello_missing(self.data)
+        # Whether the message was received, or the connection closed
+        self.done = False
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def receive(self) -> bool:
+        """
+        Reads what is available of the first message, returns whether all of it has been received.
+        Raises ConnectionError if the connection was closed or the message is invalid.
+        """
+
+        while self.missing:
+            try:
+                data = self.sock.recv(self.missing)
+            except BlockingIOError:
+                return False
+            if not data:
+                raise ConnectionError("Connection closed before its first message")
+            self.data += data
+            try:
+                self.missing = hello_missing(self.data)
+            except ValueError as err:
+                raise ConnectionError(err) from err
+        return True
+
+    def close(self):
+        self.done = True
+        self.sock.close()
+
+
+class Connection:
+    """
+    State of one client connection in the non-blocking server loop.
+
+    Incoming bytes are fed to a resumable parser which advances through ParserState as data arrives, so a
+    connection never waits for the rest of a message and other clients keep being served in the meantime.
+    Outgoing data is queued and written whenever the socket is writable, except for the content of files which
+    the server sends a chunk at a time in turn with the other downloads (see Server.send_downloads()).
+    """
+
+    # Bytes read from the socket per readable event
+    RECV_SIZE = 65536
+    # Bytes written to the socket per writable event, so one big download can't monopolize the loop
+    SEND_BUDGET = 262144
+
+    def __init__(self, server, sock: socket.socket, addr, login: str, framing: Framing):
+        self.server = server
+        self.sock = sock
+        self.addr = addr
+        self.login = login
+        self.framing = framing
+
+        self.inbound = bytearray()
+        # Reused for every read, so receiving doesn't allocate a new bytes object each time
+        self.recv_view = memoryview(bytearray(self.RECV_SIZE))
+        self.outbound = deque()
+        # Bytes of the messages in outbound, the files being sent aside
+        self.queued = 0
+        self.events = 0
+        self.closed = False
+        # Rate limit of everything sent to the client, shared with its data connections (None for no limit)
+        self.bucket = None
+        # Whether the connection is among the downloads of the server, and whether its socket was full the last time
+        # it sent a chunk of a file
+        self.scheduled = False
+        self.blocked = False
+        # ServerMetrics of the server (None if disabled), time.monotonic() of the last read, since when the socket
+        # has been full with data left to send (None if it isn't), and when the upload being received started
+        self.metrics = server.metrics
+        self.received_at = time.monotonic()
+        self.waiting_since = None
+        self.upload_started = 0.0
+
+        self.state = ParserState.HEADER
+        self.expected = framing.header_size
+        self.data_type = None
+        # Flags and id of the request being received, its answers carry the id back (0 for none)
+        self.flags = 0
+        self.request_id = 0
+        self.fields = []
+        self.upload_file = None
+        self.upload_digest = None
+        self.upload_decompressor = None
+        self.upload_remaining = 0
+        # (transfer id, digest) of a resumable upload waiting for its FILE_DIGEST trailer
+        self.pending_upload = None
+        # Transfer id -> (file name, file size, chunk hashes, hashes of the chunks still needed) of the deduplicated
+        # uploads in progress
+        self.pending_manifests = dict()
+        # Version of the list of the server files the client has, None if it doesn't keep one and gets all of it in
+        # FILES_INFO on every change instead of FILES_DELTA
+        self.files_version = None
+        # Whether changes to the server files weren't sent to the client because it was too far behind in reading
+        # what was, it gets them once it has caught up (see Server.files_broadcast())
+        self.files_stale = False
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def receive(self) -> bool:
+        """
+        Reads the data available on the socket and advances the parser.
+        Returns False if the connection was closed by the client or sent invalid data.
+        """
+
+        streaming = self.state == ParserState.PAYLOAD and not self.inbound
+        size = min(self.RECV_SIZE, self.upload_remaining) if streaming else self.RECV_SIZE
+        try:
+            size = self.sock.recv_into(self.recv_view[:size])
+        except BlockingIOError:
+            return True
+        if not size:
+            return False
+        if self.metrics is not None:
+            self.count_received(size)
+
+        if streaming:
+            # File bytes go straight from the receive buffer to the file
+            self.write_upload(self.recv_view[:size])
+            return not self.closed
+
+        self.inbound += self.recv_view[:size]
+        return self.parse()
+
+    def count_received(self, size: int):
+        """
+        Adds bytes received to the metrics, and the time since the last read if it was spent waiting for the rest of
+        a message
+        """
+
+        now = time.monotonic()
+        if self.state != ParserState.HEADER or self.inbound:
+            self.metrics.wait_seconds.inc(now - self.received_at, ("receive",))
+        self.received_at = now
+        self.metrics.received_bytes.inc(size, (self.login,))
+
+    def parse(self) -> bool:
+        """
+        Consumes as much of the inbound buffer as possible, handling every message completed along the way
+        """
+
+        while self.inbound and not self.closed:
+            if self.state == ParserState.PAYLOAD:
+                size = min(len(self.inbound), self.upload_remaining)
+                with memoryview(self.inbound) as view:
+                    self.write_upload(view[:size])
+                del self.inbound[:size]
+                continue
+
+            if len(self.inbound) < self.expected:
+                return True
+            chunk = bytes(self.inbound[:self.expected])
+            del self.inbound[:self.expected]
+
+            match self.state:
+                case ParserState.HEADER:
+                    try:
+                        data_type, self.flags, self.request_id, length = self.framing.decode_request_header(chunk)
+                        self.data_type = DataType(data_type)
+                    except ValueError:
+                        self.data_type = None
+                    if self.data_type not in MESSAGE_FIELDS:
+                        logger.warning("Invalid data type from %s", self.login)
+                        return False
+                    if self.data_type == DataType.DISCONNECT:
+                        return False
+                    self.fields = []
+                    if length is not None and self.expects_length():
+                        # Binary frames carry the length of the first field in their header
+                        self.receive_length(length)
+                    else:
+                        self.next_field()
+
+                case ParserState.LENGTH:
+                    self.receive_length(self.framing.decode_length(chunk))
+
+                case ParserState.FIELD:
+                    self.fields.append(chunk)
+                    self.next_field()
+
+                case ParserState.BLOCK_LENGTH:
+                    length = BLOCK_LENGTH.unpack(chunk)[0]
+                    if not 0 < length <= MAX_BLOCK_SIZE:
+                        logger.warning("Invalid compressed block from %s", self.login)
+                        return False
+                    self.state = ParserState.BLOCK
+                    self.expected = length
+
+                case ParserState.BLOCK:
+                    try:
+                        data = self.upload_decompressor.decompress(chunk, self.upload_remaining)
+                    except ValueError as err:
+                        logger.warning("Invalid compressed block from %s: %s", self.login, err)
+                        return False
+                    self.state = ParserState.BLOCK_LENGTH
+                    self.expected = BLOCK_LENGTH.size
+                    self.write_upload(data)
+        return not self.closed
+
+    def expects_length(self) -> bool:
+        """
+        Whether the current message still has a field, or the size of an uploaded file, to receive
+        """
+
+        return len(self.fields) < MESSAGE_FIELDS[self.data_type] or self.data_type in FILE_MESSAGES
+
+    def receive_length(self, length: int):
+        if len(self.fields) < MESSAGE_FIELDS[self.data_type]:
+            if length:
+                self.state = ParserState.FIELD
+                self.expected = length
+            else:
+                self.fields.append(b"")
+                self.next_field()
+        else:
+            self.start_upload(length)
+
+    def next_field(self):
+        """
+        Moves the parser to the next field of the current message, or finishes the message
+        """
+
+        if self.expects_length():
+            self.state = ParserState.LENGTH
+            self.expected = self.framing.length_size
+        else:
+            self.finish_message()
+
+    def start_upload(self, file_size: int):
+        try:
+            codec = flag_codec(self.flags)
+        except ValueError as err:
+            logger.warning("Invalid upload from %s: %s", self.login, err)
+            self.server.close_client(self)
+            return
+
+        if self.data_type == DataType.UPLOAD_RESUMABLE:
+            self.upload_file, self.upload_digest = self.server.open_partial(self.login, self.fields, file_size)
+            if self.upload_file is None:
+                logger.warning("Invalid resumable upload from %s", self.login)
+                self.server.close_client(self)
+                return
+        else:
+            self.upload_file = self.server.open_upload(self.fields[0].decode(self.server.FORMAT))
+        self.upload_remaining = file_size
+        self.upload_started = time.monotonic()
+        if codec is None:
+            self.state = ParserState.PAYLOAD
+        else:
+            # The file comes in compressed blocks, which go through the parser
+            self.upload_decompressor = Decompressor(codec)
+            self.state = ParserState.BLOCK_LENGTH
+            self.expected = BLOCK_LENGTH.size
+        if not file_size:
+            self.finish_upload()
+
+    def write_upload(self, data):
+        self.upload_file.write(data)
+        if self.upload_digest is not None:
+            self.upload_digest.update(data)
+        self.upload_remaining -= len(data)
+        if not self.upload_remaining:
+            self.finish_upload()
+
+    def finish_upload(self):
+        self.upload_file.close()
+        if self.metrics is not None:
+            self.metrics.transfer_seconds.observe(time.monotonic() - self.upload_started, ("upload",))
+        if self.data_type == DataType.UPLOAD_FILE:
+            # Tell the server the name the file was saved under, which may differ from the one it was sent with
+            self.fields[0] = os.path.basename(self.upload_file.name).encode(self.server.FORMAT)
+        self.upload_file = None
+        self.upload_decompressor = None
+        self.finish_message()
+        self.upload_digest = None
+
+    def finish_message(self):
+        self.state = ParserState.DONE
+        self.server.handle_message(self, self.data_type, self.fields)
+
+        self.state = ParserState.HEADER
+        self.expected = self.framing.header_size
+        self.data_type = None
+        self.flags = 0
+        self.request_id = 0
+        self.fields = []
+
+    def send(self, *chunks: bytes):
+        """
+        Queues data to be sent to the client
+        """
+
+        self.outbound.extend(chunks)
+        self.queued += sum(len(chunk) for chunk in chunks)
+        self.flush()
+
+    def send_header(self, data_type: int, *fields: bytes, flags: int = 0):
+        """
+        Queues a data type followed by length-prefixed fields, answering the request being handled if any
+        """
+
+        self.send(self.framing.encode_message(data_type, fields, flags, self.request_id))
+
+    def send_file(self, file_name: str, offset: int = 0, algorithm: str = "", codec: str = None):
+        """
+        Queues the size of a server file followed by its content, which is read lazily while sending.
+        With an offset, only the end of the file is sent and the size is the number of bytes left.
+        With a hash algorithm, the file is followed by a FILE_DIGEST trailer. Its digest is computed while the file
+        is sent, unless the server already knows it and the file can still be sent with zero-copy.
+        With a codec, the file is sent in compressed blocks, the header before it must have the codec's flag set.
+        """
+
+        cached = self.server.cached_digest(file_name, algorithm) if algorithm else None
+        digest = None
+        if algorithm and cached is None:
+            digest = new_digest(algorithm, self.server.file_segments(file_name, 0, offset), self.server.FILE_CHUNK_SIZE)
+        chunks = self.server.pin_file(file_name)
+        sender = FileSender(self.server.file_segments(file_name, offset), self.server.FILE_CHUNK_SIZE, digest, codec,
+                            self.server.TRANSFER_RATE, lambda: self.server.release_file(chunks))
+        self.outbound.append(self.framing.encode_length(sender.size))
+        self.queued += self.framing.length_size
+        self.outbound.append(sender)
+
+        if algorithm:
+            def trailer():
+                value = cached
+                if value is None:
+                    value = digest.digest()
+                    self.server.cache_digest(file_name, algorithm, value)
+                return self.framing.encode_message(DataType.FILE_DIGEST, [algorithm.encode(), value])
+            self.outbound.append(trailer)
+        self.flush()
+
+    def flush(self):
+        """
+        Writes queued data until the socket would block, the send budget is spent or a file is next, then updates
+        the selector so the connection is only watched for writability while it has data left to send
+        (and only for that while it has too much of it)
+        """
+
+        if self.closed:
+            return
+
+        budget = self.SEND_BUDGET
+        try:
+            while self.outbound and budget > 0:
+                item = self.outbound[0]
+                if callable(item):
+                    # Built only once everything queued before it has been sent, like the digest of a file
+                    item = self.outbound[0] = item()
+                    self.queued += len(item)
+                if isinstance(item, FileSender):
+                    self.server.schedule(self)
+                    break
+                sent = self.sock.send(item)
+                self.queued -= sent
+                if sent < len(item):
+                    self.outbound[0] = memoryview(item)[sent:]
+                else:
+                    self.outbound.popleft()
+                budget -= sent
+        except BlockingIOError:
+            if self.metrics is not None and self.waiting_since is None:
+                self.waiting_since = time.monotonic()
+        except ConnectionError:
+            self.server.close_client(self)
+            return
+        if self.metrics is not None and budget < self.SEND_BUDGET:
+            self.metrics.sent_bytes.inc(self.SEND_BUDGET - budget, (self.login,))
+        if self.files_stale and self.queued <= self.server.LOW_WATER_MARK:
+            # What the client missed, queued now that it reads again
+            self.server.catch_up_files(self)
+            if self.closed:
+                return
+        self.server.update_interest(self)
+
+    def send_chunk(self) -> int:
+        """
+        Sends the next chunk of the file at the head of the queue, returns the number of bytes sent. Once the whole
+        file has been sent, what was queued after it is flushed.
+        """
+
+        try:
+            sent = self.outbound[0].send(self.sock)
+        except BlockingIOError:
+            self.blocked = True
+            if self.metrics is not None and self.waiting_since is None:
+                self.waiting_since = time.monotonic()
+            self.server.update_interest(self)
+            return 0
+        except ConnectionError:
+            self.server.close_client(self)
+            return 0
+        except OSError as err:
+            # Like a piece of the file which can't be read any more, only this client is affected
+            logger.warning("Sending a file to %s failed: %s", self.login, err)
+            self.server.close_client(self)
+            return 0
+        if sent < 0:
+            sender = self.outbound.popleft()
+            sender.close()
+            if self.metrics is not None:
+                self.metrics.transfer_seconds.observe(time.monotonic() - sender.started, ("download",))
+            self.flush()
+            return 0
+        if self.metrics is not None:
+            self.metrics.sent_bytes.inc(sent, (self.login,))
+        return sent
+
+    def sending_file(self) -> bool:
+        return bool(self.outbound) and isinstance(self.outbound[0], FileSender)
+
+    def close(self):
+        self.closed = True
+        for item in self.outbound:
+            if isinstance(item, FileSender):
+                item.close()
+        self.outbound.clear()
+        self.queued = 0
+        if self.upload_file is not None:
+            self.upload_file.close()
+            self.upload_file = None
+        self.sock.close()
+
+
+class StripedUpload:
+    """
+    File uploaded over several data connections, each range is written at its offset in the preallocated partial
+    file, which joins the server files as file_name once all of them have been received
+    """
+
+    def __init__(self, file_path, file_name, file_size):
+        self.file_path = file_path
+        self.file_name = file_name
+        self.file = open(file_path, "wb")
+        self.file.truncate(file_size)
+        self.size = file_size
+        self.received = 0
+
+    def write(self, offset, data):
+        write_at(self.file, data, offset)
+        self.received += len(data)
+
+    def done(self) -> bool:
+        return self.received >= self.size
+
+    def closed(self) -> bool:
+        return self.file.closed
+
+    def close(self):
+        self.file.close()
+
+
+class RangeConnection(Connection):
+    """
+    Data connection carrying one range of a file transferred over several connections.
+
+    An upload range is written to its StripedUpload as it arrives. A download range is queued as a FileSender
+    limited to the range when the connection is accepted.
+    """
+
+    def __init__(self, server, sock: socket.socket, addr, login: str, framing: Framing, offset: int, length: int,
+                 transfer: StripedUpload = None):
+        super().__init__(server, sock, addr, login, framing)
+        self.transfer = transfer
+        self.offset = offset
+        self.remaining = length
+        self.upload_started = time.monotonic()
+
+    def receive(self) -> bool:
+        try:
+            size = self.sock.recv_into(self.recv_view[:min(self.RECV_SIZE, self.remaining) or self.RECV_SIZE])
+        except BlockingIOError:
+            return True
+        if not size:
+            return False
+        if self.metrics is not None:
+            self.count_received(size)
+        if self.transfer is None or self.transfer.closed() or size > self.remaining:
+            # Download ranges aren't supposed to receive anything, nor upload ranges more than their length or
+            # after another range of the upload was interrupted
+            return False
+
+        self.transfer.write(self.offset, self.recv_view[:size])
+        self.offset += size
+        self.remaining -= size
+        if not self.remaining:
+            if self.metrics is not None:
+                self.metrics.transfer_seconds.observe(time.monotonic() - self.upload_started, ("upload",))
+            self.server.finish_range(self)
+        return not self.closed
+
+    def send_range(self, file_name: str):
+        chunks = self.server.pin_file(file_name)
+        segments = self.server.file_segments(file_name, self.offset, self.remaining)
+        self.outbound.append(FileSender(segments, self.server.FILE_CHUNK_SIZE, rate=self.server.TRANSFER_RATE,
+                                        release=lambda: self.server.release_file(chunks)))
+        self.flush()
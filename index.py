@@ -0,0 +1,284 @@
+import ctypes
+import ctypes.util
+import os
+import struct
+import time
+from bisect import bisect_left, insort
+from collections import deque
+
+from log import get_logger
+
+logger = get_logger(__name__)
+
+
+class IndexEntry:
+    __slots__ = ("size", "mtime", "digests")
+
+    def __init__(self, size: int, mtime: int):
+        self.size = size
+        # Modification time in nanoseconds
+        self.mtime = mtime
+        # Hash algorithm -> digest of the file, computed when it was uploaded or downloaded
+        self.digests = dict()
+
+
+def sort_value(key: str, file_name: str, entry: IndexEntry) -> tuple:
+    """
+    Returns what a file is sorted on for a sort key of FILES_QUERY, always ending with its name
+    """
+
+    if key == "size":
+        return entry.size, file_name
+    if key == "mtime":
+        return entry.mtime, file_name
+    return (file_name,)
+
+
+class Inotify:
+    """
+    Linux inotify watch of a directory, through ctypes as the standard library has no binding for it. Reports the
+    names of the files created, modified, moved or deleted in the directory.
+    """
+
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+
+    # Files being written aren't reported until they are closed, so half received uploads don't show up
+    MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+            | IN_ONLYDIR)
+    EVENT = struct.Struct("iIII")
+
+    def __init__(self, path: str):
+        """
+        Raises OSError if inotify isn't available or the directory can't be watched
+        """
+
+        if not hasattr(os, "uname") or os.uname().sysname != "Linux":
+            raise OSError("inotify is only available on Linux")
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(self.fd, os.fsencode(path), self.MASK) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f"Cannot watch {path}")
+        # Whether the directory is still watched, it no longer is once it has been moved or deleted
+        self.watching = True
+
+    def fileno(self) -> int:
+        return self.fd
+
+    def read(self):
+        """
+        Returns the names of the files which changed since the last call, None if some changes were missed (the
+        event queue overflowed, or the directory itself was moved or deleted)
+        """
+
+        names = set()
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return names
+            position = 0
+            while position < len(data):
+                _, mask, _, length = self.EVENT.unpack_from(data, position)
+                position += self.EVENT.size
+                if mask & (self.IN_IGNORED | self.IN_DELETE_SELF | self.IN_MOVE_SELF):
+                    self.watching = False
+                    return None
+                if mask & self.IN_Q_OVERFLOW:
+                    return None
+                names.add(os.fsdecode(data[position:position + length].rstrip(b"\0")))
+                position += length
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class FileIndex:
+    """
+    In-memory listing of the server files (name -> IndexEntry), so listing them doesn't hit the disk.
+
+    The server updates it whenever it adds or deletes a file. Changes made to the files directory by anything else
+    are picked up through inotify where it is available, and by a periodic rescan otherwise (and, less often, in
+    case inotify missed something).
+    """
+
+    # Seconds between two rescans of the files directory, when it is watched and when it isn't
+    RESCAN_INTERVAL = 30
+    WATCHED_RESCAN_INTERVAL = 600
+    # Number of changes remembered, clients with an older version of the list get all of it again
+    MAX_CHANGES = 10000
+
+    def __init__(self, scan, stat):
+        """
+        scan() returns the (size, mtime) of every server file by name, stat(file_name) those of one file, None if
+        there is no such file
+        """
+
+        self.scan = scan
+        self.stat = stat
+        self.files = dict()
+        self.watcher = None
+        self.next_rescan = 0
+
+        # Version of the list, increased by every change. It starts from the time so that versions keep increasing
+        # across restarts, and a version from before a restart is never mistaken for one of this list.
+        self.version = time.time_ns() // 1000
+        # Difference between two versions, more than one when the versions are shared with other lists (see shard())
+        self.step = 1
+        # (version, file name) of the last changes, and the oldest version they go back to
+        self.changes = deque()
+        self.first_version = self.version
+        # Sort key -> sort values of all the files, in order. Sorted when first queried, then kept up to date.
+        self.sorted = dict()
+
+    def shard(self, shard: int, shards: int) -> None:
+        """
+        Makes this list one of several lists of the same files kept by different processes, whose versions are
+        all different: those of this list are the ones equal to shard modulo shards. A version of another list is
+        never taken for one of this list.
+        """
+
+        self.step = shards
+        self.version = self.first_version = self.version * shards + shard
+
+    def watch(self, path: str) -> None:
+        """
+        Watches the files directory for changes, if inotify is available
+        """
+
+        if self.watcher is not None:
+            return
+        try:
+            self.watcher = Inotify(path)
+        except (OSError, AttributeError):
+            logger.warning("Cannot watch the server files, rescanning them periodically instead")
+
+    def close(self) -> None:
+        if self.watcher is not None:
+            self.watcher.close()
+            self.watcher = None
+
+    def refresh(self, file_name: str):
+        """
+        Updates the entry of a file from the disk, returns it (None if there is no such file)
+        """
+
+        file_stat = self.stat(file_name)
+        if file_stat is None:
+            old_entry = self.files.pop(file_name, None)
+            if old_entry is not None:
+                self.record(file_name, old_entry, None)
+            return None
+        entry = self.files.get(file_name)
+        if entry is None or (entry.size, entry.mtime) != file_stat:
+            old_entry, entry = entry, IndexEntry(*file_stat)
+            self.files[file_name] = entry
+            self.record(file_name, old_entry, entry)
+        return entry
+
+    def record(self, file_name: str, old_entry, new_entry) -> None:
+        self.version += self.step
+        self.changes.append((self.version, file_name))
+        if len(self.changes) > self.MAX_CHANGES:
+            self.first_version = self.changes.popleft()[0]
+
+        for key, values in self.sorted.items():
+            if old_entry is not None:
+                del values[bisect_left(values, sort_value(key, file_name, old_entry))]
+            if new_entry is not None:
+                insort(values, sort_value(key, file_name, new_entry))
+
+    def sorted_files(self, key: str) -> list[tuple]:
+        """
+        Returns the sort values of all the files (see sort_value()) in order
+        """
+
+        if key not in self.sorted:
+            self.sorted[key] = sorted(sort_value(key, file_name, entry) for file_name, entry in self.files.items())
+        return self.sorted[key]
+
+    def changes_since(self, version: int):
+        """
+        Returns the names of the files added, changed or removed since a version of the list, None if the changes
+        since then aren't known
+        """
+
+        if version is None or not self.first_version <= version <= self.version or (self.version - version) % self.step:
+            return None
+        file_names = set()
+        for change_version, file_name in reversed(self.changes):
+            if change_version <= version:
+                break
+            file_names.add(file_name)
+        return file_names
+
+    def update(self, file_names) -> bool:
+        """
+        Refreshes the entries of some files, returns whether any of them changed
+        """
+
+        changed = False
+        for file_name in file_names:
+            entry = self.files.get(file_name)
+            if self.refresh(file_name) is not entry:
+                changed = True
+        return changed
+
+    def rescan(self, files: dict = None) -> bool:
+        """
+        Reconciles the index with the files on disk, returns whether it changed. files can be the result of a
+        scan() made beforehand, out of the server's loop. The files that look different are checked again before
+        being updated, as the server may have changed them since.
+        """
+
+        self.next_rescan = time.monotonic() + (self.RESCAN_INTERVAL if self.watcher is None
+                                               else self.WATCHED_RESCAN_INTERVAL)
+        if files is None:
+            files = self.scan()
+        different = [file_name for file_name, file_stat in files.items()
+                     if file_name not in self.files or (self.files[file_name].size,
+                                                        self.files[file_name].mtime) != file_stat]
+        different.extend(file_name for file_name in self.files if file_name not in files)
+        return self.update(different)
+
+    def read_events(self) -> bool:
+        """
+        Applies the changes reported by inotify, returns whether the index changed
+        """
+
+        file_names = self.watcher.read()
+        if file_names is None:
+            # Events were lost. If the directory went away it isn't watched any more, the watcher is then left for
+            # the caller to close once it stopped waiting on it.
+            if not self.watcher.watching:
+                self.watcher = None
+            return self.rescan()
+        return self.update(file_names)
+
+    def timeout(self) -> float:
+        """
+        Returns the seconds until the next rescan is due
+        """
+
+        return max(self.next_rescan - time.monotonic(), 0)
+
+    def poll(self) -> bool:
+        """
+        Rescans the files if it is due, returns whether the index changed
+        """
+
+        return self.rescan() if not self.timeout() else False
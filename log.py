@@ -0,0 +1,139 @@
+"""
+Logging of the server and the client, under the "fdp" logger.
+
+Messages are formatted lazily, with their arguments passed separately (logger.debug("Received %s", name)): below
+the level of the logger a call returns before anything is built. The records kept are put on a queue by the thread
+logging them, and a listener thread formats and writes them, so a slow terminal or disk doesn't hold up the loop of
+the server. The output is text on stdout, and optionally JSON lines in a file (see JsonFormatter).
+
+Until setup_logging() is called, only warnings and errors are written, to stderr (Python's default).
+"""
+import atexit
+import copy
+import json
+import logging
+import os
+import queue
+import sys
+from logging.handlers import QueueHandler, QueueListener
+
+LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR")
+TEXT_FORMAT = "%(asctime)s [%(levelname)s] %(message)s"
+
+# Attributes every LogRecord has (or is given here), the others were passed in extra and go in the JSON lines as
+# they are
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "arguments"}
+
+# Listener writing the records queued, None until setup_logging() is called
+listener = None
+
+
+def get_logger(name: str) -> logging.Logger:
+    """
+    Returns the logger of a module, name being its __name__
+    """
+
+    return logging.getLogger("fdp." + name)
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats a record as a JSON object on a single line: its time, level, logger, message, the arguments the message
+    was formatted with and the extra fields it was logged with
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "process": record.process,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        args = getattr(record, "arguments", record.args)
+        if args:
+            entry["args"] = args
+        entry.update((key, value) for key, value in vars(record).items() if key not in RECORD_ATTRIBUTES)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class LogQueueHandler(QueueHandler):
+    """
+    Puts records on the queue of the listener. Only the message is formatted here, so it shows the arguments as
+    they were when it was logged, the rest is left to the listener thread.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        if record.exc_info:
+            # Tracebacks don't outlive the frames they point to
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        # Formatted again by the handlers of the listener, it has to give the same message. The arguments are kept
+        # aside for the JSON lines.
+        record.arguments = record.args
+        record.msg, record.args = record.message, None
+        return record
+
+
+def setup_logging(level: str = "INFO", json_path: str = None, stream=None) -> None:
+    """
+    Writes the records of the "fdp" logger from level up as text to stream (stdout by default), and as JSON lines
+    appended to json_path if given, from a listener thread
+    """
+
+    global listener
+    stop_logging()
+    handlers = [logging.StreamHandler(stream or sys.stdout)]
+    handlers[0].setFormatter(logging.Formatter(TEXT_FORMAT))
+    if json_path:
+        handlers.append(logging.FileHandler(json_path, encoding="utf-8"))
+        handlers[1].setFormatter(JsonFormatter())
+
+    records = queue.SimpleQueue()
+    logger = logging.getLogger("fdp")
+    logger.setLevel(level)
+    logger.handlers = [LogQueueHandler(records)]
+    # The default handler of the root logger would write them a second time
+    logger.propagate = False
+    listener = QueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+
+
+def stop_logging() -> None:
+    """
+    Writes the records still queued, and stops the listener thread
+    """
+
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
+
+
+def restart_listener() -> None:
+    """
+    Starts a listener in a forked child, the thread of the parent's doesn't exist there. Records which were queued
+    but not written yet when the process was forked are left to the parent.
+    """
+
+    global listener
+    if listener is None:
+        return
+    records = queue.SimpleQueue()
+    listener = QueueListener(records, *listener.handlers, respect_handler_level=True)
+    for handler in logging.getLogger("fdp").handlers:
+        if isinstance(handler, LogQueueHandler):
+            handler.queue = records
+    listener.start()
+
+
+atexit.register(stop_logging)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=restart_listener)
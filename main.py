@@ -1,13 +1,17 @@
 """
 FDP - File Delivery Protocol
 """
+import argparse
 import socket
 
 import server
 import client
 import threading
 
-from tools import DataType
+from compression import CODEC_FLAGS
+from log import LEVELS, setup_logging
+from metrics import serve_metrics
+from tools import DataType, HASH_ALGORITHMS
 
 # FORMAT = The format (encryption) of the message to be received
 DEFAULT_FORMAT = "utf-8"
@@ -20,7 +24,71 @@ DEFAULT_PORT = 6942  # Default port number for the server
 
 DEFAULT_SERVER_FILES_SAVE_PATH = "server_files"
 
+# Where the server keeps uploads which haven't completed yet, until the client resumes them
+DEFAULT_SERVER_PARTIAL_PATH = "server_partial"
+
+# Where a deduplicating server keeps the chunks and manifests of its files
+DEFAULT_SERVER_STORE_PATH = "server_store"
+
+# Where the client keeps track of the transfers it can resume
+DEFAULT_CLIENT_TRANSFERS_PATH = "client_transfers.json"
+
+# Bytes of a file read or sent at once during a transfer
+DEFAULT_FILE_CHUNK_SIZE = 65536
+
+# Resumable uploads are sent in segments of this many bytes, between which other messages and uploads can be sent
+# and the upload can be paused
+DEFAULT_UPLOAD_SEGMENT_SIZE = 8 * 1024 * 1024
+
+# Hash algorithm files are checked with after a transfer (see tools.HASH_ALGORITHMS)
+DEFAULT_HASH_ALGORITHM = "blake2b"
+
+# Codecs files are compressed with during a transfer, in order of preference, when both sides have them installed
+# (see compression.py). Files which look already compressed are sent as they are. zlib, always installed, comes last:
+# it compresses text at around 50 MB/s, so it is only used when one side has neither zstd nor lz4.
+DEFAULT_COMPRESSION = ("zstd", "lz4", "zlib")
+
 if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="FDP - File Delivery Protocol")
+    arg_parser.add_argument("--engine", choices=["selectors", "asyncio"], default="selectors",
+                            help="server engine used when hosting (default: selectors)")
+    arg_parser.add_argument("--chunk-size", type=int, default=DEFAULT_FILE_CHUNK_SIZE,
+                            help=f"bytes sent at once during file transfers (default: {DEFAULT_FILE_CHUNK_SIZE})")
+    arg_parser.add_argument("--streams", type=int, default=1,
+                            help="data connections used per file transfer (default: 1, the main connection)")
+    arg_parser.add_argument("--dedup", action="store_true",
+                            help="store uploads deduplicated in chunks when hosting, identical data is stored once")
+    arg_parser.add_argument("--hash", choices=[*HASH_ALGORITHMS, "none"], default=DEFAULT_HASH_ALGORITHM,
+                            help=f"hash algorithm transfers are checked with (default: {DEFAULT_HASH_ALGORITHM})")
+    arg_parser.add_argument("--compression", nargs="+", choices=[*CODEC_FLAGS, "none"], default=DEFAULT_COMPRESSION,
+                            help="codecs transfers are compressed with, in order of preference "
+                                 f"(default: {' '.join(DEFAULT_COMPRESSION)})")
+    arg_parser.add_argument("--workers", type=int, default=1,
+                            help="processes accepting clients on the port when hosting with the selectors engine "
+                                 "on Unix (default: 1)")
+    arg_parser.add_argument("--max-rate", type=float,
+                            help="MB/s the server sends files at to all the clients together when hosting "
+                                 "(default: no limit)")
+    arg_parser.add_argument("--client-rate", type=float,
+                            help="MB/s the server sends files at to each client when hosting (default: no limit)")
+    arg_parser.add_argument("--transfer-rate", type=float,
+                            help="MB/s the server sends each file at when hosting (default: no limit)")
+    arg_parser.add_argument("--metrics-port", type=int,
+                            help="port the server serves its metrics on at /metrics when hosting, in the Prometheus "
+                                 "text format, each worker on the next one (default: metrics disabled)")
+    arg_parser.add_argument("--client-metrics-port", type=int,
+                            help="port the client serves its metrics on at /metrics (default: metrics disabled)")
+    arg_parser.add_argument("--log-level", choices=LEVELS, default="INFO",
+                            help="least severe level of the messages logged (default: INFO)")
+    arg_parser.add_argument("--log-json",
+                            help="file the messages are also logged to as JSON lines, for analysis (default: none)")
+    args = arg_parser.parse_args()
+    setup_logging(args.log_level, args.log_json)
+    compression = [codec for codec in args.compression if codec != "none"]
+    # Rate limits in bytes per second
+    rates = {name: int(getattr(args, name) * 1024 * 1024) if getattr(args, name) else None
+             for name in ("max_rate", "client_rate", "transfer_rate")}
+
     local = None
     print("FDP - File Delivery Protocol")
     print("1. Host Server")
@@ -31,7 +99,14 @@ if __name__ == "__main__":
         sv.start()
 
     if isHost:
-        server = server.Server()
+        if args.engine == "asyncio":
+            # Imported here as async_server imports server, which imports this module
+            import async_server
+            server = async_server.AsyncServer(file_chunk_size=args.chunk_size, dedup=args.dedup,
+                                              compression=compression, metrics_port=args.metrics_port, **rates)
+        else:
+            server = server.Server(file_chunk_size=args.chunk_size, dedup=args.dedup, compression=compression,
+                                   workers=args.workers, metrics_port=args.metrics_port, **rates)
         thread = threading.Thread(target=start_server, args=(server,), daemon=True)
         thread.start()
 
@@ -48,7 +123,11 @@ if __name__ == "__main__":
             print("Username must be less than 64 characters")
             login = ""
 
-    local_client = client.Client()
+    local_client = client.Client(file_chunk_size=args.chunk_size, streams=args.streams,
+                                 hash_algorithm="" if args.hash == "none" else args.hash, compression=compression,
+                                 metrics=bool(args.client_metrics_port))
+    if args.client_metrics_port:
+        serve_metrics(args.client_metrics_port, local_client.metrics)
     if not isHost:
         server_ip = input("Enter the server IP (10.xxx.xxx.xxx): ")
         local_client.connect_to_server(login, server_ip)
@@ -59,7 +138,9 @@ if __name__ == "__main__":
         print("1. Send debug")
         print("2. Send command")
         print("3. Send file")
-        print("4. Exit")
+        print("4. Resume interrupted transfers")
+        print("5. Show server metrics")
+        print("6. Exit")
 
         choice = int(input("Enter your choice: "))
 
@@ -71,6 +152,19 @@ if __name__ == "__main__":
             case 3:
                 local_client.send(DataType.UPLOAD_FILE, input("Enter file path: "))
             case 4:
+                local_client.resume_transfers()
+            case 5:
+                stats = local_client.request_stats()
+                stats = local_client.wait_answer(stats) if stats is not None else None
+                if stats is None:
+                    print("The server doesn't share its metrics")
+                    continue
+                for metric in stats.values():
+                    for sample in metric["samples"]:
+                        labels = ",".join(f"{label}={value}" for label, value in sample["labels"].items())
+                        print(f"{sample['name']}{{{labels}}} {sample['value']}" if labels
+                              else f"{sample['name']} {sample['value']}")
+            case 6:
                 local_client.send(DataType.DISCONNECT)
                 break
             case _:
@@ -0,0 +1,215 @@
+"""
+Metrics of a server or a client: counters, gauges and histograms, each with a value per combination of the values
+of its labels. They are read in the Prometheus text format from an HTTP endpoint (see serve_metrics()), or as JSON
+in the answer to a STATS message.
+
+Updating a metric is a dictionary lookup and an addition. When metrics are disabled the registry is None, and the
+code updating them only checks for that.
+"""
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from log import get_logger
+
+logger = get_logger(__name__)
+
+# Upper bounds of the buckets of the histograms of durations, in seconds
+DURATION_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60, 300)
+
+
+class Counter:
+    """
+    Value which only goes up, such as a number of bytes or of seconds
+    """
+
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        # Label values -> value
+        self.values = dict()
+
+    def inc(self, amount=1, labels=()) -> None:
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self) -> list[tuple[str, dict, float]]:
+        """
+        Returns the (name, labels, value) of every value
+        """
+
+        return [(self.name, dict(zip(self.labels, labels)), value) for labels, value in list(self.values.items())]
+
+
+class Gauge(Counter):
+    """
+    Value which goes up and down, or read from function when the metrics are collected
+    """
+
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, labels=(), function=None):
+        super().__init__(name, help, labels)
+        self.function = function
+
+    def set(self, value, labels=()) -> None:
+        self.values[labels] = value
+
+    def samples(self) -> list[tuple[str, dict, float]]:
+        if self.function is not None:
+            return [(self.name, {}, self.function())]
+        return super().samples()
+
+
+class Histogram:
+    """
+    Distribution of values, such as durations: how many were up to each of the bounds of its buckets, their number
+    and their sum
+    """
+
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels=(), buckets=DURATION_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # Label values -> [values in each bucket (and above the last one), sum of the values]
+        self.values = dict()
+
+    def observe(self, value: float, labels=()) -> None:
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def samples(self) -> list[tuple[str, dict, float]]:
+        samples = []
+        for labels, (counts, total) in list(self.values.items()):
+            labels = dict(zip(self.labels, labels))
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                samples.append((self.name + "_bucket", {**labels, "le": str(bound)}, cumulative))
+            samples.append((self.name + "_sum", labels, total))
+            samples.append((self.name + "_count", labels, cumulative))
+        return samples
+
+
+class Metrics:
+    """
+    Registry of metrics, whose names all start with prefix
+    """
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self.metrics = []
+
+    def counter(self, name: str, help: str, labels=()) -> Counter:
+        return self.add(Counter(self.prefix + name, help, labels))
+
+    def gauge(self, name: str, help: str, labels=(), function=None) -> Gauge:
+        return self.add(Gauge(self.prefix + name, help, labels, function))
+
+    def histogram(self, name: str, help: str, labels=(), buckets=DURATION_BUCKETS) -> Histogram:
+        return self.add(Histogram(self.prefix + name, help, labels, buckets))
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """
+        Returns the metrics in the Prometheus text format
+        """
+
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in metric.samples():
+                if labels:
+                    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+                               for value in labels.values())
+                    name += "{" + ",".join(f'{label}="{value}"' for label, value in zip(labels, escaped)) + "}"
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> dict:
+        """
+        Returns the metrics as {name: {type, help, samples: [{name, labels, value}]}}, to be sent as JSON
+        """
+
+        return {metric.name: {"type": metric.type, "help": metric.help,
+                              "samples": [{"name": name, "labels": labels, "value": value}
+                                          for name, labels, value in metric.samples()]}
+                for metric in self.metrics}
+
+
+class ServerMetrics(Metrics):
+    """
+    Metrics of a server. The server adds gauges read from its state when they are collected.
+    """
+
+    def __init__(self):
+        super().__init__("fdp_server_")
+        self.received_bytes = self.counter("received_bytes_total", "Bytes received from each client", ("login",))
+        self.sent_bytes = self.counter("sent_bytes_total", "Bytes sent to each client", ("login",))
+        self.messages = self.counter("messages_total", "Messages received from the clients, per data type", ("type",))
+        self.transfer_seconds = self.histogram("transfer_duration_seconds",
+                                               "Duration of the files (and segments of files) uploaded and downloaded",
+                                               ("direction",))
+        self.wait_seconds = self.counter("wait_seconds_total",
+                                         "Time spent waiting with data to send for sockets to be writable (send), "
+                                         "and for the rest of messages already started (receive)", ("direction",))
+        self.loop_seconds = self.histogram("loop_iteration_seconds",
+                                           "Time spent handling the events of one iteration of the selector loop")
+
+
+class ClientMetrics(Metrics):
+    """
+    Metrics of a client
+    """
+
+    def __init__(self):
+        super().__init__("fdp_client_")
+        self.file_bytes = self.counter("file_bytes_total", "Size of the files uploaded and downloaded", ("direction",))
+        self.messages = self.counter("messages_total", "Requests sent to the server, per data type", ("type",))
+        self.request_seconds = self.histogram("request_duration_seconds",
+                                              "Time from sending a request until its answer was handled, per data "
+                                              "type", ("type",))
+        self.transfer_seconds = self.histogram("transfer_duration_seconds", "Duration of the uploads and downloads",
+                                               ("direction",))
+        self.wait_seconds = self.counter("wait_seconds_total",
+                                         "Time the writer thread spent blocked sending messages and files",
+                                         ("direction",))
+
+
+def serve_metrics(port: int, *registries: Metrics, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """
+    Serves the metrics of registries in the Prometheus text format on http://host:port/metrics, from a daemon
+    thread. Returns the HTTP server, shutdown() stops it.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = "".join(registry.render() for registry in registries).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info("Serving metrics on http://%s:%d/metrics", host, server.server_address[1])
+    return server
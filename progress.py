@@ -0,0 +1,96 @@
+"""
+Progress of the transfers. send_file() and receive_file() (see tools.py) update a reporter on every chunk, which
+passes the progress on at most every INTERVAL seconds: a progress bar on the terminal, a Qt signal for the GUI, or
+nothing at all.
+"""
+import time
+
+from tqdm import tqdm
+
+
+class ProgressReporter:
+    """
+    Progress of a transfer, updated with update(bytes done, bytes in total) as it goes and closed once it ends.
+    report() gets the progress at most every INTERVAL seconds, and the last progress when the transfer is done or
+    the reporter is closed. NullReporter and TqdmReporter can be created from a description of the transfer alone,
+    which is how Client.PROGRESS creates them, a SignalReporter needs the signal to emit.
+    """
+
+    INTERVAL = 0.1
+
+    def __init__(self, description: str = ""):
+        self.description = description
+        # Last progress, and the bytes done last reported
+        self.done = self.total = 0
+        self.reported = None
+        # time.monotonic() from which the next progress is reported
+        self.next_report = 0.0
+
+    def update(self, done: int, total: int) -> None:
+        self.done, self.total = done, total
+        now = time.monotonic()
+        if now >= self.next_report or done >= total:
+            self.next_report = now + self.INTERVAL
+            self.reported = done
+            self.report(done, total)
+
+    def close(self) -> None:
+        if self.reported != self.done:
+            self.reported = self.done
+            self.report(self.done, self.total)
+
+    def report(self, done: int, total: int) -> None:
+        pass
+
+
+class NullReporter(ProgressReporter):
+    """
+    Doesn't report anything
+    """
+
+    def update(self, done: int, total: int) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class TqdmReporter(ProgressReporter):
+    """
+    Progress bar on the terminal, shown from the first progress reported. Closing it closes the bar, a new one is
+    shown if it is updated again (for the next segment of an upload).
+    """
+
+    def __init__(self, description: str = "", unit: str = "B"):
+        super().__init__(description)
+        self.unit = unit
+        self.bar = None
+
+    def report(self, done: int, total: int) -> None:
+        if self.bar is None:
+            self.bar = tqdm(total=total, initial=done, desc=self.description, unit=self.unit,
+                            unit_scale=self.unit == "B")
+            return
+        self.bar.total = total
+        self.bar.update(done - self.bar.n)
+
+    def close(self) -> None:
+        super().close()
+        if self.bar is not None:
+            self.bar.close()
+            self.bar = None
+
+
+class SignalReporter(ProgressReporter):
+    """
+    Emits a Qt signal with the progress, after args: signal.emit(*args, done, total). Connected to a slot of an
+    object of the GUI thread, the slot is called from its event loop.
+    """
+
+    def __init__(self, signal, *args):
+        super().__init__()
+        self.signal = signal
+        self.args = args
+
+    def report(self, done: int, total: int) -> None:
+        self.signal.emit(*self.args, done, total)
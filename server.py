@@ -1,118 +1,832 @@
+import fnmatch
 import json
 import os
+import re
 import selectors
 import socket
-import types
+import stat
+import time
+from bisect import bisect_left
+from collections import deque
 
 import main
-from tools import receive_data, send_data, DataType, receive_file, send_file
+from compression import CODECS, codec_flags, file_codec
+from connection import Connection, Handshake, RangeConnection, StripedUpload
+from index import FileIndex
+from log import get_logger
+from metrics import ServerMetrics, serve_metrics
+from store import ChunkStore
+from throttle import consume, new_bucket, wait_time
+from tools import (BinaryFraming, DataType, DEDUP_CHUNK_SIZE, DEDUP_HASH_SIZE, FILES_PAGE_MAX, FILES_PAGE_SIZE,
+                   FILES_SORT_KEYS, HASH_ALGORITHMS, LOGIN_DEDUP, LOGIN_FILES_DELTA, LOGIN_FILES_QUERY, LOGIN_STATS,
+                   LOGIN_UPLOAD_SEGMENTS, decode_hello, login_reply, new_digest, pack_indices, unique_file_path)
+from workers import Supervisor, send_changes
+
+logger = get_logger(__name__)
 
 
 class Server:
-    def __init__(self):
+    # Seconds after which a partial upload nobody resumed is deleted
+    PARTIAL_MAX_AGE = 7 * 24 * 3600
+    # Seconds a new connection has to send its login (or range request) in before it is closed
+    LOGIN_TIMEOUT = 10
+    # Bytes of messages waiting to be sent to a client above which it gets no more changes to the server files, and
+    # its requests aren't read, until it has read enough of them to get back below LOW_WATER_MARK
+    HIGH_WATER_MARK = 4 * 1024 * 1024
+    LOW_WATER_MARK = 1024 * 1024
+
+    def __init__(self, file_chunk_size=None, dedup=False, compression=None, max_rate=None, client_rate=None,
+                 transfer_rate=None, workers=1, metrics=False, metrics_port=None):
         self.FORMAT = main.DEFAULT_FORMAT
         self.HEADERDATALEN = main.DEFAULT_HEADERDATALEN
         self.PORT = main.DEFAULT_PORT
         self.SERVER_FILES_SAVE_PATH = main.DEFAULT_SERVER_FILES_SAVE_PATH
-        self.FILE_CHUNK_SIZE = 1024
+        self.SERVER_PARTIAL_PATH = main.DEFAULT_SERVER_PARTIAL_PATH
+        self.SERVER_STORE_PATH = main.DEFAULT_SERVER_STORE_PATH
+        self.FILE_CHUNK_SIZE = file_chunk_size or main.DEFAULT_FILE_CHUNK_SIZE
+        # Whether uploads from clients supporting it are stored deduplicated in the SERVER_STORE_PATH chunk store
+        self.DEDUP = dedup
+        # Codecs downloads are compressed with when the client accepts them, in order of preference
+        self.COMPRESSION = main.DEFAULT_COMPRESSION if compression is None else compression
+        # Limits in bytes per second of the files sent to all the clients together, to each client and in each
+        # download (each range of a download over several connections), None for no limit
+        self.MAX_RATE = max_rate
+        self.CLIENT_RATE = client_rate
+        self.TRANSFER_RATE = transfer_rate
+        # Processes accepting connections on the port, each serving its own clients (see workers.py)
+        self.WORKERS = workers
+        # Port of the HTTP endpoint serving the metrics in the Prometheus text format (each worker serving on the
+        # next one), None for none. The metrics are collected if it is set or metrics is.
+        self.METRICS_PORT = metrics_port
 
         self.SERVER_IP = socket.gethostbyname(socket.gethostname())
 
         self.CLIENTS = dict()
+        # (login, transfer id) -> StripedUpload, for uploads over several data connections
+        self.transfers = dict()
+        # Transfer id -> (bytes received, digest fed with them or None) of the resumable uploads sent in segments
+        # which are waiting for their next segment, so it doesn't have to hash what was received again
+        self.segmented_uploads = dict()
+        # Listing of the server files, along with the digests known of them so downloads don't have to hash them
+        self.index = FileIndex(self.scan_files, self.stat_file)
+        # (version of the index, encoded list of the server files sent in FILES_INFO), built again once the files
+        # change
+        self.files_info = None
+        # ChunkStore of the deduplicated files, opened when the server starts if DEDUP is set
+        self.store = None
         self.selector = selectors.DefaultSelector()
+        # Rate limit of everything the server sends, and the connections with a file to send, in the order they get
+        # their next turn
+        self.send_bucket = new_bucket(max_rate)
+        self.downloads = deque()
+        # Handshakes of the connections accepted, in the order they were, until they time out
+        self.handshakes = deque()
+        # Channel to the supervisor when the server runs in several workers, and the version of the index up to
+        # which the changes to the files have been passed on to the other workers
+        self.channel = None
+        self.shared_version = None
+        # ServerMetrics, answered to STATS, None if the metrics are disabled
+        self.metrics = None
+        if metrics or metrics_port:
+            self.metrics = ServerMetrics()
+            self.add_gauges()
+
+    def add_gauges(self) -> None:
+        """
+        Adds the metrics read from the state of the server when they are collected
+        """
+
+        self.metrics.gauge("connections", "Clients logged in", function=lambda: len(self.CLIENTS))
+        self.metrics.gauge("queued_bytes", "Bytes of messages waiting to be sent to the clients",
+                           function=lambda: sum(conn.queued for conn in list(self.CLIENTS.values())))
+        self.metrics.gauge("downloads", "Connections with a file to send", function=lambda: len(self.downloads))
+        self.metrics.gauge("handshakes", "Connections which haven't sent their login yet",
+                           function=lambda: sum(not handshake.done for handshake in self.handshakes))
 
-    # TODO: Use threading for file transfer so app doesnt freeze
-    # TODO: Check file hash to ensure file integrity
     def handle_client(self, key: selectors.SelectorKey, mask: int):
-        conn: socket.socket = key.fileobj
+        conn: Connection = key.data
 
         if mask & selectors.EVENT_READ:
-            data_type = int(receive_data(conn, 1).decode(self.FORMAT))
-
-            if data_type == DataType.DISCONNECT:
+            if not conn.receive():
                 self.close_client(conn)
+                return
 
-            match data_type:
-                case DataType.DEBUG:
-                    # Debug message
-                    data_length = int(receive_data(conn, self.HEADERDATALEN).decode(self.FORMAT))
-                    if data_length:
-                        debug_message = receive_data(conn, data_length).decode(self.FORMAT)
-                        print(f"[DEBUG] {debug_message}")
+        if mask & selectors.EVENT_WRITE:
+            conn.blocked = False
+            if conn.waiting_since is not None:
+                self.metrics.wait_seconds.inc(time.monotonic() - conn.waiting_since, ("send",))
+                conn.waiting_since = None
+            conn.flush()
 
-                case DataType.COMMAND:
-                    # Command
-                    data_length = int(receive_data(conn, self.HEADERDATALEN).decode(self.FORMAT))
-                    if data_length:
-                        command = receive_data(conn, data_length).decode(self.FORMAT)
-                        print(f"[COMMAND] {command}")
+    def handle_message(self, conn: Connection, data_type: int, fields: list[bytes]):
+        """
+        Handles a message once the connection's parser has received all of it
+        """
 
-                case DataType.UPLOAD_FILE:
-                    print("[DEBUG] Receiving file")
+        if self.metrics is not None:
+            self.metrics.messages.inc(1, (data_type.name,))
 
-                    file_name_size = int(receive_data(conn, self.HEADERDATALEN).decode(self.FORMAT))
-                    file_name = receive_data(conn, file_name_size).decode(self.FORMAT)
+        match data_type:
+            case DataType.DEBUG:
+                # Debug message
+                if fields[0]:
+                    logger.info("Debug message from %s: %s", conn.login, fields[0].decode(self.FORMAT))
 
-                    if not os.path.exists(self.SERVER_FILES_SAVE_PATH):
-                        os.makedirs(self.SERVER_FILES_SAVE_PATH)
-                    file_path = os.path.join(self.SERVER_FILES_SAVE_PATH, file_name)
+            case DataType.COMMAND:
+                # Command
+                if fields[0]:
+                    logger.info("Command from %s: %s", conn.login, fields[0].decode(self.FORMAT))
+
+            case DataType.UPLOAD_FILE:
+                # The file has already been written to disk by the parser, under the name in fields[0]
+                logger.info("Received file: %s", fields[0].decode(self.FORMAT))
+                self.index.refresh(fields[0].decode(self.FORMAT))
+                self.send_files_info()
+
+            case DataType.UPLOAD_RESUMABLE:
+                # A segment of the file has been written. After the last one the file can leave the partial uploads,
+                # unless it still has to be checked against its FILE_DIGEST trailer
+                transfer_id = fields[0].decode(self.FORMAT)
+                if not self.segment_received(transfer_id, int(fields[2]), conn.upload_digest):
+                    return
+                if conn.upload_digest is not None:
+                    conn.pending_upload = (transfer_id, conn.upload_digest)
+                    return
+                file_path = self.complete_partial(transfer_id)
+                logger.info("Received file: %s", os.path.basename(file_path))
+                self.send_files_info()
+
+            case DataType.FILE_DIGEST:
+                file_path = self.verify_upload(conn, fields)
+                if file_path is None:
+                    conn.send_header(DataType.DEBUG, b"Upload failed the integrity check")
+                    return
+                logger.info("Received file: %s", os.path.basename(file_path))
+                self.send_files_info()
+
+            case DataType.UPLOAD_MANIFEST:
+                missing = self.receive_manifest(conn, fields)
+                if missing is None:
+                    logger.warning("Invalid manifest from %s", conn.login)
+                    self.close_client(conn)
+                    return
+                conn.send_header(DataType.CHUNKS_NEEDED, fields[0], pack_indices(missing))
+                if not missing:
+                    self.complete_manifest(conn, fields[0].decode(self.FORMAT))
+                    self.send_files_info()
 
-                    receive_file(conn, self.HEADERDATALEN, self.FORMAT, self.FILE_CHUNK_SIZE, file_path)
+            case DataType.UPLOAD_CHUNK:
+                completed = self.receive_chunk(conn, fields[0])
+                if completed is None:
+                    logger.warning("Unexpected chunk from %s", conn.login)
+                    self.close_client(conn)
+                elif completed:
                     self.send_files_info()
 
-                case DataType.DOWNLOAD_FILE:
-                    # Receive a hash of the file path to send it back to the client to tell it which file is being sent
-                    file_name_size = int(receive_data(conn, self.HEADERDATALEN).decode(self.FORMAT))
-                    file_name = receive_data(conn, file_name_size).decode(self.FORMAT)
+            case DataType.TRANSFER_OFFSET:
+                offset = self.partial_offset(conn.login, fields[0].decode(self.FORMAT))
+                conn.send_header(DataType.TRANSFER_OFFSET, fields[0], str(offset).encode(self.FORMAT))
 
-                    file_path_hash_size = int(receive_data(conn, self.HEADERDATALEN).decode(self.FORMAT))
-                    file_path_hash = receive_data(conn, file_path_hash_size).decode(self.FORMAT)
+            case DataType.DOWNLOAD_FILE:
+                # Send the token back to the client to tell it which file is being sent
+                file_name = fields[0].decode(self.FORMAT)
+                file_path_hash = fields[1]
+                if self.file_size(file_name) is None:
+                    self.reply_error(conn, f"File {file_name} does not exist")
+                    return
 
-                    send_data(conn, str(DataType.DOWNLOAD_FILE).encode(self.FORMAT), 1)
-                    send_data(conn, str(file_path_hash_size).encode(self.FORMAT), self.HEADERDATALEN)
-                    send_data(conn, file_path_hash.encode(self.FORMAT), len(file_path_hash))
+                codec = self.download_codec(file_name, 0, conn.flags)
+                conn.send_header(DataType.DOWNLOAD_FILE, file_path_hash, flags=codec_flags([codec]))
+                conn.send_file(file_name, codec=codec)
 
-                    file_path = os.path.join(self.SERVER_FILES_SAVE_PATH, file_name)
-                    send_file(conn, file_path, self.HEADERDATALEN, self.FORMAT, self.FILE_CHUNK_SIZE)
+            case DataType.DOWNLOAD_FROM:
+                # Send the end of the file, after the bytes the client already has
+                file_name = fields[0].decode(self.FORMAT)
+                file_size = self.file_size(file_name)
+                if file_size is None:
+                    self.reply_error(conn, f"File {file_name} does not exist")
+                    return
+                offset = min(int(fields[2]) if fields[2].isdigit() else 0, file_size)
+                algorithm = fields[3].decode(self.FORMAT)
+                if algorithm and algorithm not in HASH_ALGORITHMS:
+                    self.reply_error(conn, f"Unsupported hash algorithm {algorithm}")
+                    return
 
-                case DataType.FILES_INFO:
-                    self.send_files_info(conn)
+                codec = self.download_codec(file_name, offset, conn.flags)
+                conn.send_header(DataType.DOWNLOAD_FROM, fields[1], str(offset).encode(self.FORMAT), fields[3],
+                                 flags=codec_flags([codec]))
+                conn.send_file(file_name, offset, algorithm, codec)
 
-                case DataType.DELETE_FILE:
-                    file_name_size = int(receive_data(conn, self.HEADERDATALEN).decode(self.FORMAT))
-                    file_name = receive_data(conn, file_name_size).decode(self.FORMAT)
-                    file_path = os.path.join(self.SERVER_FILES_SAVE_PATH, file_name)
-                    if os.path.exists(file_path):
-                        os.remove(file_path)
-                        print(f"[DEBUG] Deleting file: {file_name}")
-                        self.send_files_info()
-                    else:
-                        print(f"[DEBUG] File {file_name} does not exist")
+            case DataType.DOWNLOAD_STRIPED:
+                # Tell the client the size of the file, it then requests ranges of it over data connections
+                file_name = fields[0].decode(self.FORMAT)
+                file_size = self.file_size(file_name)
+                if file_size is not None:
+                    file_size = str(file_size).encode(self.FORMAT)
+                    conn.send_header(DataType.DOWNLOAD_STRIPED, fields[1], fields[0], file_size)
+                else:
+                    self.reply_error(conn, f"File {file_name} does not exist")
 
-                case _:
-                    # Invalid data type
-                    print("Invalid data type")
+            case DataType.FILES_INFO:
+                self.send_files_info(conn)
+
+            case DataType.FILES_DELTA:
+                # The changes since the version the client has, and from now on the changes as they happen
+                conn.send_header(DataType.FILES_DELTA, self.files_delta(fields[0]).encode(self.FORMAT))
+                conn.files_version = self.index.version
+
+            case DataType.FILES_QUERY:
+                conn.send_header(DataType.FILES_QUERY, self.files_page(fields).encode(self.FORMAT))
+
+            case DataType.DELETE_FILE:
+                file_name = fields[0].decode(self.FORMAT)
+                if self.delete_file(file_name):
+                    logger.info("Deleting file: %s", file_name)
+                    # Clients matching answers to their requests get the deletion acknowledged
+                    if conn.framing.request_ids:
+                        conn.send_header(DataType.DELETE_FILE, fields[0])
+                    self.send_files_info()
+                else:
+                    self.reply_error(conn, f"File {file_name} does not exist")
+
+            case DataType.STATS:
+                if self.metrics is None:
+                    self.reply_error(conn, "Metrics are disabled")
                     return
+                conn.send_header(DataType.STATS, json.dumps(self.metrics.snapshot()).encode(self.FORMAT))
 
-    def send_files_info(self, conn=None):
+    def download_codec(self, file_name: str, offset: int, flags: int):
+        """
+        Returns the codec to send a file from offset on with, among those whose flag the client set in the flags of
+        its request, None to send it as it is. Files which look already compressed are sent as they are.
+        """
+
+        segments = [segment for segment in self.file_segments(file_name, offset) if segment[2]]
+        return file_codec(self.COMPRESSION, flags, segments[0][0], segments[0][1]) if segments else None
+
+    def reply_error(self, conn, message: str) -> None:
+        """
+        Answers a request which can't be served with a DEBUG message, failing the request on the client
+        """
+
+        logger.info("Request of %s failed: %s", conn.login, message)
+        conn.send_header(DataType.DEBUG, message.encode(self.FORMAT))
+
+    def open_upload(self, file_name: str):
+        """
+        Opens the file an upload is written to, without overwriting existing files
+        """
+
+        logger.debug("Receiving file: %s", file_name)
+        return open(self.upload_path(file_name), "wb")
+
+    def upload_path(self, file_name: str) -> str:
+        """
+        Returns the path an upload is saved to, without overwriting existing files
+        """
+
+        if not os.path.exists(self.SERVER_FILES_SAVE_PATH):
+            os.makedirs(self.SERVER_FILES_SAVE_PATH)
+        return os.path.join(self.SERVER_FILES_SAVE_PATH, self.unique_name(file_name))
+
+    def unique_name(self, file_name: str) -> str:
+        """
+        Returns file_name, or "name (n).ext" if there already is a server file, stored as is or deduplicated, with
+        that name
+        """
+
+        file_path = unique_file_path(os.path.join(self.SERVER_FILES_SAVE_PATH, file_name),
+                                     lambda path: self.file_size(os.path.basename(path)) is not None)
+        return os.path.basename(file_path)
+
+    def file_size(self, file_name: str):
+        """
+        Returns the size of a server file, None if there is no such file
+        """
+
+        if self.store is not None and file_name in self.store.manifests:
+            return self.store.manifests[file_name]["size"]
+        file_path = os.path.join(self.SERVER_FILES_SAVE_PATH, file_name)
+        return os.path.getsize(file_path) if os.path.exists(file_path) else None
+
+    def file_segments(self, file_name: str, offset: int = 0, length: int = None) -> list[tuple[str, int, int]]:
+        """
+        Returns the (file path, offset, count) pieces making up length bytes (by default all of them) of a server
+        file from offset on. A deduplicated file is made of pieces of its chunks, other files of a single piece.
+        """
+
+        file_size = self.file_size(file_name)
+        offset = min(offset, file_size)
+        length = file_size - offset if length is None else min(length, file_size - offset)
+        if self.store is not None and file_name in self.store.manifests:
+            return self.store.segments(file_name, offset, length)
+        return [(os.path.join(self.SERVER_FILES_SAVE_PATH, file_name), offset, length)]
+
+    def pin_file(self, file_name: str) -> list[str]:
+        """
+        Keeps the chunks of a deduplicated server file from being deleted while it is sent, even if the file is
+        deleted meanwhile. Returns the chunks to give to release_file() once the file has been sent.
+        """
+
+        if self.store is None or file_name not in self.store.manifests:
+            return []
+        chunks = self.store.manifests[file_name]["chunks"]
+        self.store.pin(chunks)
+        return chunks
+
+    def release_file(self, chunks: list[str]) -> None:
+        if chunks:
+            self.store.release(chunks)
+
+    def stored_path(self, file_name: str) -> str:
+        """
+        Returns the path of the file a server file is stored in, its manifest if it is deduplicated
+        """
+
+        if self.store is not None and file_name in self.store.manifests:
+            return self.store.manifest_path(file_name)
+        return os.path.join(self.SERVER_FILES_SAVE_PATH, file_name)
+
+    def delete_file(self, file_name: str) -> bool:
+        """
+        Deletes a server file, returns False if there is no such file
+        """
+
+        if self.store is not None and file_name in self.store.manifests:
+            self.store.remove_file(file_name)
+        elif os.path.exists(os.path.join(self.SERVER_FILES_SAVE_PATH, file_name)):
+            os.remove(os.path.join(self.SERVER_FILES_SAVE_PATH, file_name))
+        else:
+            return False
+        self.index.refresh(file_name)
+        return True
+
+    def stat_file(self, file_name: str):
+        """
+        Returns the (size, modification time) of a server file, None if there is no such file
+        """
+
+        try:
+            file_stat = os.stat(self.stored_path(file_name))
+        except OSError:
+            return None
+        if self.store is not None and file_name in self.store.manifests:
+            return self.store.manifests[file_name]["size"], file_stat.st_mtime_ns
+        if not stat.S_ISREG(file_stat.st_mode):
+            return None
+        return file_stat.st_size, file_stat.st_mtime_ns
+
+    def scan_files(self) -> dict[str, tuple[int, int]]:
+        """
+        Returns the (size, modification time) of every server file by name
+        """
+
+        files = dict()
+        if self.store is not None:
+            for file_name in list(self.store.manifests):
+                file_stat = self.stat_file(file_name)
+                if file_stat is not None:
+                    files[file_name] = file_stat
+        if os.path.isdir(self.SERVER_FILES_SAVE_PATH):
+            with os.scandir(self.SERVER_FILES_SAVE_PATH) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_file():
+                            file_stat = entry.stat()
+                            files[entry.name] = (file_stat.st_size, file_stat.st_mtime_ns)
+                    except OSError:
+                        pass
+        return files
+
+    def partial_paths(self, transfer_id: str) -> tuple[str, str]:
+        """
+        Returns the paths of the data received so far and of the description of a partial upload
+        """
+
+        path = os.path.join(self.SERVER_PARTIAL_PATH, transfer_id)
+        return path + ".part", path + ".json"
+
+    def striped_path(self, transfer_id: str):
+        """
+        Returns the path of the partial file an upload over several connections is written to, None if the
+        transfer id is invalid
+        """
+
+        # Like those of the resumable uploads, the transfer ids mustn't point outside of the partial uploads
+        if not transfer_id.isascii() or not transfer_id.isalnum():
+            return None
+        os.makedirs(self.SERVER_PARTIAL_PATH, exist_ok=True)
+        return os.path.join(self.SERVER_PARTIAL_PATH, transfer_id + ".striped")
+
+    def partial_info(self, transfer_id: str):
+        """
+        Returns the description of a partial upload (login, file name and size), None if there is none
+        """
+
+        # Transfer ids are generated by the clients, make sure they can't point outside of the partial uploads
+        if not transfer_id.isascii() or not transfer_id.isalnum():
+            return None
+        try:
+            with open(self.partial_paths(transfer_id)[1]) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def partial_offset(self, login: str, transfer_id: str) -> int:
+        """
+        Returns the number of bytes received of a partial upload of login, from where the upload can resume
+        """
+
+        info = self.partial_info(transfer_id)
+        if info is None or info["login"] != login:
+            return 0
+        try:
+            return os.path.getsize(self.partial_paths(transfer_id)[0])
+        except OSError:
+            return 0
+
+    def open_partial(self, login: str, fields: list[bytes], length: int):
+        """
+        Opens the partial file a resumable upload is written to, positioned at the offset the client continues
+        from, and the digest to hash it with if the client asked for one (already fed with the bytes before the
+        offset). Returns Nones if the upload can't continue from there.
+        """
+
+        transfer_id, file_name, algorithm = (fields[i].decode(self.FORMAT) for i in (0, 1, 4))
+        try:
+            file_size, offset = int(fields[2]), int(fields[3])
+        except ValueError:
+            return None, None
+        if not transfer_id.isascii() or not transfer_id.isalnum() or offset < 0 or offset + length > file_size:
+            return None, None
+        if algorithm and algorithm not in HASH_ALGORITHMS:
+            return None, None
+
+        data_path, info_path = self.partial_paths(transfer_id)
+        info = self.partial_info(transfer_id)
+        if info is not None and info["login"] != login:
+            return None, None
+
+        received, digest = self.segmented_uploads.pop(transfer_id, (None, None))
+        if not offset:
+            logger.debug("Receiving file: %s", file_name)
+            os.makedirs(self.SERVER_PARTIAL_PATH, exist_ok=True)
+            with open(info_path, "w") as file:
+                json.dump({"login": login, "file_name": file_name, "file_size": file_size}, file)
+            return open(data_path, "wb"), new_digest(algorithm) if algorithm else None
+
+        if info is None or info["file_size"] != file_size or offset > self.partial_offset(login, transfer_id):
+            return None, None
+        file = open(data_path, "r+b")
+        file.truncate(offset)
+        file.seek(offset)
+        if received == offset and (digest.name if digest is not None else "") == algorithm:
+            # Next segment of the upload
+            return file, digest
+        logger.info("Resuming upload of %s at %d bytes", file_name, offset)
+        return file, new_digest(algorithm, [(data_path, 0, offset)], self.FILE_CHUNK_SIZE) if algorithm else None
+
+    def segment_received(self, transfer_id: str, file_size: int, digest) -> bool:
+        """
+        Called when a segment of a resumable upload has been written, returns whether it was the last one.
+        Otherwise the upload waits for the next segment, along with its digest.
+        """
+
+        received = os.path.getsize(self.partial_paths(transfer_id)[0])
+        if received >= file_size:
+            return True
+        self.segmented_uploads[transfer_id] = (received, digest)
+        return False
+
+    def complete_partial(self, transfer_id: str, digest=None) -> str:
+        """
+        Moves a completed upload to the server files, returns its path
+        """
+
+        self.segmented_uploads.pop(transfer_id, None)
+        data_path, info_path = self.partial_paths(transfer_id)
+        file_path = self.upload_path(self.partial_info(transfer_id)["file_name"])
+        os.replace(data_path, file_path)
+        os.remove(info_path)
+        self.index.refresh(os.path.basename(file_path))
+        if digest is not None:
+            self.cache_digest(os.path.basename(file_path), digest.name, digest.digest())
+        return file_path
+
+    def discard_partial(self, transfer_id: str) -> None:
+        self.segmented_uploads.pop(transfer_id, None)
+        for path in self.partial_paths(transfer_id):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def verify_upload(self, conn, fields: list[bytes]):
+        """
+        Checks the FILE_DIGEST trailer of a resumable upload against the digest computed while receiving it.
+        Completes the upload and returns its path if they match, deletes it and returns None otherwise.
+        """
+
+        if conn.pending_upload is None:
+            logger.warning("Unexpected file digest from %s", conn.login)
+            return None
+        transfer_id, digest = conn.pending_upload
+        conn.pending_upload = None
+
+        if fields[0].decode(self.FORMAT) == digest.name and fields[1] == digest.digest():
+            return self.complete_partial(transfer_id, digest)
+        logger.warning("Upload of %s corrupted, deleting it", self.partial_info(transfer_id)["file_name"])
+        self.discard_partial(transfer_id)
+        return None
+
+    def cached_digest(self, file_name: str, algorithm: str):
+        """
+        Returns the digest of a server file if it is known and the file hasn't changed since, None otherwise
+        """
+
+        entry = self.index.refresh(file_name)
+        return entry.digests.get(algorithm) if entry is not None else None
+
+    def cache_digest(self, file_name: str, algorithm: str, digest: bytes) -> None:
+        entry = self.index.refresh(file_name)
+        if entry is not None:
+            entry.digests[algorithm] = digest
+
+    def receive_manifest(self, conn, fields: list[bytes]):
+        """
+        Registers the manifest of a deduplicated upload, returns the indices of the chunks the store doesn't have,
+        None if the manifest is invalid. The upload completes once they have all been received.
+        """
+
+        if self.store is None:
+            return None
+        transfer_id, file_name = (field.decode(self.FORMAT) for field in fields[:2])
+        try:
+            file_size = int(fields[2])
+        except ValueError:
+            return None
+        hashes = fields[3]
+        chunks = [hashes[i:i + DEDUP_HASH_SIZE].hex() for i in range(0, len(hashes), DEDUP_HASH_SIZE)]
+        if len(hashes) % DEDUP_HASH_SIZE or len(chunks) != -(-file_size // DEDUP_CHUNK_SIZE):
+            return None
+        if transfer_id in conn.pending_manifests:
+            # Sent again to continue an upload which was paused, the chunks received since count
+            self.store.unpin(conn.pending_manifests.pop(transfer_id)[2])
+
+        # Chunks are pinned until the upload completes, so deleting another file can't remove the ones it reuses
+        self.store.pin(chunks)
+        missing = self.store.missing_chunks(chunks)
+        conn.pending_manifests[transfer_id] = (file_name, file_size, chunks, {chunks[index] for index in missing})
+        logger.debug("Receiving deduplicated file: %s, %d/%d chunks needed", file_name, len(missing), len(chunks))
+        return missing
+
+    def receive_chunk(self, conn, data: bytes):
+        """
+        Stores a chunk of the deduplicated uploads of a connection, returns the names of the files it completed,
+        None if none of them needed it
+        """
+
+        chunk_hash = self.store.chunk_hash(data) if self.store is not None else None
+        transfer_ids = [transfer_id for transfer_id, (_, _, _, needed) in conn.pending_manifests.items()
+                        if chunk_hash in needed]
+        if not transfer_ids:
+            return None
+
+        self.store.put_chunk(data, chunk_hash)
+        completed = []
+        for transfer_id in transfer_ids:
+            needed = conn.pending_manifests[transfer_id][3]
+            needed.discard(chunk_hash)
+            if not needed:
+                completed.append(self.complete_manifest(conn, transfer_id))
+        return completed
+
+    def complete_manifest(self, conn, transfer_id: str) -> str:
+        """
+        Saves a deduplicated upload whose chunks have all been received, returns its name
+        """
+
+        file_name, file_size, chunks, _ = conn.pending_manifests.pop(transfer_id)
+        file_name = self.unique_name(file_name)
+        self.store.add_file(file_name, file_size, chunks)
+        self.index.refresh(file_name)
+        logger.info("Received file: %s", file_name)
+        return file_name
+
+    def drop_manifests(self, conn) -> None:
         """
-        Sends information about the files stored on the server to the clients.
+        Abandons the deduplicated uploads of a connection, the chunks received so far are kept for a while so
+        uploading the file again doesn't send them again
         """
 
-        print("[DEBUG] Sending files info")
-        data = str(self.get_server_files_info()).encode(self.FORMAT)
-        data_size = len(data)
-        data_size_info = str(data_size).encode(self.FORMAT)
+        if self.store is not None:
+            for _, _, chunks, _ in conn.pending_manifests.values():
+                self.store.unpin(chunks)
+        conn.pending_manifests.clear()
+
+    def open_storage(self, clean: bool = True) -> None:
+        """
+        Opens the chunk store if deduplication is enabled, deletes what abandoned uploads left behind unless clean
+        is False, and indexes the server files
+        """
+
+        if self.DEDUP and self.store is None:
+            self.store = ChunkStore(self.SERVER_STORE_PATH)
+        if clean:
+            if self.store is not None:
+                self.store.remove_stale_chunks(self.PARTIAL_MAX_AGE)
+            self.remove_stale_partials()
+
+        os.makedirs(self.SERVER_FILES_SAVE_PATH, exist_ok=True)
+        self.index.watch(self.SERVER_FILES_SAVE_PATH)
+        self.index.rescan()
+
+    def remove_stale_partials(self) -> None:
+        """
+        Deletes the partial uploads which haven't been resumed for PARTIAL_MAX_AGE seconds
+        """
+
+        if not os.path.isdir(self.SERVER_PARTIAL_PATH):
+            return
+        for file_name in os.listdir(self.SERVER_PARTIAL_PATH):
+            file_path = os.path.join(self.SERVER_PARTIAL_PATH, file_name)
+            if time.time() - os.path.getmtime(file_path) > self.PARTIAL_MAX_AGE:
+                os.remove(file_path)
+
+    def login_flags(self) -> int:
+        """
+        Returns the LOGIN_* flags of the features the server supports, with the flags of the codecs it can receive
+        uploads with
+        """
+
+        flags = LOGIN_FILES_DELTA | LOGIN_FILES_QUERY | LOGIN_UPLOAD_SEGMENTS | LOGIN_STATS | codec_flags(CODECS)
+        return flags | (LOGIN_DEDUP if self.store is not None else 0)
+
+    def send_files_info(self, conn=None):
+        """
+        Sends information about the files stored on the server to a client, or the changes to them to all clients
+        """
 
         if conn is not None:
-            send_data(conn, str(DataType.FILES_INFO).encode(self.FORMAT), 1)
-            send_data(conn, data_size_info, self.HEADERDATALEN)
-            send_data(conn, data, data_size)
+            logger.debug("Sending files info")
+            conn.send_header(DataType.FILES_INFO, self.files_info_data())
         else:
-            for client in self.CLIENTS.values():
-                send_data(client, str(DataType.FILES_INFO).encode(self.FORMAT), 1)
-                send_data(client, data_size_info, self.HEADERDATALEN)
-                send_data(client, data, data_size)
+            self.share_changes()
+            for client, message in self.files_broadcast():
+                client.send(message)
+
+    def share_changes(self) -> None:
+        """
+        Tells the other workers about the changes to the server files since the last time
+        """
+
+        if self.channel is None or self.shared_version == self.index.version:
+            return
+        send_changes(self.channel, self.index.changes_since(self.shared_version))
+        self.shared_version = self.index.version
+
+    def handle_channel(self) -> None:
+        """
+        Handles a message from the supervisor
+        """
+
+        received = self.channel.receive()
+        if received is None:
+            # The supervisor exited, the workers go with it
+            raise SystemExit
+        message, fds = received
+        match message["type"]:
+            case "changed":
+                # Another worker changed these files, after what this one changed itself is passed on
+                self.share_changes()
+                file_names = message["files"]
+                if file_names is None:
+                    if self.store is not None:
+                        self.store = ChunkStore(self.SERVER_STORE_PATH)
+                        self.store.shared = True
+                    changed = self.index.rescan()
+                else:
+                    if self.store is not None:
+                        for file_name in file_names:
+                            self.store.reload(file_name)
+                    changed = self.index.update(file_names)
+                self.shared_version = self.index.version
+                if changed:
+                    self.send_files_info()
+
+            case "range":
+                conn = socket.socket(fileno=fds[0])
+                try:
+                    addr = conn.getpeername()
+                except OSError:
+                    conn.close()
+                    return
+                fields = [field.encode(self.FORMAT) for field in message["fields"]]
+                self.accept_range(conn, addr, message["data_type"], fields, BinaryFraming(message["version"]),
+                                  forwarded=True)
+
+    def files_broadcast(self, clients=None) -> list:
+        """
+        Returns the (client, message) pairs telling the clients (all of them by default) about the changes to the
+        server files: FILES_DELTA for the clients keeping a copy of the list, the whole list in FILES_INFO for the
+        others. Each message is only built and encoded once per framing in use, and shared by all the clients it is
+        queued for.
+        A client with more than HIGH_WATER_MARK bytes waiting to be sent is skipped, it is sent all that it missed
+        in a single message once it has caught up, instead of every change in between.
+        """
+
+        messages = {}
+        broadcast = []
+        for client in list(self.CLIENTS.values()) if clients is None else clients:
+            since = client.files_version
+            if since == self.index.version:
+                continue
+            if client.queued > self.HIGH_WATER_MARK:
+                client.files_stale = True
+                continue
+            client.files_stale = False
+            key = (client.framing.version, since)
+            if key not in messages:
+                if since is None:
+                    logger.debug("Sending files info")
+                    data_type, data = DataType.FILES_INFO, self.files_info_data()
+                else:
+                    data_type, data = DataType.FILES_DELTA, self.files_delta(since).encode(self.FORMAT)
+                messages[key] = client.framing.encode_message(data_type, [data])
+            if since is not None:
+                client.files_version = self.index.version
+            broadcast.append((client, messages[key]))
+        return broadcast
+
+    def catch_up_files(self, conn: Connection) -> None:
+        """
+        Sends a client which was too far behind the changes to the server files it missed
+        """
+
+        for client, message in self.files_broadcast([conn]):
+            client.send(message)
+
+    def files_delta(self, since) -> str:
+        """
+        Returns the changes to the server files since a version of the list (an int, or the bytes of a FILES_DELTA
+        request), or all of them if the changes since then aren't known:
+
+        {
+            version: int,
+            since: int, or None if files is the whole list,
+            files: [{file_name: str, file_size: int}] added or changed,
+            removed: [str]
+        }
+        """
+
+        if isinstance(since, bytes):
+            since = int(since) if since.isdigit() else None
+        file_names = self.index.changes_since(since)
+        if file_names is None:
+            since, file_names = None, self.index.files
+        files = [{"file_name": file_name, "file_size": self.index.files[file_name].size}
+                 for file_name in file_names if file_name in self.index.files]
+        removed = [file_name for file_name in file_names if file_name not in self.index.files]
+        return json.dumps({"version": self.index.version, "since": since, "files": files, "removed": removed})
+
+    def files_page(self, fields: list[bytes]) -> str:
+        """
+        Answers a FILES_QUERY, taken from the sorted index so only the files of the page are looked at unless they
+        are filtered by a glob:
+
+        {
+            version: int, version of the list the page is from,
+            offset: int, limit: int, pattern: str, sort: str, the query,
+            total: int, number of files matching the pattern,
+            files: [{file_name: str, file_size: int}]
+        }
+        """
+
+        offset, limit = (int(field) if field.isdigit() else None for field in fields[:2])
+        offset = offset or 0
+        limit = min(FILES_PAGE_SIZE if limit is None else limit, FILES_PAGE_MAX)
+        pattern, sort = (field.decode(self.FORMAT) for field in fields[2:])
+        key = sort.removeprefix("-")
+        if key not in FILES_SORT_KEYS:
+            sort = key = "name"
+
+        values = self.index.sorted_files(key)
+        if any(character in pattern for character in "*?["):
+            match = re.compile(fnmatch.translate(pattern)).match
+            values = [value for value in values if match(value[-1])]
+        elif pattern and key == "name":
+            # The names starting with the prefix are next to each other
+            start = bisect_left(values, (pattern,))
+            values = values[start:bisect_left(values, (pattern + chr(0x10FFFF),), start)]
+        elif pattern:
+            values = [value for value in values if value[-1].startswith(pattern)]
+
+        total = len(values)
+        if sort.startswith("-"):
+            page = values[max(total - offset - limit, 0):max(total - offset, 0)][::-1]
+        else:
+            page = values[offset:offset + limit]
+        files = [{"file_name": value[-1], "file_size": self.index.files[value[-1]].size} for value in page]
+        return json.dumps({"version": self.index.version, "offset": offset, "limit": limit, "pattern": pattern,
+                           "sort": sort, "total": total, "files": files})
 
     def get_server_files_info(self):
         """
@@ -120,39 +834,115 @@ class Server:
         """
 
         files_info = []
-        if os.path.exists(self.SERVER_FILES_SAVE_PATH):
-            for file_name in os.listdir(self.SERVER_FILES_SAVE_PATH):
-                file_path = os.path.join(self.SERVER_FILES_SAVE_PATH, file_name)
-                file_size = os.path.getsize(file_path)
-                files_info.append({
-                    "file_name": file_name,
-                    "file_size": file_size
-                })
+        for file_name, entry in self.index.files.items():
+            files_info.append({
+                "file_name": file_name,
+                "file_size": entry.size
+            })
         return json.dumps(files_info)
 
+    def files_info_data(self) -> bytes:
+        """
+        Returns the list of the server files (see get_server_files_info()) encoded, only built again when the index
+        changed since the last time
+        """
+
+        if self.files_info is None or self.files_info[0] != self.index.version:
+            self.files_info = (self.index.version, self.get_server_files_info().encode(self.FORMAT))
+        return self.files_info[1]
+
     def start(self):
         """
         Starts the server and listens for incoming connections.
+        With several workers, this process supervises them until they have all exited.
+        """
+
+        if self.WORKERS > 1:
+            # Cleaned up once for all the workers, before they open the storage
+            if self.DEDUP:
+                ChunkStore(self.SERVER_STORE_PATH).remove_stale_chunks(self.PARTIAL_MAX_AGE)
+            self.remove_stale_partials()
+            Supervisor(self, self.WORKERS).run()
+        else:
+            self.run()
+
+    def run(self, channel=None, worker: int = 0):
+        """
+        Accepts and serves clients in this process, as one of the workers if it has a channel to their supervisor
         """
 
-        print(f"Starting server on {self.SERVER_IP}:{self.PORT}")
+        if channel is not None:
+            # The selector created before the workers were forked would be shared with the other workers
+            self.selector.close()
+            self.selector = selectors.DefaultSelector()
+            self.channel = channel
+            self.index.shard(worker, self.WORKERS)
+        self.open_storage(clean=channel is None)
+        if self.store is not None:
+            self.store.shared = channel is not None
+        self.shared_version = self.index.version
+        if self.METRICS_PORT:
+            serve_metrics(self.METRICS_PORT + worker, self.metrics)
+        logger.info("Starting server on %s:%d", self.SERVER_IP, self.PORT)
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as listener_socket:
             listener_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if channel is not None:
+                # Each worker listens on the port, the kernel spreads the connections between them
+                listener_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             listener_socket.bind((self.SERVER_IP, self.PORT))
             listener_socket.listen()
-            print(f"Listening on {self.SERVER_IP}:{self.PORT}")
+            logger.info("Listening on %s:%d", self.SERVER_IP, self.PORT)
             self.selector.register(listener_socket, selectors.EVENT_READ)
+            if self.index.watcher is not None:
+                self.selector.register(self.index.watcher, selectors.EVENT_READ, data=self.index)
+            if channel is not None:
+                self.selector.register(channel, selectors.EVENT_READ, data=channel)
 
             while True:
-                events = self.selector.select(timeout=None)
+                timeouts = (self.index.timeout(), self.send_timeout(), self.handshake_timeout())
+                events = self.selector.select(timeout=min(timeout for timeout in timeouts if timeout is not None))
+                started = time.perf_counter()
                 for key, mask in events:
                     if key.data is None:
                         self.accept_connection(key.fileobj)
+                    elif isinstance(key.data, Handshake):
+                        self.handle_handshake(key.data)
+                    elif key.data is self.index:
+                        self.handle_index_events(key.fileobj)
+                    elif key.data is self.channel:
+                        self.handle_channel()
                     else:
                         try:
                             self.handle_client(key, mask)
-                        except ConnectionResetError:
-                            self.close_client(key.fileobj)
+                        except ConnectionError:
+                            self.close_client(key.data)
+                        except (ValueError, OSError):
+                            # Like a field which isn't UTF-8, or a file which can't be read: only this client is
+                            # disconnected
+                            logger.exception("Error handling a message from %s", key.data.login)
+                            self.close_client(key.data)
+                self.expire_handshakes()
+                if self.index.poll():
+                    self.send_files_info()
+                # Messages received while the supervisor was being asked something
+                while self.channel is not None and self.channel.pending:
+                    self.handle_channel()
+                self.send_downloads()
+                if self.metrics is not None:
+                    self.metrics.loop_seconds.observe(time.perf_counter() - started)
+
+    def handle_index_events(self, watcher) -> None:
+        """
+        Updates the index with the changes made to the files directory, and tells the clients about them
+        """
+
+        changed = self.index.read_events()
+        if self.index.watcher is None:
+            # The watch was lost, the files are rescanned periodically from now on
+            self.selector.unregister(watcher)
+            watcher.close()
+        if changed:
+            self.send_files_info()
 
     def restart(self) -> None:
         """
@@ -165,42 +955,279 @@ class Server:
         for client in self.CLIENTS.values():
             client.close()
         self.CLIENTS.clear()
+        for handshake in self.handshakes:
+            if not handshake.done:
+                handshake.close()
+        self.handshakes.clear()
 
         self.start()
-        print("Server restarted")
+        logger.info("Server restarted")
 
     def accept_connection(self, listener_socket: socket.socket) -> None:
         """
-        Accepts a new connection from a client.
+        Accepts a new connection from a client, which is served once it has sent its first message
         """
 
         conn, addr = listener_socket.accept()
-        data = types.SimpleNamespace(addr=addr)
-        events = selectors.EVENT_READ | selectors.EVENT_WRITE
-        self.selector.register(conn, events, data=data)
+        # Answers are often written in several pieces (an acknowledgement, then the change it made to the list of
+        # files), don't let Nagle's algorithm hold the next answer back until the client acknowledges the last one.
+        # Asyncio sets this on its sockets already.
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        # From now on the connection is only ever read from or written to when the selector says it is ready, a
+        # client which connects and sends nothing can't hold up the others
+        conn.setblocking(False)
+        handshake = Handshake(conn, addr, time.monotonic() + self.LOGIN_TIMEOUT)
+        self.selector.register(conn, selectors.EVENT_READ, data=handshake)
+        self.handshakes.append(handshake)
+
+    def handle_handshake(self, handshake: Handshake) -> None:
+        """
+        Receives the first message of a connection: the login of a client, or a range request of a data connection
+        """
+
+        try:
+            if not handshake.receive():
+                return
+        except ConnectionError:
+            self.selector.unregister(handshake.sock)
+            handshake.close()
+            return
+        self.selector.unregister(handshake.sock)
+        handshake.done = True
+        conn, addr = handshake.sock, handshake.addr
+
+        # Get client name, and whether it speaks the binary framing or the original one
+        data_type, fields, framing = decode_hello(handshake.data, self.HEADERDATALEN, self.FORMAT)
+        if data_type != DataType.LOGIN:
+            self.accept_range(conn, addr, data_type, fields, framing)
+            return
+
+        try:
+            login = fields[0].decode(self.FORMAT)
+        except ValueError:
+            # UnicodeDecodeError, only this connection is closed
+            logger.warning("Invalid login from %s", addr)
+            conn.close()
+            return
+        if not self.register_login(login):
+            logger.info("%s is already connected to the server", login)
+            try:
+                conn.send(login_reply(framing, False))
+            except OSError:
+                pass
+            conn.close()
+            return
+
+        connection = Connection(self, conn, addr, login, framing)
+        connection.bucket = new_bucket(self.CLIENT_RATE)
+        connection.events = selectors.EVENT_READ
+        self.selector.register(conn, connection.events, data=connection)
+        self.CLIENTS[login] = connection
+        logger.info("%s has connected to the server from %s", login, addr)
+        connection.send(login_reply(framing, True, self.login_flags()))
+
+    def handshake_timeout(self):
+        """
+        Returns the seconds until the oldest connection still waited for times out, None if there is none
+        """
+
+        if not self.handshakes:
+            return None
+        return max(self.handshakes[0].deadline - time.monotonic(), 0)
+
+    def expire_handshakes(self) -> None:
+        """
+        Closes the connections which haven't sent their first message within LOGIN_TIMEOUT
+        """
+
+        now = time.monotonic()
+        while self.handshakes and (self.handshakes[0].done or self.handshakes[0].deadline <= now):
+            handshake = self.handshakes.popleft()
+            if not handshake.done:
+                logger.info("No login from %s within %s seconds", handshake.addr, self.LOGIN_TIMEOUT)
+                self.selector.unregister(handshake.sock)
+                handshake.close()
+
+    def register_login(self, login: str) -> bool:
+        """
+        Returns whether a login can connect, False if it already is connected (to any of the workers)
+        """
 
-        # Get client name
-        login = receive_data(conn, 64).decode(self.FORMAT).strip(' ')
         if login in self.CLIENTS:
-            print(f"{login} is already connected to the server")
-            send_data(conn, b'0', 1)
+            return False
+        return self.channel is None or self.channel.request({"type": "login", "login": login})["accepted"]
+
+    def accept_range(self, conn: socket.socket, addr, data_type: int, fields: list[bytes], framing,
+                     forwarded: bool = False) -> None:
+        """
+        Accepts a data connection carrying one range of a file uploaded or downloaded over several connections.
+        A data connection of a client served by another worker is passed on to it, through the supervisor.
+        """
+
+        try:
+            login, transfer_id, file_name = (field.decode(self.FORMAT) for field in fields[:3])
+            file_size, offset, length = (int(field) for field in fields[3:])
+        except ValueError:
+            # Missing fields, or not numbers
+            logger.warning("Invalid range request from %s", addr)
+            conn.close()
+            return
+        if login not in self.CLIENTS and self.channel is not None and not forwarded:
+            self.channel.send({"type": "range", "login": login, "data_type": data_type, "version": framing.version,
+                               "fields": [field.decode(self.FORMAT) for field in fields]}, [conn.fileno()])
+            conn.close()
+            return
+        if login not in self.CLIENTS or offset < 0 or length < 0 or offset + length > file_size:
+            logger.warning("Invalid range request from %s", addr)
             conn.close()
             return
-        send_data(conn, b'1', 1)
-        self.CLIENTS[login] = conn
-        print(f"{login} has connected to the server from {conn.getpeername()}")
 
-    def close_client(self, sock: socket.socket) -> None:
+        transfer = None
+        if data_type == DataType.UPLOAD_RANGE:
+            # The first range to arrive creates the transfer
+            key = (login, transfer_id)
+            if key not in self.transfers:
+                file_path = self.striped_path(transfer_id)
+                if file_path is None:
+                    logger.warning("Invalid range request from %s", addr)
+                    conn.close()
+                    return
+                logger.debug("Receiving file over several connections: %s", file_name)
+                self.transfers[key] = StripedUpload(file_path, file_name, file_size)
+            transfer = self.transfers[key]
+        elif self.file_size(file_name) is None:
+            logger.info("Range of %s requested, it does not exist", file_name)
+            conn.close()
+            return
+
+        conn.setblocking(False)
+        connection = RangeConnection(self, conn, addr, login, framing, offset, length, transfer)
+        connection.bucket = self.CLIENTS[login].bucket
+        connection.events = selectors.EVENT_READ
+        self.selector.register(conn, connection.events, data=connection)
+        if transfer is None:
+            connection.send_range(file_name)
+        elif not length:
+            self.finish_range(connection)
+
+    def finish_range(self, conn: RangeConnection) -> None:
         """
-        Closes and unregisters a client socket.
+        Called when an upload range has been received, completes the upload once all of its ranges have
         """
 
-        self.selector.unregister(sock)
-        sock.close()
-        for login, client in list(self.CLIENTS.items()):
-            if client == sock:
-                print(f"{login} has disconnected from the server")
-                del self.CLIENTS[login]
+        if not conn.transfer.done():
+            return
+        self.complete_transfer(conn.transfer)
+        self.send_files_info()
+
+    def complete_transfer(self, transfer: StripedUpload) -> str:
+        """
+        Moves an upload whose ranges have all been received to the server files, returns its path
+        """
+
+        self.drop_transfer(transfer)
+        file_path = self.upload_path(transfer.file_name)
+        os.replace(transfer.file_path, file_path)
+        logger.info("Received file: %s", os.path.basename(file_path))
+        self.index.refresh(os.path.basename(file_path))
+        return file_path
+
+    def drop_transfer(self, transfer: StripedUpload) -> None:
+        """
+        Forgets an upload over several connections, deleting its partial file if it was interrupted
+        """
+
+        for key, other in list(self.transfers.items()):
+            if other is transfer:
+                del self.transfers[key]
+        transfer.close()
+        if not transfer.done() and os.path.exists(transfer.file_path):
+            os.remove(transfer.file_path)
+
+    def schedule(self, conn: Connection) -> None:
+        """
+        Adds a connection with a file to send to the downloads
+        """
+
+        if not conn.scheduled:
+            conn.scheduled = True
+            self.downloads.append(conn)
+
+    def send_downloads(self) -> None:
+        """
+        Sends the files being downloaded a chunk at a time, going round the downloads so a small file isn't stuck
+        behind a large one, while their rate limits allow it. Stops when they all wait for their socket or limits,
+        or after a few rounds to get back to the other clients.
+        """
+
+        for _ in range(max(Connection.SEND_BUDGET // self.FILE_CHUNK_SIZE, 1)):
+            now = time.monotonic()
+            waiting, sent = [], []
+            while self.downloads:
+                conn = self.downloads.popleft()
+                if conn.closed or not conn.sending_file():
+                    conn.scheduled = False
+                    continue
+                buckets = (self.send_bucket, conn.bucket, conn.outbound[0].bucket)
+                if conn.blocked or wait_time(buckets, now) > 0:
+                    waiting.append(conn)
+                    continue
+                consume(buckets, conn.send_chunk())
+                sent.append(conn)
+            # The downloads which couldn't send keep their turn, ahead of those which just did
+            self.downloads.extend(waiting + sent)
+            if all(conn.blocked or conn.closed for conn in sent):
+                return
+
+    def send_timeout(self):
+        """
+        Returns the seconds until one of the downloads can send its next chunk, None if they all wait for their
+        socket
+        """
+
+        now = time.monotonic()
+        return min((wait_time((self.send_bucket, conn.bucket, conn.outbound[0].bucket), now)
+                    for conn in self.downloads if not conn.closed and not conn.blocked and conn.sending_file()),
+                   default=None)
+
+    def update_interest(self, conn: Connection) -> None:
+        """
+        Watches a connection for writability only while it has queued data to send, as an idle socket is
+        always writable and would make select() return immediately. A file is sent by send_downloads(), the
+        connection is only watched while its socket is full.
+        """
+
+        events = selectors.EVENT_READ
+        if conn.outbound and (conn.blocked or not conn.sending_file()):
+            events |= selectors.EVENT_WRITE
+            if conn.queued > self.HIGH_WATER_MARK:
+                # The client doesn't read its answers, its next requests wait until it does
+                events = selectors.EVENT_WRITE
+        if events != conn.events:
+            conn.events = events
+            self.selector.modify(conn.sock, events, data=conn)
+
+    def close_client(self, conn: Connection) -> None:
+        """
+        Closes and unregisters a client connection.
+        """
+
+        if conn.closed:
+            return
+
+        self.selector.unregister(conn.sock)
+        conn.close()
+        self.drop_manifests(conn)
+        if isinstance(conn, RangeConnection) and conn.transfer is not None and conn.remaining:
+            if not conn.transfer.closed():
+                logger.warning("Upload of %s interrupted", conn.transfer.file_name)
+                self.drop_transfer(conn.transfer)
+        if self.CLIENTS.get(conn.login) is conn:
+            logger.info("%s has disconnected from the server", conn.login)
+            del self.CLIENTS[conn.login]
+            if self.channel is not None:
+                self.channel.send({"type": "logout", "login": conn.login})
 
 if __name__ == "__main__":
     server = Server()
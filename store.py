@@ -0,0 +1,177 @@
+import hashlib
+import json
+import os
+import time
+from collections import Counter
+
+from tools import DEDUP_CHUNK_SIZE, DEDUP_HASH_SIZE
+
+
+class ChunkStore:
+    """
+    Content-addressed storage for the server files: a file is split in DEDUP_CHUNK_SIZE chunks stored once under
+    their hash, and described by a manifest listing its chunks. Identical files, or identical parts of files, are
+    only stored once whoever uploads them.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.chunks_path = os.path.join(path, "chunks")
+        self.manifests_path = os.path.join(path, "manifests")
+        os.makedirs(self.chunks_path, exist_ok=True)
+        os.makedirs(self.manifests_path, exist_ok=True)
+
+        # File name -> {"size": file size, "chunks": [chunk hashes]}
+        self.manifests = dict()
+        # Chunk hash -> number of manifests, and of uploads in progress, using the chunk
+        self.refs = Counter()
+        # Whether other processes use the store too. The chunks they are using aren't all known from this one, so
+        # chunks are then only deleted by remove_stale_chunks().
+        self.shared = False
+        for manifest_name in os.listdir(self.manifests_path):
+            with open(os.path.join(self.manifests_path, manifest_name)) as file:
+                manifest = json.load(file)
+            self.manifests[manifest_name.removesuffix(".json")] = manifest
+            self.refs.update(manifest["chunks"])
+
+    @staticmethod
+    def chunk_hash(data) -> str:
+        return hashlib.blake2b(data, digest_size=DEDUP_HASH_SIZE).hexdigest()
+
+    def chunk_path(self, chunk_hash: str) -> str:
+        # Spread the chunks over 256 directories so none of them gets huge
+        return os.path.join(self.chunks_path, chunk_hash[:2], chunk_hash)
+
+    def manifest_path(self, file_name: str) -> str:
+        return os.path.join(self.manifests_path, file_name + ".json")
+
+    def has_chunk(self, chunk_hash: str) -> bool:
+        return os.path.exists(self.chunk_path(chunk_hash))
+
+    def missing_chunks(self, chunks: list[str]) -> list[int]:
+        """
+        Returns the indices of the chunks the store doesn't have, only the first one of identical chunks
+        """
+
+        missing = []
+        seen = set()
+        for index, chunk_hash in enumerate(chunks):
+            if chunk_hash not in seen and not self.has_chunk(chunk_hash):
+                missing.append(index)
+            seen.add(chunk_hash)
+        return missing
+
+    def put_chunk(self, data, chunk_hash: str = None) -> str:
+        """
+        Stores a chunk, returns its hash (which can be given if it is already known)
+        """
+
+        chunk_hash = chunk_hash or self.chunk_hash(data)
+        chunk_path = self.chunk_path(chunk_hash)
+        if not os.path.exists(chunk_path):
+            os.makedirs(os.path.dirname(chunk_path), exist_ok=True)
+            # Write to a temporary file and rename it, so a chunk is never seen half written
+            with open(chunk_path + ".tmp", "wb") as file:
+                file.write(data)
+            os.replace(chunk_path + ".tmp", chunk_path)
+        return chunk_hash
+
+    def pin(self, chunks: list[str]) -> None:
+        """
+        Keeps chunks from being deleted while the upload or the download of a file using them is in progress
+        """
+
+        self.refs.update(chunks)
+
+    def unpin(self, chunks: list[str]) -> None:
+        # Chunks nobody uses any more are kept, so an interrupted upload doesn't have to send them again. Those
+        # which aren't used by then are deleted by remove_stale_chunks()
+        self.refs.subtract(chunks)
+        self.refs += Counter()
+
+    def add_file(self, file_name: str, file_size: int, chunks: list[str]) -> None:
+        """
+        Saves the manifest of a file whose chunks are all stored and pinned, the pins become the file's references
+        """
+
+        manifest = {"size": file_size, "chunks": chunks}
+        manifest_path = self.manifest_path(file_name)
+        with open(manifest_path + ".tmp", "w") as file:
+            json.dump(manifest, file)
+        os.replace(manifest_path + ".tmp", manifest_path)
+        self.manifests[file_name] = manifest
+
+    def remove_file(self, file_name: str) -> None:
+        """
+        Deletes the manifest of a file, and the chunks no other file uses
+        """
+
+        manifest = self.manifests.pop(file_name)
+        os.remove(self.manifest_path(file_name))
+        self.release(manifest["chunks"])
+
+    def release(self, chunks: list[str]) -> None:
+        """
+        Unpins chunks which were read from, like those of a file being downloaded, and deletes those no file uses
+        any more
+        """
+
+        self.unpin(chunks)
+        if self.shared:
+            return
+        for chunk_hash in set(chunks):
+            if not self.refs[chunk_hash] and self.has_chunk(chunk_hash):
+                os.remove(self.chunk_path(chunk_hash))
+
+    def reload(self, file_name: str) -> None:
+        """
+        Reads the manifest of a file again, after another process added or removed the file
+        """
+
+        manifest = self.manifests.pop(file_name, None)
+        if manifest is not None:
+            self.unpin(manifest["chunks"])
+        try:
+            with open(self.manifest_path(file_name)) as file:
+                manifest = json.load(file)
+        except (OSError, ValueError):
+            return
+        self.manifests[file_name] = manifest
+        self.refs.update(manifest["chunks"])
+
+    def remove_stale_chunks(self, max_age: float) -> None:
+        """
+        Deletes the chunks no file uses which are older than max_age seconds, left by abandoned uploads
+        """
+
+        for directory in os.listdir(self.chunks_path):
+            directory = os.path.join(self.chunks_path, directory)
+            for chunk_hash in os.listdir(directory):
+                chunk_path = os.path.join(directory, chunk_hash)
+                if not self.refs[chunk_hash] and time.time() - os.path.getmtime(chunk_path) > max_age:
+                    os.remove(chunk_path)
+
+    def segments(self, file_name: str, offset: int, length: int) -> list[tuple[str, int, int]]:
+        """
+        Returns the (chunk path, offset, count) pieces making up length bytes of a file from offset on
+        """
+
+        segments = []
+        index = offset // DEDUP_CHUNK_SIZE
+        offset -= index * DEDUP_CHUNK_SIZE
+        chunks = self.manifests[file_name]["chunks"]
+        while length > 0 and index < len(chunks):
+            count = min(DEDUP_CHUNK_SIZE - offset, length)
+            segments.append((self.chunk_path(chunks[index]), offset, count))
+            length -= count
+            offset = 0
+            index += 1
+        return segments
+
+    def disk_usage(self) -> int:
+        """
+        Returns the bytes used by the chunks
+        """
+
+        return sum(os.path.getsize(os.path.join(root, file_name))
+                   for root, _, file_names in os.walk(self.chunks_path) for file_name in file_names)
@@ -0,0 +1,56 @@
+import time
+
+# Tokens a bucket holds at most, in seconds of its rate: how much it can send at once after being idle
+BURST_TIME = 0.05
+
+
+class TokenBucket:
+    """
+    Limits sending to rate bytes per second. Tokens (bytes) are added at that rate, up to the burst, and sending
+    takes as many as the bytes sent. A chunk can be sent as long as the bucket isn't in debt, even if it takes more
+    tokens than there are, the next chunk then waits for the debt to be paid back.
+    """
+
+    def __init__(self, rate: float, burst: float = None):
+        self.rate = rate
+        self.burst = rate * BURST_TIME if burst is None else burst
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float = None) -> float:
+        """
+        Returns the seconds until the bucket allows sending, 0 if it does now
+        """
+
+        self.refill(time.monotonic() if now is None else now)
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def consume(self, count: int) -> None:
+        self.tokens -= count
+
+
+def new_bucket(rate):
+    """
+    Returns a TokenBucket limiting to rate bytes per second, None for no limit
+    """
+
+    return TokenBucket(rate) if rate else None
+
+
+def wait_time(buckets, now: float = None) -> float:
+    """
+    Returns the seconds until all the buckets (None for no limit) allow sending
+    """
+
+    now = time.monotonic() if now is None else now
+    return max((bucket.wait_time(now) for bucket in buckets if bucket is not None), default=0.0)
+
+
+def consume(buckets, count: int) -> None:
+    for bucket in buckets:
+        if bucket is not None:
+            bucket.consume(count)
@@ -1,7 +1,14 @@
+import hashlib
 import os
+import stat
+import struct
 from enum import IntEnum
+from socket import SHUT_RDWR
 
-from tqdm import tqdm
+from compression import BLOCK_LENGTH, MAX_BLOCK_SIZE, Compressor, Decompressor
+from log import get_logger
+
+logger = get_logger(__name__)
 
 
 class DataType(IntEnum):
@@ -12,65 +19,539 @@ class DataType(IntEnum):
     FILES_INFO = 4
     DELETE_FILE = 5
     DISCONNECT = 6
+    LOGIN = 7  # Only used by the binary framing handshake
+    UPLOAD_RANGE = 8  # First message of a data connection receiving part of an upload
+    DOWNLOAD_RANGE = 9  # First message of a data connection sending part of a download
+    DOWNLOAD_STRIPED = 10  # Download over several data connections
+    UPLOAD_RESUMABLE = 11  # Upload which can be continued from where it stopped after a disconnection
+    TRANSFER_OFFSET = 12  # Number of bytes of a resumable upload the server already has
+    DOWNLOAD_FROM = 13  # Download of the end of a file, from a given offset
+    FILE_DIGEST = 14  # Trailer following a file, with the digest of the whole file
+    UPLOAD_MANIFEST = 15  # Chunk hashes of a file to upload to a deduplicating server
+    CHUNKS_NEEDED = 16  # Chunks of an upload the deduplicating server doesn't have
+    UPLOAD_CHUNK = 17  # One chunk of a deduplicated upload
+    FILES_DELTA = 18  # Changes to the server files since a version of the list
+    FILES_QUERY = 19  # One page of the server files, sorted and filtered
+    STATS = 20  # Metrics of the server, as JSON (see metrics.py)
+
+# Number of length-prefixed fields a client sends after the data type, per data type.
+# Data types in FILE_MESSAGES are additionally followed by the file itself (size header + file bytes)
+MESSAGE_FIELDS = {
+    DataType.DEBUG: 1,  # message
+    DataType.COMMAND: 1,  # command
+    DataType.UPLOAD_FILE: 1,  # file name
+    DataType.DOWNLOAD_FILE: 2,  # file name, token echoed in the answer (the request id)
+    DataType.FILES_INFO: 0,
+    DataType.DELETE_FILE: 1,  # file name
+    DataType.DISCONNECT: 0,
+    DataType.DOWNLOAD_STRIPED: 2,  # file name, token echoed in the answer (the request id)
+    # transfer id, file name, file size, offset the upload continues from, hash algorithm (empty for none)
+    DataType.UPLOAD_RESUMABLE: 5,
+    DataType.TRANSFER_OFFSET: 1,  # transfer id
+    DataType.DOWNLOAD_FROM: 4,  # file name, token echoed in the answer, offset, hash algorithm (empty for none)
+    DataType.FILE_DIGEST: 2,  # hash algorithm, digest
+    DataType.UPLOAD_MANIFEST: 4,  # transfer id, file name, file size, DEDUP_HASH_SIZE-byte hash of every chunk
+    DataType.UPLOAD_CHUNK: 1,  # chunk
+    DataType.FILES_DELTA: 1,  # version of the list the client has (empty for none)
+    DataType.FILES_QUERY: 4,  # offset, limit, name prefix or glob (empty for all), sort key (see FILES_SORT_KEYS)
+    DataType.STATS: 0,
+}
+
+FILE_MESSAGES = {DataType.UPLOAD_FILE, DataType.UPLOAD_RESUMABLE}
+
+# Number of fields of the first message of a connection, per data type
+HELLO_FIELDS = {
+    DataType.LOGIN: 1,  # login
+    # login, transfer id, file name, file size, offset and length of the range
+    DataType.UPLOAD_RANGE: 6,
+    DataType.DOWNLOAD_RANGE: 6,
+}
+# Longest first message accepted, logins and range requests are short
+MAX_HELLO_SIZE = 65536
+
+# hashlib algorithms a transfer can be checked with
+HASH_ALGORITHMS = ("blake2b", "blake2s", "sha256", "sha1", "md5")
+
+# Files are deduplicated in chunks of DEDUP_CHUNK_SIZE bytes, identified by their DEDUP_HASH_SIZE-byte BLAKE2b hash
+DEDUP_CHUNK_SIZE = 1024 * 1024
+DEDUP_HASH_SIZE = 32
+
+# Flags of the LOGIN frame answering a binary login, telling the client what the server supports
+LOGIN_DEDUP = 0x01
+LOGIN_FILES_DELTA = 0x02
+LOGIN_FILES_QUERY = 0x04
+# Resumable uploads can be sent in several UPLOAD_RESUMABLE messages, each with the next segment of the file
+LOGIN_UPLOAD_SEGMENTS = 0x08
+# The server answers STATS, with an error if its metrics are disabled. The bits in between are the codecs' (see
+# compression.CODEC_FLAGS).
+LOGIN_STATS = 0x80
+
+# What FILES_QUERY can sort the files by, prefixed with "-" for descending order
+FILES_SORT_KEYS = ("name", "size", "mtime")
+# Default and maximum number of files in a FILES_QUERY page
+FILES_PAGE_SIZE = 100
+FILES_PAGE_MAX = 1000
+
+def new_digest(algorithm, segments=(), chunk_size=65536):
+    """
+    Returns a hashlib object for algorithm, already fed with segments, the (file path, offset, count) pieces of
+    files a transfer resumes after. Raises ValueError if the algorithm isn't supported.
+    """
+    if algorithm not in HASH_ALGORITHMS:
+        raise ValueError(f"Unsupported hash algorithm {algorithm!r}")
+    digest = hashlib.new(algorithm)
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    for file_path, offset, count in segments:
+        if not count:
+            continue
+        with open(file_path, "rb") as file:
+            file.seek(offset)
+            while count:
+                size = file.readinto(view[:min(chunk_size, count)])
+                if not size:
+                    break
+                digest.update(view[:size])
+                count -= size
+    return digest
+
+def pack_indices(indices):
+    """
+    Encodes a list of chunk indices as u32s
+    """
+    return struct.pack(f"!{len(indices)}I", *indices)
+
+def unpack_indices(data):
+    return list(struct.unpack(f"!{len(data) // 4}I", data))
+
+def split_ranges(size, count):
+    """
+    Splits size bytes in count contiguous (offset, length) ranges, dropping empty ones
+    """
+    step = -(-size // count)
+    return [(offset, min(step, size - offset)) for offset in range(0, size, step)] if size else [(0, 0)]
+
+def unique_file_path(file_path, exists=os.path.exists):
+    """
+    Returns file_path, or "name (n).ext" with the lowest free n if file_path is already taken according to exists
+    """
+    if exists(file_path):
+        file_name, file_extension = os.path.splitext(file_path)
+        n = 1
+        while exists(f"{file_name} ({n}){file_extension}"):
+            n += 1
+        file_path = f"{file_name} ({n}){file_extension}"
+    return file_path
+
+def write_at(file, data, offset):
+    """
+    Writes data at offset, with os.pwrite() where available so the file position doesn't matter.
+    The seek() fallback is only safe when a single thread writes to the file object.
+    """
+    if hasattr(os, "pwrite"):
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(file.fileno(), view, offset)
+            view = view[written:]
+            offset += written
+    else:
+        file.seek(offset)
+        file.write(data)
 
 def receive_data(socket, data_len):
-    data = b""
-    while len(data) < data_len:
-        packet = socket.recv(data_len - len(data))
-        if not packet:
+    """
+    Receives exactly data_len bytes into a single preallocated bytearray, returns None if the connection closes
+    """
+    data = bytearray(data_len)
+    view = memoryview(data)
+    received = 0
+    while received < data_len:
+        size = socket.recv_into(view[received:])
+        if not size:
             return None
-        data += packet
+        received += size
     return data
 
-def send_data(socket, data, data_len):
+def pad_data(data, data_len):
+    """
+    Pads data with spaces, or truncates it, to exactly data_len bytes
+    """
     if len(data) < data_len:
         data += b' ' * (data_len - len(data))
     elif len(data) > data_len:
         data = data[:data_len]
+    return data
+
+class Framing:
+    """
+    Original framing, still used by old clients: the data type is a single ASCII digit and every length is a
+    HEADERDATALEN-byte space-padded decimal number
+    """
+
+    version = 0
+
+    def __init__(self, HEADERDATALEN, FORMAT):
+        self.FORMAT = FORMAT
+        self.HEADERDATALEN = HEADERDATALEN
+        # Bytes starting a message, and bytes of every following length
+        self.header_size = 1
+        self.length_size = HEADERDATALEN
+        # Whether messages carry the id of the request they are or answer
+        self.request_ids = False
+
+    def encode_length(self, length):
+        return pad_data(str(length).encode(self.FORMAT), self.HEADERDATALEN)
+
+    def decode_length(self, data):
+        return int(data.decode(self.FORMAT))
+
+    def decode_header(self, data):
+        """
+        Returns the data type of a message and the length of its first field, None if it comes separately
+        """
+        data_type, _, _, length = self.decode_request_header(data)
+        return data_type, length
+
+    def decode_request_header(self, data):
+        """
+        Returns the data type of a message, its flags, the id of the request it is or answers (0 for none) and the
+        length of its first field, None if it comes separately
+        """
+        return int(data.decode(self.FORMAT)), 0, 0, None
+
+    def encode_message(self, data_type, fields, flags=0, request_id=0):
+        """
+        Encodes a data type followed by length-prefixed fields as a single buffer, so a message isn't split in
+        several small TCP segments. Flags and request ids only exist in the binary framing.
+        """
+        chunks = [str(data_type).encode(self.FORMAT)]
+        for field in fields:
+            chunks.append(self.encode_length(len(field)))
+            chunks.append(field)
+        return b"".join(chunks)
+
+
+# First bytes of a binary frame, can't be mistaken for the first character of a legacy (alphanumeric) login
+FRAME_MAGIC = b"\xfdP"
+PROTOCOL_VERSION = 2
+
+class BinaryFraming(Framing):
+    """
+    Binary framing negotiated at login: a message starts with a fixed header (magic, version, data type, flags,
+    length of the first field) and every following length is a u64.
+    From version 2 on, the header also carries the u32 id of the request the message is or answers, 0 for none.
+    """
+
+    # Header of version 1, and of the first message of every connection and the answer to a login whatever the
+    # version, as the version isn't negotiated yet
+    HEADER = struct.Struct("!2sBBBQ")
+    REQUEST_HEADER = struct.Struct("!2sBBBIQ")
+    LENGTH = struct.Struct("!Q")
+
+    def __init__(self, version=PROTOCOL_VERSION):
+        self.version = version
+        self.request_ids = version >= 2
+        self.header_size = (self.REQUEST_HEADER if self.request_ids else self.HEADER).size
+        self.length_size = self.LENGTH.size
+
+    def encode_length(self, length):
+        return self.LENGTH.pack(length)
+
+    def decode_length(self, data):
+        return self.LENGTH.unpack(data)[0]
+
+    def decode_request_header(self, data):
+        if self.request_ids:
+            magic, version, data_type, flags, request_id, length = self.REQUEST_HEADER.unpack(data)
+        else:
+            magic, version, data_type, flags, length = self.HEADER.unpack(data)
+            request_id = 0
+        if magic != FRAME_MAGIC:
+            raise ValueError("Invalid frame")
+        return data_type, flags, request_id, length
+
+    def encode_message(self, data_type, fields, flags=0, request_id=0):
+        first = fields[0] if fields else b""
+        if self.request_ids:
+            header = self.REQUEST_HEADER.pack(FRAME_MAGIC, self.version, data_type, flags, request_id, len(first))
+        else:
+            header = self.HEADER.pack(FRAME_MAGIC, self.version, data_type, flags, len(first))
+        return self.join_fields(header, fields)
+
+    def encode_hello(self, data_type, fields, flags=0):
+        """
+        Encodes the first message of a connection, or the answer to a login, with the version 1 header
+        """
+        first = fields[0] if fields else b""
+        return self.join_fields(self.HEADER.pack(FRAME_MAGIC, self.version, data_type, flags, len(first)), fields)
+
+    def join_fields(self, header, fields):
+        chunks = [header, fields[0] if fields else b""]
+        for field in fields[1:]:
+            chunks.append(self.LENGTH.pack(len(field)))
+            chunks.append(field)
+        return b"".join(chunks)
+
+
+def hello_missing(data):
+    """
+    Returns how many more bytes the first message of a connection takes after data, its first bytes, 0 once they
+    have all been received. Raises ValueError if it is invalid.
+    Binary clients start with a LOGIN frame (or a range request on data connections), old clients with their
+    login padded to 64 bytes.
+    """
+    if len(data) < len(FRAME_MAGIC):
+        return len(FRAME_MAGIC) - len(data)
+    if data[:len(FRAME_MAGIC)] != FRAME_MAGIC:
+        return 64 - len(data)
+
+    if len(data) < BinaryFraming.HEADER.size:
+        return BinaryFraming.HEADER.size - len(data)
+    _, _, data_type, _, length = BinaryFraming.HEADER.unpack_from(data)
+    if data_type not in HELLO_FIELDS:
+        raise ValueError("Invalid first message")
+    end = BinaryFraming.HEADER.size + length
+    for _ in range(HELLO_FIELDS[data_type] - 1):
+        if end > MAX_HELLO_SIZE:
+            break
+        if len(data) < end + BinaryFraming.LENGTH.size:
+            return end + BinaryFraming.LENGTH.size - len(data)
+        end += BinaryFraming.LENGTH.size + BinaryFraming.LENGTH.unpack_from(data, end)[0]
+    if end > MAX_HELLO_SIZE:
+        raise ValueError("First message too long")
+    return end - len(data)
+
+def decode_hello(data, HEADERDATALEN, FORMAT):
+    """
+    Decodes the first message of a connection once hello_missing() says it is complete, returns its data type, its
+    fields and the framing the client speaks
+    """
+    if data[:len(FRAME_MAGIC)] != FRAME_MAGIC:
+        return DataType.LOGIN, [bytes(data).strip(b' ')], Framing(HEADERDATALEN, FORMAT)
+
+    _, version, data_type, _, length = BinaryFraming.HEADER.unpack_from(data)
+    offset = BinaryFraming.HEADER.size
+    fields = []
+    for _ in range(HELLO_FIELDS[data_type]):
+        if fields:
+            length = BinaryFraming.LENGTH.unpack_from(data, offset)[0]
+            offset += BinaryFraming.LENGTH.size
+        fields.append(bytes(data[offset:offset + length]))
+        offset += length
+    return DataType(data_type), fields, BinaryFraming(min(version, PROTOCOL_VERSION))
+
+def login_reply(framing, accepted, flags=0):
+    """
+    Answer to a login, a single byte for old clients and a LOGIN frame carrying it, and the LOGIN_* flags of the
+    features the server supports, for binary ones
+    """
+    status = b'1' if accepted else b'0'
+    if framing.version:
+        return framing.encode_hello(DataType.LOGIN, [status], flags)
+    return status
+
+def receive_header(socket, framing):
+    """
+    Receives the start of a message, returns its data type and the length of its first field (or None)
+    """
+    data_type, _, _, length = receive_request_header(socket, framing)
+    return data_type, length
+
+def receive_request_header(socket, framing):
+    """
+    Receives the start of a message, returns its data type, its flags, the id of the request it is or answers (0 for
+    none) and the length of its first field (or None)
+    """
+    data = receive_data(socket, framing.header_size)
+    if data is None:
+        return None, None, None, None
+    return framing.decode_request_header(data)
+
+def receive_field(socket, framing, length=None):
+    """
+    Receives a length-prefixed field, length is given when it was already received in the message header
+    """
+    if length is None:
+        data = receive_data(socket, framing.length_size)
+        if data is None:
+            return None
+        length = framing.decode_length(data)
+    return receive_data(socket, length) if length else b""
+
+def send_data(socket, data, data_len):
+    data = pad_data(data, data_len)
 
     data_sent = 0
     while data_sent < data_len:
         data_sent += socket.send(data[data_sent:])
 
-def send_file(socket, file_path, HEADERDATALEN, FORMAT, FILE_CHUNK_SIZE):
-    # Could use socket.sendfile() but where's the fun in that?
-    print("[FILE] Started sending file: ", os.path.basename(file_path))
+def send_file(socket, file_path, framing, FILE_CHUNK_SIZE, offset=0, digest=None, length=None, progress=None,
+              codec=None):
+    """
+    Sends the size of the file followed by its content, or only what follows offset when resuming an upload, or
+    only length bytes from offset on when sending a segment of it.
+    With a digest (a hashlib object already fed with the bytes before offset), the file is hashed while it is sent
+    and followed by a FILE_DIGEST trailer once its end is sent.
+    With a codec, the content is sent in compressed blocks (see compression.py), the message before the file must
+    have its flag set.
+    progress (a ProgressReporter, see progress.py) is updated with the bytes sent as the file is sent, and closed
+    at the end.
+    """
+    logger.debug("Sending file: %s", os.path.basename(file_path))
 
-    file_size = os.path.getsize(file_path)
-    send_data(socket, str(file_size).encode(FORMAT), HEADERDATALEN)
+    with open(file_path, "rb") as file:
+        file_size = os.fstat(file.fileno()).st_size
+        end = file_size if length is None else min(offset + length, file_size)
+        socket.sendall(framing.encode_length(end - offset))
 
-    chunks = file_size // FILE_CHUNK_SIZE
-    remaining_data = file_size % FILE_CHUNK_SIZE
-    # print("[DEBUG] File size: ", file_size)
-    # print("[DEBUG] Number of chunks: ", chunks)
-    # print("[DEBUG] Remaining data: ", remaining_data)
+        try:
+            if digest is None and codec is None and stat.S_ISREG(os.fstat(file.fileno()).st_mode):
+                # Let the kernel copy the file to the socket without going through Python, socket.sendfile()
+                # falls back to send() on platforms without os.sendfile(). Hashing and compressing need the bytes in
+                # Python, so only without a digest or a codec
+                while offset < end:
+                    sent = socket.sendfile(file, offset, min(FILE_CHUNK_SIZE, end - offset))
+                    if not sent:
+                        break
+                    offset += sent
+                    if progress is not None:
+                        progress.update(offset, file_size)
+            else:
+                buffer = bytearray(FILE_CHUNK_SIZE)
+                view = memoryview(buffer)
+                compressor = Compressor(codec) if codec is not None else None
+                file.seek(offset)
+                while offset < end:
+                    size = file.readinto(view[:min(FILE_CHUNK_SIZE, end - offset)])
+                    if not size:
+                        break
+                    if digest is not None:
+                        digest.update(view[:size])
+                    socket.sendall(view[:size] if compressor is None else compressor.compress(view[:size]))
+                    offset += size
+                    if progress is not None:
+                        progress.update(offset, file_size)
+        finally:
+            if progress is not None:
+                progress.close()
 
-    with open(file_path, "rb") as file:
-        for chunk in tqdm(range(chunks + 1), desc="Sending file", unit="chunk"):
-            size = FILE_CHUNK_SIZE if chunk < chunks else remaining_data
-            file_data = file.read(size)
-            if not file_data:
-                break
-            send_data(socket, file_data, size)
-
-def receive_file(socket, HEADERDATALEN, FORMAT, FILE_CHUNK_SIZE, file_path):
-    if os.path.exists(file_path):
-        file_name, file_extension = os.path.splitext(file_path)
-        n = 1
-        while os.path.exists(f"{file_name} ({n}){file_extension}"):
-            n += 1
-        file_path = f"{file_name} ({n}){file_extension}"
+    if digest is not None and end == file_size:
+        socket.sendall(framing.encode_message(DataType.FILE_DIGEST, [digest.name.encode(), digest.digest()]))
+
+def receive_block(socket, decompressor, limit):
+    """
+    Receives and decompresses the next block of a compressed file, limit being the bytes of the file left. Returns
+    None if the connection closed, and shuts it down if the block is invalid.
+    """
+    data = receive_data(socket, BLOCK_LENGTH.size)
+    if data is None:
+        return None
+    length = BLOCK_LENGTH.unpack(data)[0]
+    try:
+        if not 0 < length <= MAX_BLOCK_SIZE:
+            raise ValueError(f"Invalid compressed block length {length}")
+        block = receive_data(socket, length)
+        return decompressor.decompress(block, limit) if block is not None else None
+    except ValueError as err:
+        logger.warning("%s, closing the connection", err)
+        socket.shutdown(SHUT_RDWR)
+        return None
+
+def receive_file(socket, framing, FILE_CHUNK_SIZE, file_path, offset=None, digest=None, progress=None, codec=None):
+    """
+    Receives a file to a new file next to file_path, or when resuming a download, the rest of a file to the partial
+    file at file_path from offset on. Returns whether the whole file was received.
+    With a digest (a hashlib object already fed with the bytes before offset), the file is hashed while it is
+    received and checked against the FILE_DIGEST trailer following it, the file is deleted if they don't match.
+    With a codec, the file comes in compressed blocks which are decompressed as they are received. If they can't
+    be, the connection is shut down as what follows can't be read.
+    progress (a ProgressReporter, see progress.py) is updated with the bytes received as the file is received, and
+    closed at the end.
+    """
+    if offset is None:
+        file_path = unique_file_path(file_path)
+        mode = "wb"
+    else:
+        mode = "r+b" if os.path.exists(file_path) else "wb"
+
+    logger.debug("Receiving file: %s", os.path.basename(file_path))
+
+    data = receive_data(socket, framing.length_size)
+    if data is None:
+        return False
+    remaining = framing.decode_length(data)
+    file_size = remaining + (offset or 0)
+
+    # Every chunk is received into the same buffer and written from it, so memory use doesn't depend on the
+    # size of the file
+    buffer = bytearray(FILE_CHUNK_SIZE)
+    view = memoryview(buffer)
+    with open(file_path, mode) as file:
+        if offset is not None:
+            file.truncate(offset)
+            file.seek(offset)
+        decompressor = Decompressor(codec) if codec is not None else None
+        try:
+            while remaining:
+                if decompressor is None:
+                    size = socket.recv_into(view[:min(FILE_CHUNK_SIZE, remaining)])
+                    data = view[:size]
+                else:
+                    data = receive_block(socket, decompressor, remaining)
+                    size = len(data) if data is not None else 0
+                if not size:
+                    break
+                if digest is not None:
+                    digest.update(data)
+                file.write(data)
+                remaining -= size
+                if progress is not None:
+                    progress.update(file_size - remaining, file_size)
+        finally:
+            if progress is not None:
+                progress.close()
+    if remaining:
+        return False
+
+    if digest is not None:
+        data_type, length = receive_header(socket, framing)
+        algorithm = receive_field(socket, framing, length) if data_type == DataType.FILE_DIGEST else None
+        expected = receive_field(socket, framing) if algorithm is not None else None
+        if expected is None:
+            # Connection closed before the trailer, the file is kept so the download can be checked when resumed
+            return False
+        if algorithm.decode() != digest.name or expected != digest.digest():
+            logger.warning("File corrupted during the transfer, deleting it: %s", os.path.basename(file_path))
+            os.remove(file_path)
+            return False
+    return True
 
-    print("[DEBUG] Receiving file: ", os.path.basename(file_path))
+def discard_file(socket, framing, FILE_CHUNK_SIZE, trailer=False, codec=None):
+    """
+    Receives a file sent like receive_file() receives them and throws it away, so the messages following it can be
+    read. trailer is whether a FILE_DIGEST trailer follows it. Returns whether the whole file was received.
+    """
+    data = receive_data(socket, framing.length_size)
+    if data is None:
+        return False
+    remaining = framing.decode_length(data)
 
-    file_size = int(receive_data(socket, HEADERDATALEN).decode(FORMAT))
+    buffer = bytearray(FILE_CHUNK_SIZE)
+    view = memoryview(buffer)
+    decompressor = Decompressor(codec) if codec is not None else None
+    while remaining:
+        if decompressor is None:
+            size = socket.recv_into(view[:min(FILE_CHUNK_SIZE, remaining)])
+        else:
+            data = receive_block(socket, decompressor, remaining)
+            size = len(data) if data is not None else 0
+        if not size:
+            return False
+        remaining -= size
 
-    chunks = file_size // FILE_CHUNK_SIZE
-    remaining_data = file_size % FILE_CHUNK_SIZE
-    with open(file_path, "wb") as file:
-        for chunk in tqdm(range(chunks + 1), desc=f"Receiving file", unit="chunk"):
-            size = FILE_CHUNK_SIZE if chunk < chunks else remaining_data
-            data = receive_data(socket, size)
-            if not data:
-                break
-            file.write(data)
\ No newline at end of file
+    if trailer:
+        data_type, length = receive_header(socket, framing)
+        if data_type != DataType.FILE_DIGEST or receive_field(socket, framing, length) is None:
+            return False
+        return receive_field(socket, framing) is not None
+    return True
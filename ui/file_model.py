@@ -0,0 +1,226 @@
+"""
+files delta (see Client.apply_files_delta):
+
+{
+    version: int,
+    since: int, or None if files is the whole list,
+    files: [
+        {
+            file_name: str,
+            file_size: int
+        }
+    ],
+    removed: [str]
+}
+"""
+from qtpy.QtCore import QAbstractListModel, QModelIndex, QRect, QSize, Qt, Signal, QEvent
+from qtpy.QtWidgets import QStyle, QStyledItemDelegate, QStyleOptionButton
+
+class FileListModel(QAbstractListModel):
+    """
+    List of the server files, one row per file. It only changes the rows the file list changes touch, and loads the
+    files a page at a time as the view is scrolled down through request_page(offset, limit) if it is given.
+    request_page() returns None when the server can't send pages, the whole list then comes through set_files().
+    """
+
+    FileNameRole = Qt.ItemDataRole.UserRole + 1
+    FileSizeRole = Qt.ItemDataRole.UserRole + 2
+
+    # Number of files requested at a time
+    PAGE_SIZE = 100
+    # Above this number of separate blocks of rows to remove, the model is reset instead
+    MAX_REMOVED_BLOCKS = 64
+
+    def __init__(self, request_page=None, parent=None):
+        super().__init__(parent)
+        self.request_page = request_page
+        self._files: list[dict] = []
+        # File name -> row
+        self._rows: dict[str, int] = {}
+        # Number of files on the server, None until the first page is received
+        self._total_files = None
+        self._loading = False
+
+    def rowCount(self, parent=QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(self._files)
+
+    def data(self, index: QModelIndex, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        file_data = self._files[index.row()]
+        match role:
+            case Qt.ItemDataRole.DisplayRole | self.FileNameRole:
+                return file_data["file_name"]
+            case self.FileSizeRole:
+                return file_data["file_size"]
+        return None
+
+    def roleNames(self) -> dict:
+        return {self.FileNameRole: b"file_name", self.FileSizeRole: b"file_size"}
+
+    def canFetchMore(self, parent=QModelIndex()) -> bool:
+        return (self.request_page is not None and not parent.isValid() and not self._loading
+                and self._total_files is not None and len(self._files) < self._total_files)
+
+    def fetchMore(self, parent=QModelIndex()) -> None:
+        self.request_files(len(self._files))
+
+    def reload(self) -> None:
+        """
+        Requests the first page of files again, the rows are replaced when it is received
+        """
+
+        self._total_files = None
+        self.request_files(0)
+
+    def request_files(self, offset: int) -> None:
+        self._loading = True
+        if self.request_page(offset, self.PAGE_SIZE) is None:
+            # No page is coming, the server sends all of its files instead and there is nothing more to fetch
+            self._loading = False
+            self._total_files = None
+
+    def set_files(self, delta: dict) -> None:
+        """
+        Applies changes to the list of the server files
+        """
+
+        removed = list(delta["removed"])
+        if delta["since"] is None:
+            listed = {file_data["file_name"] for file_data in delta["files"]}
+            removed.extend(file_name for file_name in self._rows if file_name not in listed)
+        self.remove_files(removed)
+        # While not all the pages have been loaded, new files show up when the page they are in is
+        paged = delta["since"] is not None and self._total_files is not None
+        self.update_files(delta["files"], not paged or len(self._files) >= self._total_files)
+
+    def add_page(self, page: dict) -> None:
+        """
+        Adds a page of files answering request_page()
+        """
+
+        self._loading = False
+        self._total_files = page["total"]
+        if not page["offset"]:
+            listed = {file_data["file_name"] for file_data in page["files"]}
+            self.remove_files([file_name for file_name in self._rows if file_name not in listed])
+        self.update_files(page["files"])
+
+    def update_files(self, files: list[dict], add_new: bool = True) -> None:
+        """
+        Updates the rows of files already listed, and appends the others if add_new is set
+        """
+
+        new_files = []
+        first_changed = last_changed = None
+        for file_data in files:
+            row = self._rows.get(file_data["file_name"])
+            if row is None:
+                if add_new:
+                    new_files.append(file_data)
+            elif self._files[row] != file_data:
+                self._files[row] = file_data
+                first_changed = row if first_changed is None else min(first_changed, row)
+                last_changed = row if last_changed is None else max(last_changed, row)
+
+        if first_changed is not None:
+            self.dataChanged.emit(self.index(first_changed), self.index(last_changed))
+        if new_files:
+            first = len(self._files)
+            self.beginInsertRows(QModelIndex(), first, first + len(new_files) - 1)
+            for row, file_data in enumerate(new_files, first):
+                self._files.append(file_data)
+                self._rows[file_data["file_name"]] = row
+            self.endInsertRows()
+
+    def remove_files(self, file_names: list[str]) -> None:
+        rows = sorted(self._rows[file_name] for file_name in set(file_names) if file_name in self._rows)
+        if not rows:
+            return
+
+        # Remove the rows in blocks of consecutive ones, from the last so the others don't move
+        blocks = []
+        for row in rows:
+            if blocks and blocks[-1][1] == row - 1:
+                blocks[-1][1] = row
+            else:
+                blocks.append([row, row])
+        if len(blocks) > self.MAX_REMOVED_BLOCKS:
+            removed = set(rows)
+            self.beginResetModel()
+            self._files = [file_data for row, file_data in enumerate(self._files) if row not in removed]
+            self.endResetModel()
+        else:
+            for first, last in reversed(blocks):
+                self.beginRemoveRows(QModelIndex(), first, last)
+                del self._files[first:last + 1]
+                self.endRemoveRows()
+        self._rows = {file_data["file_name"]: row for row, file_data in enumerate(self._files)}
+
+
+class FileItemDelegate(QStyledItemDelegate):
+    """
+    Paints a row of the file list with its name, its size and Download and Delete buttons. Only the visible rows
+    are ever painted, the buttons are drawn and not widgets.
+    """
+
+    download_requested = Signal(str)
+    delete_requested = Signal(str)
+
+    ROW_HEIGHT = 56
+    BUTTON_WIDTH = 90
+    BUTTON_HEIGHT = 32
+    MARGIN = 8
+
+    def button_rects(self, rect: QRect) -> list[tuple[str, QRect]]:
+        """
+        Returns the label and the rectangle of the buttons of a row
+        """
+
+        top = rect.top() + (rect.height() - self.BUTTON_HEIGHT) // 2
+        buttons = []
+        right = rect.right() - self.MARGIN
+        for label in ("Delete", "Download"):
+            buttons.append((label, QRect(right - self.BUTTON_WIDTH, top, self.BUTTON_WIDTH, self.BUTTON_HEIGHT)))
+            right -= self.BUTTON_WIDTH + self.MARGIN
+        return buttons
+
+    def paint(self, painter, option, index: QModelIndex) -> None:
+        widget = option.widget
+        style = widget.style() if widget is not None else None
+        if style is not None:
+            style.drawPrimitive(QStyle.PrimitiveElement.PE_PanelItemViewItem, option, painter, widget)
+
+        buttons = self.button_rects(option.rect)
+        text_rect = option.rect.adjusted(self.MARGIN * 2, self.MARGIN, 0, -self.MARGIN)
+        text_rect.setRight(buttons[-1][1].left() - self.MARGIN)
+        half = text_rect.height() // 2
+        file_name = option.fontMetrics.elidedText(index.data(FileListModel.FileNameRole),
+                                                  Qt.TextElideMode.ElideMiddle, text_rect.width())
+
+        painter.save()
+        painter.drawText(text_rect.adjusted(0, 0, 0, -half), Qt.AlignmentFlag.AlignVCenter, file_name)
+        painter.setOpacity(0.7)
+        painter.drawText(text_rect.adjusted(0, half, 0, 0), Qt.AlignmentFlag.AlignVCenter,
+                         f"{index.data(FileListModel.FileSizeRole)} bytes")
+        painter.restore()
+
+        if style is not None:
+            for label, rect in buttons:
+                button = QStyleOptionButton()
+                button.rect = rect
+                button.text = label
+                button.state = QStyle.StateFlag.State_Enabled | QStyle.StateFlag.State_Raised
+                style.drawControl(QStyle.ControlElement.CE_PushButton, button, painter, widget)
+
+    def sizeHint(self, option, index: QModelIndex) -> QSize:
+        return QSize(option.rect.width(), self.ROW_HEIGHT)
+
+    def editorEvent(self, event, model, option, index: QModelIndex) -> bool:
+        if event.type() == QEvent.Type.MouseButtonRelease and event.button() == Qt.MouseButton.LeftButton:
+            for label, rect in self.button_rects(option.rect):
+                if rect.contains(event.position().toPoint()):
+                    signal = self.download_requested if label == "Download" else self.delete_requested
+                    signal.emit(index.data(FileListModel.FileNameRole))
+                    return True
+        return super().editorEvent(event, model, option, index)
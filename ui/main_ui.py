@@ -4,145 +4,105 @@ import sys
 import threading
 
 from PySide6.QtWidgets import QStackedWidget
-from qtpy.QtCore import Property, Qt
-from qtpy.QtWidgets import QApplication, QWidget, QVBoxLayout, QScrollArea, QSizePolicy, QFileDialog
+from qtpy.QtCore import Qt
+from qtpy.QtWidgets import QApplication, QWidget, QVBoxLayout, QListView, QFileDialog
 import pywintypes
 from FluentQt import fTheme, Theme
-from FluentQt.common.overload import Overload
 from FluentQt.widgets import FMainWindow, FPushButton, FLineEdit
-from FluentQt.widgets.expander import FExpander
 from FluentQt.widgets.label import FLabel
-from client import Client
+from client import Client, TransferManager
+from progress import NullReporter
 from tools import DataType
+from ui.file_model import FileItemDelegate, FileListModel
 
 
-class FileWidget(FExpander):
-    def __init__(self, file_data: dict, widget_id: int, parent: 'FileList', *args, **kwargs):
-        super().__init__(*args, **kwargs, parent=parent)
-        self.parent = parent
-
-        self._file_name = ""
-        self._file_size = ""
-        self.update_data(file_data)
-        self._widget_id = widget_id
-
-        self.setExpandDirection(FExpander.ExpandDirection.NONE)
-
-        button = FPushButton("Delete", self)
-        self.headerLayout().addWidget(button)
-        button.clicked.connect(self.delete_file)
-
-        button = FPushButton("Download", self)
-        self.headerLayout().addWidget(button)
-        button.clicked.connect(self.download_file)
-
-    def update_data(self, file_data: dict):
-        self._file_name = file_data["file_name"]
-        self.setTitle(self._file_name)
-
-        self._file_size = file_data["file_size"]
-        self.setSubtitle(f"{self._file_size} bytes")
-
-    def delete_file(self):
-        self.parent.client.send(DataType.DELETE_FILE, self._file_name)
-
-    def download_file(self):
-        file_save_url, _ = QFileDialog.getSaveFileName(self, "Save File", self._file_name)
-        if file_save_url:
-            self.parent.client.download_file(self._file_name, file_save_url)
-
-    WidgetId = Property(int, lambda self: self._widget_id)
-
-"""
-files_data:
-
-[
-    {
-        file_name: str,
-        file_size: int
-    }
-]
-"""
-
 class FileList(QWidget):
     def __init__(self, client, parent: 'MainWindow'=None):
         super().__init__(parent)
         self.parent = parent
         self.client = client
-        self._files_data: list = []
-        self._file_widgets: list[FileWidget] = []
-        self._highest_file_id = 0
 
         self.setAcceptDrops(True)
 
         # Layout
         layout = QVBoxLayout(self)
 
-        scroll_area = QScrollArea(self)
-        scroll_area.setWidgetResizable(True)
-        layout.addWidget(scroll_area)
-
-        self.scroll_content = QWidget(scroll_area)
-        self.scroll_content.setSizePolicy(QSizePolicy(QSizePolicy.Policy.Preferred, QSizePolicy.Policy.Fixed))
-        scroll_area.setWidget(self.scroll_content)
+        # The view only creates and paints the rows which are visible, and asks the model for more files as it is
+        # scrolled down
+        self.model = FileListModel(self.client.query_files, self)
+        self.delegate = FileItemDelegate(self)
+        self.delegate.download_requested.connect(self.download_file)
+        self.delegate.delete_requested.connect(self.delete_file)
+
+        self.view = QListView(self)
+        self.view.setModel(self.model)
+        self.view.setItemDelegate(self.delegate)
+        self.view.setUniformItemSizes(True)
+        # Lay the rows out a batch at a time from the event loop, not all of them on every change
+        self.view.setLayoutMode(QListView.LayoutMode.Batched)
+        self.view.setVerticalScrollMode(QListView.ScrollMode.ScrollPerPixel)
+        self.view.setSelectionMode(QListView.SelectionMode.NoSelection)
+        layout.addWidget(self.view)
+
+        # Uploads and downloads run in the background, a few at a time
+        self.transfers = TransferManager(self.client, parent=self)
+        self.transfers.job_state_changed.connect(self.update_transfers)
+        self.transfers.job_progress.connect(self.update_progress)
+        # Job id -> (bytes transferred, bytes to transfer) of the running jobs
+        self.progress = {}
+        self.transfers_label = FLabel("", self)
+        layout.addWidget(self.transfers_label)
 
-        self.layout = QVBoxLayout(self.scroll_content)
         button = FPushButton("Disconnect", self)
         button.clicked.connect(self.parent.disconnect_client)
         layout.addWidget(button)
 
         self.client.files_info_received.connect(self.set_files)
+        self.client.files_page_received.connect(self.model.add_page)
 
-    def set_files(self, files: list):
-        self._files_data = files
-        self.update_data()
-
-    def update_data(self):
-        for i, file_data in enumerate(self._files_data):
-            if i > len(self._file_widgets)-1:
-                self.add_widget(file_data)
-            else:
-                self._file_widgets[i].update_data(file_data)
-
-        data_len = len(self._files_data)
-        widget_num = len(self._file_widgets)
-        for i in range(data_len, widget_num):
-            self.delete_widget(i)
-
-    def add_widget(self, file_data: dict):
-        self._highest_file_id += 1
-        file_widget = FileWidget(file_data, self._highest_file_id, self)
-        self._file_widgets.append(file_widget)
-        self.layout.addWidget(file_widget)
-        self.scroll_content.adjustSize()
-
-    def delete_widget(self, index: int):
-        file_widget = self._file_widgets.pop(index)
-        self.layout.removeWidget(file_widget)
-        file_widget.deleteLater()
-        self.scroll_content.adjustSize()
+    def reload(self):
+        """
+        Requests the first page of files again, the rows are replaced when it is received
+        """
+
+        self.model.reload()
+
+    def set_files(self, delta: dict):
+        self.model.set_files(delta)
 
     def add_file(self, file_data: dict):
-        self._files_data.append(file_data)
-        self.update_data()
-
-    @Overload
-    def delete_file(self, file_name: str) -> None:
-        if file_name is not None:
-            for i, file_data in enumerate(self._files_data):
-                if file_data["file_name"] == file_name:
-                    self._files_data.pop(i)
-                    self.update_data()
-                    break
-
-    @delete_file.register
-    def _(self, widget_id: int) -> None:
-        if widget_id is not None:
-            for i, file_widget in enumerate(self._file_widgets):
-                if file_widget.WidgetId == widget_id:
-                    self._files_data.pop(i)
-                    self.update_data()
-                    break
+        self.model.update_files([file_data])
+
+    def delete_file(self, file_name: str):
+        self.client.send(DataType.DELETE_FILE, file_name)
+
+    def download_file(self, file_name: str):
+        file_save_url, _ = QFileDialog.getSaveFileName(self, "Save File", file_name)
+        if file_save_url:
+            self.transfers.download(file_name, file_save_url)
+
+    def update_transfers(self, job_id: int, state: str):
+        if state != "running":
+            self.progress.pop(job_id, None)
+        self.show_transfers()
+
+    def update_progress(self, job_id: int, done: int, total: int):
+        # Emitted at most every ProgressReporter.INTERVAL seconds per job, see progress.py
+        if self.transfers.jobs.get(job_id) is not None and self.transfers.jobs[job_id].state == "running":
+            self.progress[job_id] = (done, total)
+            self.show_transfers()
+
+    def show_transfers(self):
+        states = [job.state for job in self.transfers.jobs.values()]
+        running, queued = states.count("running"), states.count("queued")
+        if not running and not queued:
+            self.transfers_label.setText("")
+            return
+        text = f"{running} transfers running, {queued} queued"
+        total = sum(total for _, total in self.progress.values())
+        if total:
+            text += f", {sum(done for done, _ in self.progress.values()) / total:.0%}"
+        self.transfers_label.setText(text)
 
     def dragEnterEvent(self, event):
         if event.mimeData().hasUrls and all([os.path.exists(url.toLocalFile()) for url in event.mimeData().urls()]):
@@ -164,8 +124,7 @@ class FileList(QWidget):
 
             for url in event.mimeData().urls():
                 if self.client is not None:
-                    # TODO Use threading for file transfer so app doesnt freeze, make sure only one file at a time is sent
-                    self.client.send(DataType.UPLOAD_FILE, str(url.toLocalFile()))
+                    self.transfers.upload(str(url.toLocalFile()))
         else:
             event.ignore()
 
@@ -215,7 +174,8 @@ class MainWindow(FMainWindow):
         self.login = ""
         self.server_ip = socket.gethostbyname(socket.gethostname())
 
-        self.client = Client()
+        # Transfers show their progress in the window (see FileList.update_progress()), not on the terminal
+        self.client = Client(progress=NullReporter)
 
         self.stacked_widget = QStackedWidget(self)
         self.setCentralWidget(self.stacked_widget)
@@ -238,7 +198,7 @@ class MainWindow(FMainWindow):
         result = self.client.connect_to_server(self.login, self.server_ip)
         if result:
             self.stacked_widget.setCurrentIndex(2)
-            self.client.send(DataType.FILES_INFO)
+            self.file_list.reload()
         else:
             self.stacked_widget.setCurrentIndex(1)
 
@@ -0,0 +1,178 @@
+"""
+Server running in several worker processes, each accepting connections on the same port (SO_REUSEPORT, the kernel
+spreads the connections between them) and serving its clients with its own loop.
+
+The workers are forked by a supervisor process they are each connected to by a Unix socket, over which they send
+JSON messages (with the file descriptors passed along with some of them):
+
+login   worker -> supervisor, whether a login can connect, answered with {"type": "answer", "accepted": bool}
+logout  worker -> supervisor, a client disconnected
+changed worker -> supervisor -> other workers, the server files which changed (None for all of them)
+range   worker -> supervisor -> worker, a data connection (its socket, and the fields of its first message) for the
+        worker serving the client it belongs to
+"""
+import json
+import os
+import selectors
+import socket
+from collections import deque
+
+from log import get_logger, stop_logging
+
+logger = get_logger(__name__)
+
+# Longest message, and most file names in a single changed message
+MAX_MESSAGE = 262144
+FILES_PER_MESSAGE = 1000
+
+
+class Channel:
+    """
+    End of the connection between a worker and the supervisor
+    """
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        # (message, file descriptors) received while waiting for an answer, handled afterwards
+        self.pending = deque()
+
+    def fileno(self) -> int:
+        return self.sock.fileno()
+
+    def send(self, message: dict, fds=()) -> None:
+        socket.send_fds(self.sock, [json.dumps(message).encode()], list(fds))
+
+    def receive(self):
+        """
+        Returns the next (message, file descriptors), None once the other end is closed
+        """
+
+        if self.pending:
+            return self.pending.popleft()
+        try:
+            data, fds, _, _ = socket.recv_fds(self.sock, MAX_MESSAGE, 1)
+        except ConnectionError:
+            return None
+        if not data:
+            return None
+        return json.loads(data), fds
+
+    def request(self, message: dict) -> dict:
+        """
+        Sends a message and returns its answer, the messages received in the meantime are kept for later
+        """
+
+        self.send(message)
+        while True:
+            data, fds, _, _ = socket.recv_fds(self.sock, MAX_MESSAGE, 1)
+            if not data:
+                raise ConnectionError("Supervisor gone")
+            answer = json.loads(data)
+            if answer["type"] == "answer":
+                return answer
+            self.pending.append((answer, fds))
+
+    def close(self) -> None:
+        self.sock.close()
+
+
+def send_changes(channel: Channel, file_names) -> None:
+    """
+    Tells about changed files, in as many messages as needed. None stands for all the files.
+    """
+
+    if file_names is None:
+        channel.send({"type": "changed", "files": None})
+        return
+    file_names = list(file_names)
+    for start in range(0, len(file_names), FILES_PER_MESSAGE):
+        channel.send({"type": "changed", "files": file_names[start:start + FILES_PER_MESSAGE]})
+
+
+class Supervisor:
+    """
+    Parent process of the workers. It remembers which worker serves each login, so a login can only be connected
+    once and the data connections of a client reach the worker serving it, and passes the changes a worker made to
+    the server files on to the others.
+    """
+
+    def __init__(self, server, workers: int):
+        self.server = server
+        self.workers = workers
+        # Channel -> pid of the worker at its other end
+        self.channels = dict()
+        # Login -> Channel of the worker serving it
+        self.logins = dict()
+        self.selector = selectors.DefaultSelector()
+
+    def run(self) -> None:
+        """
+        Forks the workers, then serves them until they have all exited
+        """
+
+        for worker in range(self.workers):
+            supervisor_end, worker_end = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            pid = os.fork()
+            if not pid:
+                supervisor_end.close()
+                for channel in self.channels:
+                    channel.close()
+                self.selector.close()
+                status = 0
+                try:
+                    self.server.run(Channel(worker_end), worker)
+                except (KeyboardInterrupt, SystemExit):
+                    pass
+                except BaseException:
+                    logger.exception("Worker %d failed", worker)
+                    status = 1
+                finally:
+                    # Never return to the caller of the supervisor, and os._exit() doesn't write the records queued
+                    stop_logging()
+                    os._exit(status)
+            worker_end.close()
+            channel = Channel(supervisor_end)
+            self.channels[channel] = pid
+            self.selector.register(channel, selectors.EVENT_READ)
+
+        logger.info("Started %d workers", self.workers)
+        while self.channels:
+            for key, _ in self.selector.select():
+                self.handle(key.fileobj)
+
+    def handle(self, channel: Channel) -> None:
+        received = channel.receive()
+        if received is None:
+            self.selector.unregister(channel)
+            channel.close()
+            pid = self.channels.pop(channel)
+            os.waitpid(pid, 0)
+            logger.info("Worker %d exited", pid)
+            for login in [login for login, other in self.logins.items() if other is channel]:
+                del self.logins[login]
+            return
+
+        message, fds = received
+        match message["type"]:
+            case "login":
+                accepted = message["login"] not in self.logins
+                if accepted:
+                    self.logins[message["login"]] = channel
+                channel.send({"type": "answer", "accepted": accepted})
+
+            case "logout":
+                if self.logins.get(message["login"]) is channel:
+                    del self.logins[message["login"]]
+
+            case "changed":
+                for other in self.channels:
+                    if other is not channel:
+                        other.send(message)
+
+            case "range":
+                other = self.logins.get(message["login"])
+                if other is not None:
+                    other.send(message, fds)
+
+        for fd in fds:
+            os.close(fd)